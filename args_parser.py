@@ -1,35 +1,207 @@
-import argparse
-
-
-def parse_args():
-    parent_parser = argparse.ArgumentParser(add_help=False)
-    parent_parser.add_argument("storage", help="full_path")
-
-    parser = argparse.ArgumentParser(parents=[parent_parser])
-    subparsers = parser.add_subparsers(
-        title="available commands", dest="command")
-
-    subparsers.add_parser("init", help="initialize storage")
-
-    add_parser = subparsers.add_parser(
-        "add", help="add value by specified key")
-    add_parser.add_argument(
-        "items", metavar="item", nargs="+", help="key or value")
-
-    get_parser = subparsers.add_parser(
-        "get", help="get values by specified key")
-    get_parser.add_argument("keys", metavar="key", nargs="+")
-
-    del_parser = subparsers.add_parser(
-        "del", help="delete value by specified key")
-    del_parser.add_argument("keys", metavar="key", nargs="+")
-
-    exs_parser = subparsers.add_parser(
-        "exist", help="check if key in storage")
-    exs_parser.add_argument("keys", metavar="keys", nargs="+")
-
-    subparsers.add_parser("keys", help="get all keys")
-
-    subparsers.add_parser("values", help="get all values")
-
-    return parser.parse_args()
+import argparse
+
+from replica import FOLLOW_INTERVAL
+from wal import parse_sync
+
+
+def sync_policy(value):
+    try:
+        parse_sync(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return value
+
+
+def parse_args():
+    parent_parser = argparse.ArgumentParser(add_help=False)
+    parent_parser.add_argument("storage", help="full_path")
+    parent_parser.add_argument(
+        "--fsync", default="batch", type=sync_policy,
+        help="journal fsync policy: always, batch[:ms] or off")
+    parent_parser.add_argument(
+        "--connect", action="store_true",
+        help="send the command to a running `serve` instead of the file")
+    parent_parser.add_argument(
+        "--socket", default=None, metavar="ADDRESS",
+        help="unix socket path or host:port, storage.sock by default")
+
+    parser = argparse.ArgumentParser(parents=[parent_parser])
+    subparsers = parser.add_subparsers(
+        title="available commands", dest="command")
+
+    init_parser = subparsers.add_parser("init", help="initialize storage")
+    init_parser.add_argument(
+        "--engine", choices=["rbtree", "btree"], default="rbtree",
+        help="on-disk structure: binary red-black tree or paged B+tree")
+    init_parser.add_argument(
+        "--bloom", type=float, default=None, metavar="FP_RATE",
+        help="keep a bloom filter with given false positive rate")
+    init_parser.add_argument(
+        "--shards", type=int, default=None,
+        help="create a directory of N hash-partitioned storages")
+    init_parser.add_argument(
+        "--index-values", action="store_true",
+        help="keep an index of keys by value for `find-value`")
+    init_parser.add_argument(
+        "--oplog", action="store_true",
+        help="keep a numbered log of operations for `follow`")
+
+    add_parser = subparsers.add_parser(
+        "add", help="add value by specified key")
+    add_parser.add_argument(
+        "items", metavar="item", nargs="+", help="key or value")
+    add_parser.add_argument(
+        "--ttl", type=float, default=None, metavar="SECONDS",
+        help="expire added keys after given number of seconds")
+
+    get_parser = subparsers.add_parser(
+        "get", help="get values by specified key")
+    get_parser.add_argument("keys", metavar="key", nargs="+")
+    get_parser.add_argument(
+        "--raw", action="store_true",
+        help="write bytes of bytes and str values to stdout as is")
+
+    add_file_parser = subparsers.add_parser(
+        "add-file", help="add bytes value read from file by specified key")
+    add_file_parser.add_argument("key")
+    add_file_parser.add_argument("file", help="path to file, - for stdin")
+    add_file_parser.add_argument(
+        "--ttl", type=float, default=None, metavar="SECONDS",
+        help="expire added key after given number of seconds")
+
+    del_parser = subparsers.add_parser(
+        "del", help="delete value by specified key")
+    del_parser.add_argument("keys", metavar="key", nargs="+")
+
+    exs_parser = subparsers.add_parser(
+        "exist", help="check if key in storage")
+    exs_parser.add_argument("keys", metavar="keys", nargs="+")
+
+    import_parser = subparsers.add_parser(
+        "import", help="load key value pairs from csv or jsonl file")
+    import_parser.add_argument("file", help="path to csv or jsonl file")
+    import_parser.add_argument(
+        "--format", choices=["csv", "jsonl"], default=None,
+        help="input format, guessed by extension if omitted")
+    import_parser.add_argument(
+        "--chunk-size", type=int, default=100000,
+        help="pairs sorted in memory at once")
+
+    subparsers.add_parser(
+        "compact", help="rewrite live data and reclaim free space")
+
+    bloom_parser = subparsers.add_parser(
+        "bloom", help="show bloom filter counters")
+    bloom_parser.add_argument(
+        "--rebuild", action="store_true",
+        help="rebuild filter from stored keys, creating it if missing")
+    bloom_parser.add_argument(
+        "--fp-rate", type=float, default=None,
+        help="false positive rate for rebuilt filter")
+
+    batch_parser = subparsers.add_parser(
+        "batch", help="run add, get, del and exist commands read from stdin")
+    batch_parser.add_argument(
+        "--format", choices=["text", "jsonl"], default="text",
+        help="one command per line as in the command line, or json")
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="keep storage open and serve clients on a socket")
+    serve_parser.add_argument(
+        "--stats", action="store_true",
+        help="collect i/o counters and latencies for `stats`")
+    serve_parser.add_argument(
+        "--memory", action="store_true",
+        help="load all records into memory columns for fast reads")
+
+    subparsers.add_parser(
+        "stats", help="show tree shape, i/o counters and latencies")
+
+    count_parser = subparsers.add_parser(
+        "count", help="count keys with lo <= key < hi without a scan")
+    count_parser.add_argument("lo", nargs="?", default=None)
+    count_parser.add_argument("hi", nargs="?", default=None)
+
+    rank_parser = subparsers.add_parser(
+        "rank", help="number of keys less than key")
+    rank_parser.add_argument("key")
+
+    select_parser = subparsers.add_parser(
+        "select", help="key at position N in key order, from 0")
+    select_parser.add_argument("index", type=int)
+
+    find_parser = subparsers.add_parser(
+        "find-value", help="keys holding a value, or pairs by value range")
+    find_parser.add_argument(
+        "value", nargs="?", default=None,
+        help="print keys with exactly this value")
+    find_parser.add_argument(
+        "--lo", default=None, help="print value and key for lo <= value")
+    find_parser.add_argument(
+        "--hi", default=None, help="and value < hi")
+    find_parser.add_argument(
+        "--reverse", action="store_true", help="descending value order")
+
+    expire_parser = subparsers.add_parser(
+        "expire", help="delete expired keys now")
+    expire_parser.add_argument(
+        "--limit", type=int, default=None,
+        help="delete at most N keys, all expired keys by default")
+
+    ttl_parser = subparsers.add_parser(
+        "ttl", help="seconds left before key expires")
+    ttl_parser.add_argument("key")
+
+    snapshot_parser = subparsers.add_parser(
+        "snapshot",
+        help="copy storage as of now; writes go on only through "
+             "'serve', a local run holds the storage lock while copying")
+    snapshot_parser.add_argument("dest", help="path of the copy")
+
+    backup_parser = subparsers.add_parser(
+        "backup",
+        help="add a backup generation to a directory; writes go on only "
+             "through 'serve', a local run holds the storage lock")
+    backup_parser.add_argument("directory")
+    backup_parser.add_argument(
+        "--incremental", action="store_true",
+        help="copy only records changed since the last generation")
+
+    restore_parser = subparsers.add_parser(
+        "restore", help="create storage from a backup directory")
+    restore_parser.add_argument("directory")
+    restore_parser.add_argument(
+        "--generation", type=int, default=None,
+        help="generation to restore, the last one by default")
+
+    oplog_parser = subparsers.add_parser(
+        "oplog", help="show the operation log position")
+    oplog_parser.add_argument(
+        "--enable", action="store_true",
+        help="start the operation log on an existing storage")
+
+    follow_parser = subparsers.add_parser(
+        "follow", help="keep a follower storage in sync with this one")
+    follow_parser.add_argument("follower", help="follower storage path")
+    follow_parser.add_argument(
+        "--once", action="store_true",
+        help="stop after catching up instead of polling")
+    follow_parser.add_argument(
+        "--interval", type=float, default=FOLLOW_INTERVAL,
+        metavar="SECONDS", help="pause between polls of the leader log")
+    follow_parser.add_argument(
+        "--status", action="store_true",
+        help="print follower position and lag without applying")
+
+    subparsers.add_parser("keys", help="get all keys")
+
+    subparsers.add_parser("values", help="get all values")
+
+    scan_parser = subparsers.add_parser(
+        "scan", help="get pairs with lo <= key < hi in key order")
+    scan_parser.add_argument("lo")
+    scan_parser.add_argument("hi")
+    scan_parser.add_argument(
+        "--reverse", action="store_true", help="descending key order")
+
+    return parser.parse_args()
@@ -0,0 +1,257 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from codec import encode
+from expiry import deadline
+from storage import StorageError
+from wal import DELETE, EXPIRE, PUT
+
+
+# Сколько пар сканирование забирает за один переход в поток
+SCAN_CHUNK = 1000
+
+
+class AsyncStorage:
+    # Обертка Storage для asyncio: вся работа с деревом идет в одном
+    # потоке ввода-вывода, и цикл событий не ждет чтения файлов. Storage
+    # не потокобезопасен (общие файлы и кэш вершин), поэтому поток один,
+    # а параллельность дают пакеты: все чтения, накопившиеся, пока поток
+    # занят, выполняются одним get_many, и одинаковые ключи ищутся один
+    # раз; все записи - одним пакетом журнала с одним fsync. Пакеты
+    # чтений и записей чередуются, так что поток записей не задерживает
+    # читателей дольше одного пакета
+    def __init__(self, storage):
+        self.storage = storage
+        self._executor = None
+        self._worker = None
+        self._wakeup = None
+        self._closing = False
+        # Код ключа -> (ключ, будущее) для ожидающих чтений
+        self._reads = dict()
+        self._contains = dict()
+        # (операции, будущее) для ожидающих записей
+        self._writes = list()
+        # (функция, аргументы, будущее) для прочих вызовов
+        self._calls = list()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="kvs-io")
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        try:
+            await self._run(self.storage.__enter__)
+        except BaseException:
+            self._executor.shutdown()
+            self._executor = None
+            raise
+        self._worker = asyncio.create_task(self._serve())
+
+    async def close(self):
+        # Новые вызовы больше не принимаются, а уже принятые исполнитель
+        # доводит до конца: отмена посреди пакета оставила бы его
+        # ожидающих без ответа. Закрытие неоткрытого - пустая операция
+        if self._executor is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await self._worker
+        finally:
+            self._fail_pending()
+            await self._run(self.storage.__exit__, None, None, None)
+            self._executor.shutdown()
+            self._executor = None
+            self._worker = None
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    async def _serve(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self._drain()
+
+    def _fail_pending(self):
+        # Страховка на случай, если исполнитель сам был отменен
+        error = StorageError("Storage is closed")
+        for _, future in list(self._reads.values()) + \
+                list(self._contains.values()) + self._writes:
+            _resolve(future, error=error)
+        for _, _, future in self._calls:
+            _resolve(future, error=error)
+        self._reads.clear()
+        self._contains.clear()
+        self._writes = list()
+        self._calls = list()
+
+    def _check_open(self):
+        if self._closing or self._worker is None:
+            raise StorageError("Storage is closed")
+
+    async def _drain(self):
+        while self._writes or self._reads or self._contains or self._calls:
+            if self._writes:
+                await self._flush_writes()
+            if self._reads or self._contains:
+                await self._flush_reads()
+            if self._calls:
+                await self._flush_calls()
+
+    async def _flush_writes(self):
+        writes, self._writes = self._writes, list()
+        ops = [op for batch, _ in writes for op in batch]
+        try:
+            await self._run(self.storage.replay, ops)
+        except Exception as error:
+            if len(writes) == 1:
+                _resolve(writes[0][1], error=error)
+                return
+            # Пакет отвергнут целиком, см. Storage._write: вызовы
+            # повторяются по одному, и ошибку получает только свой
+            for batch, future in writes:
+                try:
+                    await self._run(self.storage.replay, batch)
+                except Exception as error:
+                    _resolve(future, error=error)
+                else:
+                    _resolve(future)
+            return
+        for _, future in writes:
+            _resolve(future)
+
+    async def _flush_reads(self):
+        for pending, method in ((self._reads, "get_many"),
+                                (self._contains, "contains_many")):
+            if not pending:
+                continue
+            batch = list(pending.values())
+            pending.clear()
+            try:
+                results = await self._run(
+                    getattr(self.storage, method),
+                    [key for key, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    _resolve(future, error=error)
+                continue
+            for (_, future), result in zip(batch, results):
+                _resolve(future, result)
+
+    async def _flush_calls(self):
+        calls, self._calls = self._calls, list()
+        for function, args, future in calls:
+            try:
+                result = await self._run(function, *args)
+            except Exception as error:
+                _resolve(future, error=error)
+            else:
+                _resolve(future, result)
+
+    def _wait(self, future):
+        self._wakeup.set()
+        # Отмена одного ожидающего не отменяет общий поиск
+        return asyncio.shield(future)
+
+    async def _lookup(self, pending, key):
+        self._check_open()
+        code = encode(key)
+        item = pending.get(code)
+        if item is None:
+            item = (key, asyncio.get_running_loop().create_future())
+            pending[code] = item
+        return await self._wait(item[1])
+
+    async def get(self, key):
+        return await self._lookup(self._reads, key)
+
+    async def contains(self, key):
+        return await self._lookup(self._contains, key)
+
+    async def get_many(self, keys):
+        return await asyncio.gather(*(self.get(key) for key in keys))
+
+    async def _write(self, ops):
+        self._check_open()
+        future = asyncio.get_running_loop().create_future()
+        self._writes.append((ops, future))
+        await self._wait(future)
+
+    async def put(self, key, value, ttl=None):
+        await self.update([(key, value)], ttl)
+
+    async def update(self, items, ttl=None):
+        # Ключи и значения кодируются здесь: ошибка кода достается
+        # только своему вызову, а не всему пакету
+        if hasattr(items, "items"):
+            items = items.items()
+        when = None if ttl is None else deadline(ttl)
+        ops = list()
+        for key, value in items:
+            key = encode(key)
+            ops.append((PUT, key, encode(value)))
+            if when is not None:
+                ops.append((EXPIRE, key, when))
+        await self._write(ops)
+
+    async def delete(self, key):
+        await self.delete_many([key])
+
+    async def delete_many(self, keys):
+        await self._write([(DELETE, encode(key)) for key in keys])
+
+    async def _call(self, function, *args):
+        self._check_open()
+        future = asyncio.get_running_loop().create_future()
+        self._calls.append((function, args, future))
+        return await self._wait(future)
+
+    async def call(self, method, *args):
+        # Любой метод Storage в потоке ввода-вывода, между пакетами
+        return await self._call(getattr(self.storage, method), *args)
+
+    async def scan(self, lo=None, hi=None, reverse=False):
+        # Асинхронный итератор пар. Порции читаются отдельными вызовами,
+        # и между ними могут пройти записи, поэтому каждая следующая
+        # порция начинается от последнего отданного ключа
+        skip = None
+        while True:
+            rows = await self._call(
+                _scan, self.storage, lo, hi, reverse, skip)
+            for row in rows:
+                yield row
+            if len(rows) < SCAN_CHUNK:
+                return
+            skip = rows[-1][0]
+            if reverse:
+                hi = skip
+            else:
+                lo = skip
+
+
+def _scan(storage, lo, hi, reverse, skip):
+    # Вперед нижняя граница включается, уже отданный ключ пропускается
+    rows = storage.range(lo, hi, reverse)
+    if skip is not None and not reverse:
+        rows = (row for row in rows if row[0] != skip)
+    return list(islice(rows, SCAN_CHUNK))
+
+
+def _resolve(future, result=None, error=None):
+    # Ожидавший мог уйти по отмене
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
@@ -0,0 +1,407 @@
+import json
+import os
+import struct
+
+from bloom import BloomFilter
+
+
+MANIFEST = "backup.json"
+# Сколько байт копируется за одно чтение
+COPY_CHUNK = 1024 * 1024
+# Имя копии файла хранилища в каталоге полного поколения
+DATA = "storage"
+
+
+class BackupError(Exception):
+    def __init__(self, text=""):
+        self.text = text
+
+
+class ChangeLog:
+    # Диапазоны записей, измененных контрольными точками после последней
+    # резервной копии, в файле <path>.changes. Заголовок хранит метку
+    # поколения копии, с которого начат учет
+    magic = b"KVSC"
+    header = struct.Struct(">4s16s")
+    # Номер файла образа журнала, смещение, длина
+    block = struct.Struct(">BQI")
+
+    def __init__(self, path):
+        self.path = path
+        self.token = None
+        self._file = None
+
+    @staticmethod
+    def path_for(storage_path):
+        return storage_path + ".changes"
+
+    @classmethod
+    def create(cls, path, token):
+        # Новый журнал подменяет старый атомарно: метка и пустой список
+        temp = path + ".new"
+        with open(temp, "wb") as changes:
+            changes.write(cls.header.pack(cls.magic, bytes.fromhex(token)))
+            changes.flush()
+            os.fsync(changes.fileno())
+        os.replace(temp, path)
+
+    def open(self):
+        self._file = open(self.path, "rb+")
+        magic, token = self.header.unpack(self._file.read(self.header.size))
+        if magic != self.magic:
+            self._file.close()
+            self._file = None
+            raise ValueError(f"File '{self.path}' is not a change log")
+        self.token = token.hex()
+        # Оборванная последняя запись отбрасывается
+        size = os.fstat(self._file.fileno()).st_size - self.header.size
+        self._file.truncate(
+            self.header.size + size // self.block.size * self.block.size)
+        self._file.seek(0, 2)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def append(self, blocks):
+        self._file.write(b"".join(
+            self.block.pack(number, offset, len(data))
+            for number, offset, data in blocks))
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def ranges(self):
+        # Номер файла -> отсортированные непересекающиеся (смещение, длина)
+        self._file.flush()
+        self._file.seek(self.header.size, 0)
+        data = self._file.read()
+        self._file.seek(0, 2)
+        spans = dict()
+        for number, offset, length in self.block.iter_unpack(data):
+            spans.setdefault(number, set()).add((offset, length))
+        return {number: _merge(items) for number, items in spans.items()}
+
+
+def _merge(spans):
+    merged = list()
+    for offset, length in sorted(spans):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            start, size = merged[-1]
+            merged[-1] = (start, max(size, offset + length - start))
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def _read_ranges(path, ranges):
+    # Диапазоны файла по COPY_CHUNK байт: (смещение, данные)
+    with open(path, "rb") as source:
+        for offset, length in ranges:
+            end = offset + length
+            source.seek(offset, 0)
+            while offset < end:
+                data = source.read(min(COPY_CHUNK, end - offset))
+                if not data:
+                    break
+                yield offset, data
+                offset += len(data)
+
+
+def _write_file(path, chunks):
+    total = 0
+    with open(path, "wb") as target:
+        for _, data in chunks:
+            target.write(data)
+            total += len(data)
+        target.flush()
+        os.fsync(target.fileno())
+    return total
+
+
+def _mark_clean(data, clean=True):
+    # Фильтр скопирован сразу после контрольной точки и совпадает с
+    # деревом; копия не должна перестраиваться при открытии
+    header = BloomFilter.header
+    fields = list(header.unpack_from(data, 0))
+    fields[-1] = clean
+    return header.pack(*fields) + data[header.size:]
+
+
+class _Copy:
+    # Копирование в три шага: begin замораживает файлы хранилища под
+    # блокировкой, copy читает их без нее, пока записи копятся в кэше и
+    # журнале, end размораживает. Фильтр Блума меняется на каждой
+    # записи, поэтому читается в память еще в begin
+    def __init__(self):
+        self.bytes = 0
+        self._done = False
+        self._files = list()
+        self._bloom = None
+
+    def begin(self, storage):
+        files = storage.freeze()
+        try:
+            self._plan(storage, files)
+        except BaseException:
+            storage.thaw()
+            raise
+
+    def _plan(self, storage, files):
+        self._base = files[0][1]
+        self._files = list()
+        for number, path, size in files:
+            suffix = path[len(self._base):]
+            if path == BloomFilter.path_for(self._base):
+                with open(path, "rb") as bloom:
+                    self._bloom = (suffix, _mark_clean(bloom.read(size)))
+            else:
+                self._files.append((number, suffix, path, size))
+
+    def end(self, storage):
+        storage.thaw()
+        if not self._done:
+            self._discard()
+            return None
+        return self._commit(storage)
+
+
+class Snapshot(_Copy):
+    # Копия хранилища на момент вызова в файлах dest, dest.heap и т.д.:
+    # готовое хранилище того же формата
+    def __init__(self, dest):
+        super().__init__()
+        self.dest = dest
+
+    def _plan(self, storage, files):
+        if os.path.exists(self.dest):
+            text = f"Snapshot '{self.dest}' already exists"
+            raise BackupError(text)
+        super()._plan(storage, files)
+
+    def copy(self):
+        head = os.path.dirname(self.dest)
+        if head:
+            os.makedirs(head, exist_ok=True)
+        for _, suffix, path, size in self._files:
+            self.bytes += _write_file(
+                self.dest + suffix, _read_ranges(path, [(0, size)]))
+        if self._bloom:
+            suffix, data = self._bloom
+            self.bytes += _write_file(self.dest + suffix, [(0, data)])
+        self._done = True
+
+    def _discard(self):
+        suffixes = [suffix for _, suffix, _, _ in self._files]
+        if self._bloom:
+            suffixes.append(self._bloom[0])
+        for suffix in suffixes:
+            if os.path.exists(self.dest + suffix):
+                os.remove(self.dest + suffix)
+
+    def _commit(self, storage):
+        return {"bytes": self.bytes}
+
+
+class Backup(_Copy):
+    # Каталог резервных копий. Полное поколение - каталог <n>.full с
+    # копиями файлов, разностное - файл <n>.delta с записями, которые
+    # контрольные точки изменили после предыдущего поколения, и
+    # хвостами куч: кучи только дописываются. После каждого поколения
+    # журнал изменений хранилища начинается заново с новой меткой
+    record = struct.Struct(">HQI")
+
+    def __init__(self, directory, incremental=False):
+        super().__init__()
+        self.directory = directory
+        self.incremental = incremental
+        self.kind = None
+        self._token = None
+        self._spans = list()
+        self._stale = None
+
+    def manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as manifest:
+                return json.load(manifest)
+        except FileNotFoundError:
+            return {"token": None, "generations": list()}
+        except (OSError, ValueError):
+            text = f"Backup '{self.directory}' has no valid manifest"
+            raise BackupError(text)
+
+    def _plan(self, storage, files):
+        changes = storage.changes()
+        super()._plan(storage, files)
+        self._manifest = self.manifest()
+        self.generation = len(self._manifest["generations"])
+        # Разностная копия возможна, только если журнал изменений ведется
+        # с прошлого поколения этого каталога; иначе делается полная
+        self.kind = "full"
+        if self.incremental and self.generation and changes and \
+                changes.token == self._manifest["token"]:
+            self.kind = "delta"
+        self._token = os.urandom(16).hex()
+        if self.kind == "full":
+            self._spans = [(suffix, path, [(0, size)])
+                           for _, suffix, path, size in self._files]
+            return
+
+        previous = dict(self._manifest["generations"][-1]["files"])
+        # Фильтр меняется по всей длине даже от немногих записей, поэтому
+        # разностная копия его не несет: восстановленный фильтр берется
+        # из полного поколения и перестраивается при открытии
+        if self._bloom and self._bloom[0] in previous:
+            self._stale = (self._bloom[0], previous[self._bloom[0]])
+            self._bloom = None
+        ranges = changes.ranges()
+        self._spans = list()
+        for number, suffix, path, size in self._files:
+            if suffix not in previous:
+                spans = [(0, size)]
+            elif number is not None:
+                spans = [(offset, min(length, size - offset))
+                         for offset, length in ranges.get(number, ())
+                         if offset < size]
+            else:
+                spans = [(previous[suffix], size - previous[suffix])]
+            self._spans.append(
+                (suffix, path, [span for span in spans if span[1] > 0]))
+
+    def copy(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.kind == "full":
+            self._copy_full()
+        else:
+            self._copy_delta()
+        self._done = True
+
+    def _copy_full(self):
+        target = os.path.join(self.directory, f"{self.generation}.full")
+        os.makedirs(target, exist_ok=True)
+        for suffix, path, spans in self._spans:
+            self.bytes += _write_file(
+                os.path.join(target, DATA + suffix),
+                _read_ranges(path, spans))
+        if self._bloom:
+            suffix, data = self._bloom
+            self.bytes += _write_file(
+                os.path.join(target, DATA + suffix), [(0, data)])
+
+    def _copy_delta(self):
+        def records():
+            for number, (suffix, path, spans) in enumerate(self._spans):
+                for offset, data in _read_ranges(path, spans):
+                    yield number, offset, data
+            if self._bloom:
+                yield len(self._spans), 0, self._bloom[1]
+
+        path = os.path.join(self.directory, f"{self.generation}.delta")
+        with open(path, "wb") as delta:
+            for number, offset, data in records():
+                delta.write(self.record.pack(number, offset, len(data)))
+                delta.write(data)
+                self.bytes += len(data)
+            delta.flush()
+            os.fsync(delta.fileno())
+
+    def _names(self):
+        names = [(suffix, size) for _, suffix, _, size in self._files]
+        if self._bloom:
+            names.append((self._bloom[0], len(self._bloom[1])))
+        if self._stale:
+            names.append(self._stale)
+        return names
+
+    def _discard(self):
+        for name in (f"{self.generation}.full", f"{self.generation}.delta"):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                for item in os.listdir(path):
+                    os.remove(os.path.join(path, item))
+                os.rmdir(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def _commit(self, storage):
+        # Манифест пишется последним: без него поколения нет
+        self._manifest["token"] = self._token
+        self._manifest["generations"].append(
+            {"kind": self.kind, "files": self._names()})
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".new", "w") as manifest:
+            json.dump(self._manifest, manifest)
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        os.replace(path + ".new", path)
+        storage.track_changes(self._token)
+        return {"generation": self.generation, "kind": self.kind,
+                "bytes": self.bytes}
+
+
+def restore(directory, dest, generation=None):
+    # Последнее полное поколение не новее нужного и разностные после него
+    generations = Backup(directory).manifest()["generations"]
+    if not generations:
+        text = f"Backup '{directory}' is empty"
+        raise BackupError(text)
+    if generation is None:
+        generation = len(generations) - 1
+    if not 0 <= generation < len(generations):
+        text = f"Backup '{directory}' has no generation {generation}"
+        raise BackupError(text)
+    if os.path.exists(dest):
+        text = f"Storage '{dest}' already exists"
+        raise BackupError(text)
+    head = os.path.dirname(dest)
+    if head:
+        os.makedirs(head, exist_ok=True)
+
+    start = max(i for i in range(generation + 1)
+                if generations[i]["kind"] == "full")
+    source = os.path.join(directory, f"{start}.full")
+    for suffix, size in generations[start]["files"]:
+        _write_file(dest + suffix, _read_ranges(
+            os.path.join(source, DATA + suffix), [(0, size)]))
+
+    for i in range(start + 1, generation + 1):
+        files = generations[i]["files"]
+        _apply_delta(os.path.join(directory, f"{i}.delta"), dest, files)
+        current = {suffix for suffix, _ in files}
+        for suffix, _ in generations[i - 1]["files"]:
+            if suffix not in current:
+                os.remove(dest + suffix)
+    bloom = BloomFilter.path_for(dest)
+    if generation > start and os.path.exists(bloom):
+        with open(bloom, "rb+") as target:
+            data = target.read(BloomFilter.header.size)
+            target.seek(0, 0)
+            target.write(_mark_clean(data, False))
+    return generation
+
+
+def _apply_delta(path, dest, files):
+    targets = list()
+    for suffix, size in files:
+        mode = "rb+" if os.path.exists(dest + suffix) else "wb+"
+        target = open(dest + suffix, mode)
+        target.truncate(size)
+        targets.append(target)
+    header = Backup.record
+    try:
+        with open(path, "rb") as delta:
+            while True:
+                data = delta.read(header.size)
+                if len(data) < header.size:
+                    break
+                number, offset, length = header.unpack(data)
+                targets[number].seek(offset, 0)
+                targets[number].write(delta.read(length))
+        for target in targets:
+            target.flush()
+            os.fsync(target.fileno())
+    finally:
+        for target in targets:
+            target.close()
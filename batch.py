@@ -0,0 +1,134 @@
+import json
+
+from codec import encode
+
+
+# Сколько подряд идущих однотипных операций выполняется одним вызовом:
+# записи - одним пакетом журнала, чтения - одним обходом дерева
+BATCH_SIZE = 1000
+
+WRITES = ("add", "del")
+READS = ("get", "exist")
+
+
+class BatchError(Exception):
+    def __init__(self, text=""):
+        self.text = text
+
+
+def _convert(item):
+    try:
+        return int(item)
+    except ValueError:
+        return item
+
+
+def parse_text(line):
+    # Та же запись, что в командной строке: add k v [k v ...], get k ...
+    command, *items = line.split()
+    return command, [_convert(item) for item in items]
+
+
+def parse_jsonl(line):
+    # ["add", k, v, ...] или {"op": "add", "key": k, "value": v}
+    item = json.loads(line)
+    if isinstance(item, dict):
+        if "op" not in item or "key" not in item:
+            raise ValueError("expected 'op' and 'key' fields")
+        items = [item["key"]]
+        if "value" in item:
+            items.append(item["value"])
+        return item["op"], items
+    command, *items = item
+    return command, items
+
+
+def format_text(value):
+    return str(value)
+
+
+def format_jsonl(value):
+    return json.dumps(value)
+
+
+FORMATS = {
+    "text": (parse_text, format_text),
+    "jsonl": (parse_jsonl, format_jsonl),
+}
+
+
+class Batch:
+    # Команды читаются построчно, подряд идущие однотипные операции
+    # копятся и выполняются вместе. Смена типа операции сбрасывает
+    # накопленное, поэтому чтение видит все предыдущие записи, а ответы
+    # выходят в порядке команд. Память ограничена размером пачки
+    def __init__(self, storage, output, file_format="text"):
+        self.storage = storage
+        self.output = output
+        self.parse, self.format = FORMATS[file_format]
+        self._command = None
+        self._items = list()
+
+    def run(self, lines):
+        count = 0
+        last = 0
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                command, items = self.parse(line)
+                self._add(command, items)
+            except (ValueError, TypeError) as error:
+                # Строки до ошибочной уже проверены и выполняются
+                self.flush()
+                text = f"Line {number}: {error}"
+                raise BatchError(text)
+            count += 1
+            last = number
+        try:
+            self.flush()
+        except (ValueError, TypeError) as error:
+            text = f"Line {last}: {error}"
+            raise BatchError(text)
+        return count
+
+    def _add(self, command, items):
+        if command not in WRITES + READS:
+            raise ValueError(f"unknown command '{command}'")
+        if not items or command == "add" and len(items) % 2:
+            raise ValueError(f"wrong number of arguments for '{command}'")
+        # Неподходящий ключ или значение должен остановить поток на своей
+        # строке, а не при выполнении пачки
+        for item in items:
+            encode(item)
+        if command == "add":
+            items = list(zip(items[::2], items[1::2]))
+            # Ограничения движка проверяет хранилище; клиент сервера
+            # такой проверки не дает
+            check = getattr(self.storage, "check", None)
+            if check is not None:
+                check(items)
+        if command != self._command:
+            self.flush()
+            self._command = command
+        self._items.extend(items)
+        if len(self._items) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        command, items = self._command, self._items
+        self._items = list()
+        if not items:
+            return
+        if command == "add":
+            self.storage.update(items)
+        elif command == "del":
+            self.storage.delete_many(items)
+        elif command == "get":
+            results = self.storage.get_many(items)
+        else:
+            results = self.storage.contains_many(items)
+        if command in READS:
+            self.output.write("".join(
+                self.format(result) + "\n" for result in results))
@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+from async_storage import AsyncStorage
+from benchmarks.runner import percentile
+from storage import ENGINES, Storage
+
+
+# Одновременных сопрограмм и операций каждой
+TASKS = 1000
+OPS = 20
+KEYS = 100000
+# Доля записей среди операций
+WRITES = 0.1
+# Период сопрограммы, которая меряет задержку цикла событий
+TICK = 0.001
+MODES = ("async", "executor", "blocking")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.concurrency",
+        description="latency of storage calls under concurrent coroutines")
+    parser.add_argument("--engine", choices=list(ENGINES), default="btree")
+    parser.add_argument("--keys", type=int, default=KEYS)
+    parser.add_argument("--tasks", type=int, default=TASKS)
+    parser.add_argument(
+        "--ops", type=int, default=OPS, help="operations per coroutine")
+    parser.add_argument(
+        "--writes", type=float, default=WRITES, help="share of puts")
+    parser.add_argument(
+        "--mode", action="append", choices=MODES,
+        help="way of calling storage, may repeat; all by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fsync", default="batch")
+    parser.add_argument(
+        "--directory", default=None,
+        help="where temporary storages are created")
+    args = parser.parse_args(argv)
+    args.mode = args.mode or MODES
+    return args
+
+
+class Blocking:
+    # Вызовы Storage прямо в сопрограмме: цикл событий стоит на каждом
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def get(self, key):
+        return self.storage.get_many([key])[0]
+
+    async def put(self, key, value):
+        self.storage.set(key, value)
+
+
+class Executor(Blocking):
+    # Каждый вызов отдельно уходит в поток; Storage не потокобезопасен,
+    # поэтому вызовы идут по одному под замком
+    def __init__(self, storage):
+        super().__init__(storage)
+        self._lock = asyncio.Lock()
+
+    async def _run(self, function, *args):
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, function, *args)
+
+    async def get(self, key):
+        return (await self._run(self.storage.get_many, [key]))[0]
+
+    async def put(self, key, value):
+        await self._run(self.storage.set, key, value)
+
+
+async def worker(target, args, seed, latencies):
+    generator = random.Random(seed)
+    for _ in range(args.ops):
+        key = 2 * generator.randrange(args.keys)
+        started = time.perf_counter()
+        if generator.random() < args.writes:
+            await target.put(key, "w")
+        else:
+            await target.get(key)
+        latencies.append(time.perf_counter() - started)
+        # Прочая работа сопрограммы: цикл событий переключается
+        await asyncio.sleep(0)
+
+
+async def ticker(stalls):
+    # Насколько позже срока просыпается сопрограмма цикла событий
+    while True:
+        stalls.append(time.perf_counter())
+        await asyncio.sleep(TICK)
+
+
+async def measure(target, args):
+    latencies, stalls = list(), list()
+    clock = asyncio.create_task(ticker(stalls))
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        worker(target, args, args.seed + number, latencies)
+        for number in range(args.tasks)))
+    elapsed = time.perf_counter() - started
+    clock.cancel()
+    # Паузы между пробуждениями, включая последнюю до конца прогона
+    stalls.append(time.perf_counter())
+    stall = max(b - a for a, b in zip(stalls, stalls[1:])) - TICK
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_us": percentile(latencies, 0.5) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "stall_ms": max(stall, 0.0) * 1e3,
+    }
+
+
+async def run(mode, path, args):
+    storage = Storage(path, sync=args.fsync)
+    if mode == "async":
+        async with AsyncStorage(storage) as target:
+            return await measure(target, args)
+    with storage:
+        target = Executor(storage) if mode == "executor" \
+            else Blocking(storage)
+        return await measure(target, args)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(f"{'mode':<9}{'throughput':>18}{'p50':>10} {'p99':>10}"
+          f"{'loop stall':>17}")
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        path = os.path.join(directory, "bench")
+        Storage(path).init(args.engine)
+        with Storage(path) as storage:
+            storage.bulk_load((2 * i, "v") for i in range(args.keys))
+        for mode in args.mode:
+            row = asyncio.run(run(mode, path, args))
+            print(f"{mode:<9}{row['ops_per_sec']:>12.0f} ops/s"
+                  f"{row['p50_us']:>10.1f} {row['p99_us']:>10.1f} us"
+                  f"{row['stall_ms']:>14.1f} ms", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
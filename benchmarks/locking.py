@@ -0,0 +1,164 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from storage import ENGINES, Storage
+
+
+READERS = 8
+WRITERS = 4
+# Сессий на каждый процесс
+ROUNDS = 20
+# Ключей в хранилище для замера чтения и поисков на процесс
+KEYS = 50000
+LOOKUPS = 15000
+# Маленький кэш: записи вытесняются на диск посреди сессий
+CACHE_SIZE = 32
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.locking",
+        description="stress N reader and M writer processes on one "
+                    "storage and check readers see consistent data")
+    parser.add_argument(
+        "--engine", action="append", choices=list(ENGINES),
+        help="engine to check, may repeat; all engines by default")
+    parser.add_argument("--readers", type=int, default=READERS)
+    parser.add_argument("--writers", type=int, default=WRITERS)
+    parser.add_argument(
+        "--rounds", type=int, default=ROUNDS,
+        help="storage sessions opened by each process")
+    parser.add_argument(
+        "--scaling", default="1,2,4",
+        help="comma separated numbers of reader processes to time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--directory", default=None,
+        help="where temporary storages are created")
+    args = parser.parse_args(argv)
+    try:
+        args.scaling = [int(count) for count in args.scaling.split(",")]
+    except ValueError as error:
+        parser.error(str(error))
+    args.engine = args.engine or list(ENGINES)
+    return args
+
+
+def writer(path, number, args, results):
+    # Каждая сессия пишет пачку ключей с одним значением и их сумму
+    # одной записью журнала, затем удаляет и переписывает другие ключи:
+    # вращения и разбиения идут посреди сессии
+    generator = random.Random(args.seed + number)
+    for i in range(args.rounds):
+        with Storage(path, CACHE_SIZE) as storage:
+            value = number * 100000 + i
+            count = generator.randrange(50, 300)
+            batch = {f"k{j}": value for j in range(count)}
+            batch["sum"] = value * count
+            batch["count"] = count
+            storage.update(batch)
+            storage.delete_many(
+                f"x{generator.randrange(1000)}"
+                for _ in range(generator.randrange(50)))
+            for _ in range(30):
+                storage[f"x{generator.randrange(1000)}"] = value
+    results.put(("writer", 0))
+
+
+def reader(path, number, args, results):
+    # Пачка писателя видна целиком или не видна совсем, ключи идут
+    # по порядку и без повторов
+    errors = 0
+    for _ in range(args.rounds):
+        with Storage(path, CACHE_SIZE, readonly=True) as storage:
+            items = dict(storage.items())
+            count = items.get("count")
+            if count is not None:
+                values = {items.get(f"k{j}") for j in range(count)}
+                if len(values) != 1 or \
+                        items["sum"] != values.pop() * count:
+                    errors += 1
+            keys = list(storage.keys())
+            if keys != sorted(keys) or len(set(keys)) != len(keys):
+                errors += 1
+    results.put(("reader", errors))
+
+
+def stress(engine, path, args):
+    Storage(path).init(engine, bloom=0.01)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+        target=writer, args=(path, number + 1, args, results))
+        for number in range(args.writers)]
+    processes += [multiprocessing.Process(
+        target=reader, args=(path, number, args, results))
+        for number in range(args.readers)]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+    # Упавший процесс считается ошибкой и ответа не присылает
+    finished = sum(process.exitcode == 0 for process in processes)
+    errors = sum(results.get()[1] for _ in range(finished))
+    return errors + len(processes) - finished, elapsed
+
+
+def lookups(path, number, seed, results):
+    generator = random.Random(seed + number)
+    with Storage(path, readonly=True) as storage:
+        for _ in range(LOOKUPS // 1000):
+            storage.get_many(generator.sample(range(2 * KEYS), 1000))
+    results.put(LOOKUPS // 1000 * 1000)
+
+
+def scaling(engine, path, args):
+    # Читатели без писателей: пропускная способность должна расти с
+    # числом процессов, пока хватает ядер
+    Storage(path).init(engine)
+    with Storage(path) as storage:
+        storage.bulk_load((i, i) for i in range(KEYS))
+    rates = list()
+    for count in args.scaling:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=lookups, args=(path, number, args.seed, results))
+            for number in range(count)]
+        started = time.perf_counter()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - started
+        finished = sum(process.exitcode == 0 for process in processes)
+        total = sum(results.get() for _ in range(finished))
+        rates.append((count, total / elapsed))
+    return rates
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    failures = 0
+    for engine in args.engine:
+        with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+            errors, elapsed = stress(
+                engine, os.path.join(directory, "stress"), args)
+            print(f"{engine:<7} readers={args.readers} "
+                  f"writers={args.writers} rounds={args.rounds} "
+                  f"inconsistent={errors} {elapsed:.2f}s", flush=True)
+            failures += errors
+            for count, rate in scaling(
+                    engine, os.path.join(directory, "scaling"), args):
+                print(f"{engine:<7} {count:>3} readers "
+                      f"{rate:>12.0f} lookups/s", flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
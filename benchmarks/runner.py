@@ -0,0 +1,182 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import tempfile
+import time
+
+from benchmarks.workloads import WORKLOADS, Workload
+from storage import ENGINES, MEMORY_ENGINES, MODES, Storage
+from wal import parse_sync
+
+
+SIZES = (1000, 100000, 1000000)
+# Операций на нагрузку; меньше, если ключей в хранилище меньше
+OPS = 10000
+# Допустимое падение ops/sec относительно базового прогона
+THRESHOLD = 0.2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="storage benchmarks with reproducible workloads")
+    parser.add_argument(
+        "--engine", action="append", choices=list(ENGINES),
+        help="engine to measure, may repeat; all engines by default")
+    parser.add_argument(
+        "--sizes", default=",".join(str(size) for size in SIZES),
+        help="comma separated numbers of preloaded keys")
+    parser.add_argument(
+        "--workload", action="append", choices=WORKLOADS,
+        help="workload to run, may repeat; all workloads by default")
+    parser.add_argument(
+        "--ops", type=int, default=OPS, help="operations per workload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache-size", type=int, default=None)
+    parser.add_argument(
+        "--mode", choices=MODES, default="disk",
+        help="memory keeps all records in memory columns, rbtree only")
+    parser.add_argument(
+        "--fsync", default="batch",
+        help="journal fsync policy: always, batch[:ms] or off")
+    parser.add_argument(
+        "--directory", default=None,
+        help="where temporary storages are created")
+    parser.add_argument(
+        "--output", default=None,
+        help="file to write results to, e.g. for a later --baseline; "
+             "results are only printed by default")
+    parser.add_argument(
+        "--baseline", default=None,
+        help="earlier results file to compare against")
+    parser.add_argument(
+        "--threshold", type=float, default=THRESHOLD,
+        help="allowed ops/sec drop against baseline, 0.2 means 20%%")
+    args = parser.parse_args(argv)
+    try:
+        parse_sync(args.fsync)
+        args.sizes = [int(size) for size in args.sizes.split(",")]
+    except ValueError as error:
+        parser.error(str(error))
+    if args.mode == "memory":
+        # Режим memory есть не у всех движков: по умолчанию берутся
+        # только те, что его поддерживают
+        unsupported = [engine for engine in args.engine or ()
+                       if engine not in MEMORY_ENGINES]
+        if unsupported:
+            parser.error(f"engine '{unsupported[0]}' has no memory mode")
+        args.engine = args.engine or list(MEMORY_ENGINES)
+    args.engine = args.engine or list(ENGINES)
+    args.workload = args.workload or WORKLOADS
+    return args
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def storage_size(path):
+    # Файл данных и все его спутники, кроме файла блокировки
+    paths = [path] + glob.glob(glob.escape(path) + ".*")
+    return sum(os.path.getsize(item) for item in paths
+               if not item.endswith(".lock"))
+
+
+def result(engine, size, workload, count, latencies, path):
+    latencies = sorted(latencies)
+    elapsed = sum(latencies)
+    return {
+        "engine": engine,
+        "size": size,
+        "workload": workload,
+        "ops": count,
+        "ops_per_sec": count / elapsed if elapsed else 0.0,
+        "p50_us": percentile(latencies, 0.5) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "file_size": storage_size(path),
+    }
+
+
+def run(engine, size, args):
+    results = list()
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        path = os.path.join(directory, "bench")
+        Storage(path).init(engine)
+        with Storage(path, args.cache_size, args.fsync,
+                     mode=args.mode) as storage:
+            started = time.perf_counter()
+            storage.bulk_load((2 * i, "v") for i in range(size))
+            elapsed = time.perf_counter() - started
+            results.append(
+                result(engine, size, "bulk_load", size, [elapsed], path))
+            report(results[-1])
+
+            workload = Workload(
+                storage, size, min(args.ops, size), args.seed)
+            for name in args.workload:
+                count, latencies = getattr(workload, name)()
+                storage.checkpoint()
+                results.append(
+                    result(engine, size, name, count, latencies, path))
+                report(results[-1])
+    return results
+
+
+def report(row, note=""):
+    print(f"{row['engine']:<7} {row['size']:>8} {row['workload']:<14}"
+          f"{row['ops_per_sec']:>12.0f} ops/s"
+          f"{row['p50_us']:>10.1f} {row['p99_us']:>10.1f} us"
+          f"{row['file_size']:>12} B{note}", flush=True)
+
+
+def compare(results, path, threshold):
+    # Регрессия - падение ops/sec больше допустимого на той же нагрузке
+    with open(path) as file:
+        baseline = {
+            (row["engine"], row["size"], row["workload"]): row
+            for row in json.load(file)["results"]}
+    regressions = list()
+    for row in results:
+        base = baseline.get((row["engine"], row["size"], row["workload"]))
+        if base and row["ops_per_sec"] < \
+                base["ops_per_sec"] * (1 - threshold):
+            regressions.append((row, base))
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(f"{'engine':<7} {'keys':>8} {'workload':<14}"
+          f"{'throughput':>18}{'p50':>10} {'p99':>10}{'size':>18}")
+    results = list()
+    for engine in args.engine:
+        for size in args.sizes:
+            results.extend(run(engine, size, args))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "meta": {
+                    "date": datetime.datetime.now().isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "ops": args.ops,
+                    "seed": args.seed,
+                    "cache_size": args.cache_size,
+                    "mode": args.mode,
+                    "fsync": args.fsync,
+                },
+                "results": results,
+            }, file, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        for row, base in regressions:
+            change = row["ops_per_sec"] / base["ops_per_sec"] - 1
+            report(row, f"  REGRESSION {change:+.0%}")
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,164 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.runner import percentile
+from client import Client
+from server import serve
+from storage import ENGINES, Storage
+
+
+# Операций на каждого клиента
+OPS = 5000
+KEYS = 100000
+# Доля записей среди операций
+WRITES = 0.1
+MODES = ("round-trip", "pipelined")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.server",
+        description="throughput of kvs serve under concurrent local "
+                    "client processes")
+    parser.add_argument("--engine", choices=list(ENGINES), default="btree")
+    parser.add_argument("--keys", type=int, default=KEYS)
+    parser.add_argument(
+        "--clients", default="1,2,4,8",
+        help="comma separated numbers of client processes")
+    parser.add_argument(
+        "--ops", type=int, default=OPS, help="operations per client")
+    parser.add_argument(
+        "--writes", type=float, default=WRITES, help="share of puts")
+    parser.add_argument(
+        "--mode", action="append", choices=MODES,
+        help="one request per operation or pipelined requests, may "
+             "repeat; all by default")
+    parser.add_argument(
+        "--scan", action="store_true",
+        help="run one more client doing full scans all the time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fsync", default="batch")
+    parser.add_argument(
+        "--directory", default=None,
+        help="where temporary storages are created")
+    args = parser.parse_args(argv)
+    try:
+        args.clients = [int(count) for count in args.clients.split(",")]
+    except ValueError as error:
+        parser.error(str(error))
+    args.mode = args.mode or MODES
+    return args
+
+
+def run_server(path, address, sync, ready):
+    serve(Storage(path, sync=sync), address, ready.set, sync)
+
+
+def client(address, mode, args, number, results):
+    generator = random.Random(args.seed + number)
+    latencies = list()
+    with Client(address) as connection:
+        started = time.perf_counter()
+        if mode == "pipelined":
+            # Задержка отдельной операции в конвейере не видна
+            pipeline = connection.pipeline()
+            for _ in range(args.ops):
+                key = 2 * generator.randrange(args.keys)
+                if generator.random() < args.writes:
+                    pipeline.set(key, "w")
+                else:
+                    pipeline.get(key)
+            pipeline.execute()
+        else:
+            for _ in range(args.ops):
+                key = 2 * generator.randrange(args.keys)
+                begun = time.perf_counter()
+                if generator.random() < args.writes:
+                    connection[key] = "w"
+                else:
+                    connection.get_many([key])
+                latencies.append(time.perf_counter() - begun)
+        elapsed = time.perf_counter() - started
+    results.put((args.ops, elapsed, latencies))
+
+
+def scanner(address, stop):
+    # Потоковые ответы читают дерево порциями и не держат остальных
+    with Client(address) as connection:
+        while not stop.is_set():
+            for _ in connection.range():
+                if stop.is_set():
+                    break
+
+
+def measure(address, mode, count, args):
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    processes = [multiprocessing.Process(
+        target=client, args=(address, mode, args, number, results))
+        for number in range(count)]
+    background = list()
+    if args.scan:
+        background.append(multiprocessing.Process(
+            target=scanner, args=(address, stop)))
+    for process in background + processes:
+        process.start()
+    rows = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    stop.set()
+    for process in background:
+        process.join()
+    ops = sum(row[0] for row in rows)
+    elapsed = max(row[1] for row in rows)
+    latencies = sorted(
+        latency for row in rows for latency in row[2])
+    return {
+        "ops": ops,
+        "ops_per_sec": ops / elapsed if elapsed else 0.0,
+        "p50_us": percentile(latencies, 0.5) * 1e6 if latencies else None,
+        "p99_us": percentile(latencies, 0.99) * 1e6 if latencies else None,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(f"{'mode':<11}{'clients':>8}{'throughput':>18}"
+          f"{'p50':>10} {'p99':>10}")
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        path = os.path.join(directory, "bench")
+        address = os.path.join(directory, "bench.sock")
+        Storage(path).init(args.engine)
+        with Storage(path) as storage:
+            storage.bulk_load((2 * i, "v") for i in range(args.keys))
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=run_server, args=(path, address, args.fsync, ready))
+        process.start()
+        try:
+            while not ready.wait(0.1):
+                if not process.is_alive():
+                    print("Server failed to start", file=sys.stderr)
+                    return 1
+            for mode in args.mode:
+                for count in args.clients:
+                    row = measure(address, mode, count, args)
+                    latency = "" if row["p50_us"] is None else \
+                        f"{row['p50_us']:>10.1f} {row['p99_us']:>10.1f} us"
+                    print(f"{mode:<11}{count:>8}"
+                          f"{row['ops_per_sec']:>12.0f} ops/s{latency}",
+                          flush=True)
+        finally:
+            # SIGTERM: сервер закрывает хранилище и удаляет сокет
+            process.terminate()
+            process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
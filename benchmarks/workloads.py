@@ -0,0 +1,159 @@
+import random
+import time
+from itertools import accumulate, islice
+
+
+# Длина короткого сканирования в range и YCSB E
+SCAN_LENGTH = 100
+# Параметр распределения Ципфа, как в YCSB
+ZIPF_THETA = 0.99
+
+
+class Workload:
+    # Хранилище заполнено четными ключами 0, 2, ..., 2 * (size - 1),
+    # так что нечетные ключи гарантированно отсутствуют. Каждая
+    # нагрузка возвращает число операций и задержку каждой из них
+    def __init__(self, storage, size, ops, seed):
+        self.storage = storage
+        self.size = size
+        self.ops = ops
+        self.rng = random.Random(seed)
+        self._next = 2 * size + 1
+        self._zipf = None
+
+    def _timed(self, calls):
+        latencies = list()
+        for call, *args in calls:
+            started = time.perf_counter()
+            call(*args)
+            latencies.append(time.perf_counter() - started)
+        return len(latencies), latencies
+
+    def _hit(self):
+        return 2 * self.rng.randrange(self.size)
+
+    def _miss(self):
+        return 2 * self.rng.randrange(self.size) + 1
+
+    def _new_key(self):
+        key = self._next
+        self._next += 2
+        return key
+
+    def _zipfian(self, count):
+        # Популярные ранги разбросаны по ключам перестановкой, чтобы
+        # горячие ключи не лежали рядом в дереве
+        if self._zipf is None:
+            self._zipf = list(accumulate(
+                1 / (rank + 1) ** ZIPF_THETA for rank in range(self.size)))
+        ranks = self.rng.choices(
+            range(self.size), cum_weights=self._zipf, k=count)
+        return [2 * (rank * 2654435761 % self.size) for rank in ranks]
+
+    def _scan(self, lo, length):
+        for _ in islice(self.storage.range(lo), length):
+            pass
+
+    def insert_seq(self):
+        storage = self.storage
+        return self._timed(
+            (storage.__setitem__, self._new_key(), "v")
+            for _ in range(self.ops))
+
+    def insert_random(self):
+        storage = self.storage
+        return self._timed(
+            (storage.__setitem__, self._miss(), "v")
+            for _ in range(self.ops))
+
+    def get_hit(self):
+        return self._timed(
+            (self.storage.__getitem__, self._hit())
+            for _ in range(self.ops))
+
+    def get_miss(self):
+        return self._timed(
+            (self.storage.__getitem__, self._miss())
+            for _ in range(self.ops))
+
+    def exist(self):
+        return self._timed(
+            (self.storage.__contains__,
+             self._hit() if self.rng.random() < 0.5 else self._miss())
+            for _ in range(self.ops))
+
+    def delete(self):
+        return self._timed(
+            (self.storage.__delitem__, self._hit())
+            for _ in range(self.ops))
+
+    def scan_range(self):
+        count, latencies = self._timed(
+            (self._scan, self._hit(), SCAN_LENGTH)
+            for _ in range(max(1, self.ops // SCAN_LENGTH)))
+        return count * SCAN_LENGTH, latencies
+
+    def scan_full(self):
+        started = time.perf_counter()
+        count = sum(1 for _ in self.storage.items())
+        return count, [time.perf_counter() - started]
+
+    def _mixed(self, operations):
+        # operations: доли операций и функции, получающие ключ
+        shares, calls = zip(*operations)
+        keys = self._zipfian(self.ops)
+        choices = self.rng.choices(calls, weights=shares, k=self.ops)
+        return self._timed((call, key) for call, key in zip(choices, keys))
+
+    def _read(self, key):
+        self.storage[key]
+
+    def _update(self, key):
+        self.storage[key] = "u"
+
+    def _read_modify_write(self, key):
+        value = self.storage[key]
+        self.storage[key] = f"{value}+"
+
+    def _insert(self, key):
+        self.storage[self._new_key()] = "v"
+
+    def _read_latest(self, key):
+        # Чтение недавно вставленных ключей
+        newest = (self._next - 2 * self.size - 1) // 2
+        if newest:
+            offset = self.rng.randrange(min(newest, 100)) + 1
+            self.storage[self._next - 2 * offset]
+        else:
+            self.storage[key]
+
+    def _short_scan(self, key):
+        self._scan(key, self.rng.randint(1, SCAN_LENGTH))
+
+    def ycsb_a(self):
+        return self._mixed([(50, self._read), (50, self._update)])
+
+    def ycsb_b(self):
+        return self._mixed([(95, self._read), (5, self._update)])
+
+    def ycsb_c(self):
+        return self._mixed([(100, self._read)])
+
+    def ycsb_d(self):
+        return self._mixed([(95, self._read_latest), (5, self._insert)])
+
+    def ycsb_e(self):
+        return self._mixed([(95, self._short_scan), (5, self._insert)])
+
+    def ycsb_f(self):
+        return self._mixed(
+            [(50, self._read), (50, self._read_modify_write)])
+
+
+# Порядок важен: нагрузки идут на одном хранилище, поэтому читающие
+# выполняются раньше меняющих данные
+WORKLOADS = [
+    "get_hit", "get_miss", "exist", "scan_range", "scan_full",
+    "ycsb_c", "ycsb_b", "ycsb_a", "ycsb_f", "ycsb_d", "ycsb_e",
+    "insert_seq", "insert_random", "delete",
+]
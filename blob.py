@@ -0,0 +1,102 @@
+import mmap
+import os
+import struct
+
+
+# Коды значений длиннее порога хранятся в файле блобов, в дереве -
+# только ссылка на них
+BLOB_THRESHOLD = 16 * 1024
+# Размер куска при записи значения из файла
+BLOB_CHUNK = 1024 * 1024
+
+# Ссылка: метка, которой нет у типов codec, смещение и длина кода
+# значения в файле блобов
+REF = 0xff
+ref = struct.Struct(">BQQ")
+
+
+def is_ref(value):
+    return value[0] == REF
+
+
+class BlobStore:
+    # Файл <path>.blob с кодами больших значений. Данные только
+    # дописываются, поэтому записанное не меняется, и чтение отдает
+    # memoryview прямо в отображение файла в память без копирования
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._map = None
+        self._size = 0
+
+    @staticmethod
+    def path_for(storage_path):
+        return storage_path + ".blob"
+
+    @staticmethod
+    def create(path):
+        with open(path, "wb"):
+            pass
+
+    def open(self, readonly=False):
+        self._file = open(self.path, "rb" if readonly else "rb+")
+        self._size = os.fstat(self._file.fileno()).st_size
+
+    def close(self):
+        self._unmap()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _unmap(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Отданные представления держат отображение сами, оно
+                # закроется вместе с последним из них
+                pass
+            self._map = None
+
+    def append(self, data):
+        offset = self._size
+        self._file.seek(offset, 0)
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        return ref.pack(REF, offset, len(data))
+
+    def append_stream(self, stream, head=b""):
+        # Код значения из заголовка и содержимого файла, кусками
+        offset = self._size
+        self._file.seek(offset, 0)
+        self._file.write(head)
+        length = len(head)
+        while True:
+            chunk = stream.read(BLOB_CHUNK)
+            if not chunk:
+                break
+            self._file.write(chunk)
+            length += len(chunk)
+        self._file.flush()
+        self._size += length
+        return ref.pack(REF, offset, length)
+
+    def view(self, value):
+        _, offset, length = ref.unpack(value)
+        if self._map is None or offset + length > len(self._map):
+            # Файл вырос: отображение заново на всю длину
+            self._unmap()
+            self._map = mmap.mmap(self._file.fileno(), self._size,
+                                  access=mmap.ACCESS_READ)
+        return memoryview(self._map)[offset:offset + length]
+
+    def read(self, value):
+        return bytes(self.view(value))
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,141 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import struct
+
+
+# Ожидаемое число ключей, если хранилище еще пустое
+BLOOM_CAPACITY = 100000
+BLOOM_FP_RATE = 0.01
+
+# Счетчик, дошедший до предела, больше не уменьшается
+COUNTER_LIMIT = 255
+
+
+class BloomFilter:
+    # Считающий фильтр Блума рядом с файлом хранилища: каждый ключ
+    # увеличивает k однобайтовых счетчиков, удаление их уменьшает.
+    # Нулевой счетчик означает, что ключа точно нет. Файл отображается
+    # в память, флаг clean снимается на время пишущей сессии, и фильтр
+    # после аварийного завершения перестраивается по дереву
+    header = struct.Struct(">4sQIdQQQ?")
+    magic = b"KVSF"
+
+    def __init__(self, path):
+        self.path = path
+        self.slots = 0
+        self.hashes = 0
+        self.fp_rate = 0.0
+        self.clean = False
+        self.readonly = False
+        self.checks = 0
+        self.negatives = 0
+        self.false_positives = 0
+        self._file = None
+        self._map = None
+        self._saved = (0, 0, 0)
+
+    @staticmethod
+    def path_for(storage_path):
+        return storage_path + ".bloom"
+
+    @classmethod
+    def is_clean(cls, path):
+        with open(path, "rb") as bloom:
+            return cls.header.unpack(bloom.read(cls.header.size))[-1]
+
+    @classmethod
+    def create(cls, path, capacity=BLOOM_CAPACITY, fp_rate=BLOOM_FP_RATE):
+        if not 0 < fp_rate < 1:
+            raise ValueError(f"False positive rate {fp_rate} not in (0, 1)")
+        capacity = max(capacity, 1)
+        slots = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+        hashes = max(1, round(slots / capacity * math.log(2)))
+        with open(path, "wb") as bloom:
+            bloom.write(cls.header.pack(
+                cls.magic, slots, hashes, fp_rate, 0, 0, 0, True))
+            bloom.truncate(cls.header.size + slots)
+
+    def open(self, readonly=False):
+        self.readonly = readonly
+        self._file = open(self.path, "rb+")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.slots, self.hashes, self.fp_rate, self.checks, \
+            self.negatives, self.false_positives, self.clean = \
+            self.header.unpack_from(self._map, 0)
+        if magic != self.magic:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+            raise ValueError(f"File '{self.path}' is not a bloom filter")
+        self._saved = (self.checks, self.negatives, self.false_positives)
+        if not readonly:
+            self._save(clean=False)
+
+    def close(self, clean=False):
+        if self._map is not None:
+            self._save(clean)
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _save(self, clean):
+        # Читатели работают параллельно, поэтому каждая сессия прибавляет
+        # свои счетчики к сохраненным под блокировкой файла фильтра
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+        try:
+            saved = self.header.unpack_from(self._map, 0)
+            counters = [now + stored - base for now, stored, base in zip(
+                (self.checks, self.negatives, self.false_positives),
+                saved[4:7], self._saved)]
+            if self.readonly:
+                clean = saved[7]
+            self.header.pack_into(
+                self._map, 0, self.magic, self.slots, self.hashes,
+                self.fp_rate, *counters, clean)
+            self._map.flush()
+            self.checks, self.negatives, self.false_positives = counters
+            self._saved = tuple(counters)
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        step = int.from_bytes(digest[8:], "big") | 1
+        offset = self.header.size
+        for i in range(self.hashes):
+            yield offset + (first + i * step) % self.slots
+
+    def add(self, key):
+        for position in self._positions(key):
+            counter = self._map[position]
+            if counter < COUNTER_LIMIT:
+                self._map[position] = counter + 1
+
+    def remove(self, key):
+        for position in self._positions(key):
+            counter = self._map[position]
+            if 0 < counter < COUNTER_LIMIT:
+                self._map[position] = counter - 1
+
+    def __contains__(self, key):
+        self.checks += 1
+        for position in self._positions(key):
+            if not self._map[position]:
+                self.negatives += 1
+                return False
+        return True
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "hashes": self.hashes,
+            "fp_rate": self.fp_rate,
+            "checks": self.checks,
+            "negatives": self.negatives,
+            "false_positives": self.false_positives,
+        }
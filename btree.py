@@ -0,0 +1,728 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+import os
+import struct
+
+from heap import Heap
+
+
+PAGE_SIZE = 4096
+# Ограничения подобраны так, чтобы после разделения или перераспределения
+# каждая половина гарантированно помещалась в страницу
+MAX_KEY_SIZE = 1024
+INLINE_VALUE_SIZE = 256
+UNDERFLOW_SIZE = PAGE_SIZE // 4
+
+LEAF = 1
+INNER = 2
+FREE = 3
+
+
+# Значение, вынесенное в кучу
+Ref = namedtuple("Ref", ["offset", "length"])
+
+
+class Page:
+    # kind, count, next, prev, first_child, first_child_keys
+    header = struct.Struct(">BHiiiq")
+    # key_len, value_in_heap, value_len
+    leaf_entry = struct.Struct(">H?I")
+    # key_len, child, child_keys
+    inner_entry = struct.Struct(">Hiq")
+    ref = struct.Struct(">q")
+
+    def __init__(self, index, leaf, keys=None, values=None,
+                 children=None, counts=None, next=-1, prev=-1):
+        self.index = index
+        self.leaf = leaf
+        self.keys = keys if keys is not None else list()
+        # Для листа - значения (bytes или Ref), для внутренней - потомки
+        self.values = values if values is not None else list()
+        self.children = children if children is not None else list()
+        # Число ключей в поддереве каждого потомка
+        self.counts = counts if counts is not None else list()
+        self.next = next
+        self.prev = prev
+
+    def entry_size(self, i):
+        if self.leaf:
+            value = self.values[i]
+            value_size = (
+                self.ref.size if isinstance(value, Ref) else len(value))
+            return self.leaf_entry.size + len(self.keys[i]) + value_size
+        return self.inner_entry.size + len(self.keys[i])
+
+    def total(self):
+        # Число ключей в поддереве страницы
+        return len(self.keys) if self.leaf else sum(self.counts)
+
+    def size(self):
+        return self.header.size + sum(
+            self.entry_size(i) for i in range(len(self.keys)))
+
+    def split_point(self):
+        # Индекс, делящий записи страницы пополам по объему
+        half = (self.size() - self.header.size) // 2
+        total = 0
+        for i in range(len(self.keys)):
+            total += self.entry_size(i)
+            if total >= half:
+                break
+        lo, hi = (1, len(self.keys) - 1) if self.leaf \
+            else (1, len(self.keys) - 2)
+        return min(max(i, lo), hi)
+
+    def pack(self):
+        first_child = -1 if self.leaf else self.children[0]
+        first_count = 0 if self.leaf else self.counts[0]
+        parts = [self.header.pack(
+            LEAF if self.leaf else INNER, len(self.keys),
+            self.next, self.prev, first_child, first_count)]
+        if self.leaf:
+            for key, value in zip(self.keys, self.values):
+                if isinstance(value, Ref):
+                    parts.append(
+                        self.leaf_entry.pack(len(key), True, value.length))
+                    parts.append(key)
+                    parts.append(self.ref.pack(value.offset))
+                else:
+                    parts.append(
+                        self.leaf_entry.pack(len(key), False, len(value)))
+                    parts.append(key)
+                    parts.append(value)
+        else:
+            for key, child, count in zip(
+                    self.keys, self.children[1:], self.counts[1:]):
+                parts.append(self.inner_entry.pack(len(key), child, count))
+                parts.append(key)
+        return b"".join(parts).ljust(PAGE_SIZE, b"\0")
+
+    @classmethod
+    def unpack(cls, index, data):
+        kind, count, next, prev, first_child, first_count = \
+            cls.header.unpack_from(data)
+        page = cls(index, kind == LEAF, next=next, prev=prev)
+        offset = cls.header.size
+        if page.leaf:
+            for _ in range(count):
+                key_len, in_heap, value_len = \
+                    cls.leaf_entry.unpack_from(data, offset)
+                offset += cls.leaf_entry.size
+                page.keys.append(bytes(data[offset:offset + key_len]))
+                offset += key_len
+                if in_heap:
+                    heap_offset = cls.ref.unpack_from(data, offset)[0]
+                    page.values.append(Ref(heap_offset, value_len))
+                    offset += cls.ref.size
+                else:
+                    page.values.append(
+                        bytes(data[offset:offset + value_len]))
+                    offset += value_len
+        else:
+            page.children.append(first_child)
+            page.counts.append(first_count)
+            for _ in range(count):
+                key_len, child, child_count = \
+                    cls.inner_entry.unpack_from(data, offset)
+                offset += cls.inner_entry.size
+                page.keys.append(bytes(data[offset:offset + key_len]))
+                offset += key_len
+                page.children.append(child)
+                page.counts.append(child_count)
+        return page
+
+
+class PageStream:
+    magic = b"KVSB"
+    cache_size = 1024
+
+    # Метка формата, число страниц, корень, высота,
+    # голова списка свободных страниц, число ключей, поколение кучи
+    header = struct.Struct(">4siiiiqi")
+
+    def __init__(self, path, cache_size=None):
+        self.path = path
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.heap = None
+        self.heap_gen = 0
+        # Счетчики stats.Stats, None - сбор выключен
+        self.stats = None
+        self._file = None
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self.pages_count = 1
+        self.root = -1
+        self.height = 0
+        self.free_head = -1
+        self.count = 0
+        self._header_dirty = False
+
+    @classmethod
+    def create(cls, path, heap_gen=0):
+        with open(path, "wb") as storage:
+            storage.write(
+                cls.header.pack(cls.magic, 1, -1, 0, -1, 0, heap_gen)
+                .ljust(PAGE_SIZE, b"\0"))
+        with open(Heap.path_for(path, heap_gen), "wb"):
+            pass
+
+    def open(self):
+        self._file = open(self.path, "rb+")
+        _, self.pages_count, self.root, self.height, self.free_head, \
+            self.count, self.heap_gen = self.header.unpack(
+                self._file.read(self.header.size))
+        self.heap = Heap(Heap.path_for(self.path, self.heap_gen))
+        self.heap.stats = self.stats
+        self.heap.open()
+        if self.stats is not None:
+            self.stats.file_opens += 1
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+            self.heap.close()
+        self._cache.clear()
+
+    def set_header(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self._header_dirty = True
+
+    def get_page(self, index):
+        if index == -1:
+            return None
+        page = self._cache.get(index)
+        stats = self.stats
+        if page is not None:
+            self._cache.move_to_end(index)
+            if stats is not None:
+                stats.cache_hits += 1
+            return page
+
+        self._file.seek(index * PAGE_SIZE, 0)
+        data = self._file.read(PAGE_SIZE)
+        if stats is not None:
+            stats.cache_misses += 1
+            stats.seeks += 1
+            stats.bytes_read += len(data)
+            stats.nodes_read += 1
+        page = Page.unpack(index, data)
+        self._cache[index] = page
+        return page
+
+    def set_page(self, page):
+        self._cache[page.index] = page
+        self._cache.move_to_end(page.index)
+        self._dirty.add(page.index)
+
+    def new_page(self, leaf):
+        if self.free_head != -1:
+            index = self.free_head
+            self.set_header(free_head=self.get_page(index).next)
+        else:
+            index = self.pages_count
+            self.set_header(pages_count=self.pages_count + 1)
+        page = Page(index, leaf)
+        self.set_page(page)
+        return page
+
+    def free_page(self, page):
+        # Освобожденная страница хранит ссылку на следующую свободную
+        self.set_page(_FreePage(page.index, self.free_head))
+        self.set_header(free_head=page.index)
+
+    def begin_pages(self):
+        # Последовательная запись страниц начиная с первой
+        self._cache.clear()
+        self._dirty.clear()
+        self._file.seek(PAGE_SIZE, 0)
+        if self.stats is not None:
+            self.stats.seeks += 1
+
+    def append_page(self, page):
+        self._file.write(page.pack())
+        if self.stats is not None:
+            self.stats.nodes_written += 1
+            self.stats.bytes_written += PAGE_SIZE
+
+    def end_pages(self, pages_count, root, height, count):
+        self._file.truncate()
+        self.set_header(pages_count=pages_count, root=root, height=height,
+                        free_head=-1, count=count)
+        self.flush()
+
+    def blocks(self):
+        blocks = list()
+        for index in sorted(self._dirty):
+            blocks.append((index * PAGE_SIZE, self._cache[index].pack()))
+        if self._header_dirty:
+            blocks.append((0, self.header.pack(
+                self.magic, self.pages_count, self.root, self.height,
+                self.free_head, self.count, self.heap_gen)))
+        return blocks
+
+    def write_blocks(self, blocks):
+        for offset, data in blocks:
+            self._file.seek(offset, 0)
+            self._file.write(data)
+        if self.stats is not None:
+            self.stats.seeks += len(blocks)
+            self.stats.bytes_written += sum(len(data) for _, data in blocks)
+            self.stats.nodes_written += len(blocks) - self._header_dirty
+        self._dirty.clear()
+        self._header_dirty = False
+        self._file.flush()
+        self.trim()
+
+    def dirty_count(self):
+        return len(self._dirty)
+
+    def drop_cache(self):
+        if not self._dirty:
+            self._cache.clear()
+
+    def flush(self):
+        blocks = self.blocks()
+        self.heap.flush()
+        self.write_blocks(blocks)
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.heap.sync()
+
+    def trim(self):
+        excess = len(self._cache) - self.cache_size
+        if excess <= 0:
+            return
+        victims = list()
+        for index in self._cache:
+            if index not in self._dirty:
+                victims.append(index)
+                if len(victims) == excess:
+                    break
+        for index in victims:
+            del self._cache[index]
+
+
+class _FreePage:
+    def __init__(self, index, next):
+        self.index = index
+        self.next = next
+
+    def pack(self):
+        return Page.header.pack(FREE, 0, self.next, -1, -1, 0) \
+            .ljust(PAGE_SIZE, b"\0")
+
+
+class BTree:
+    max_key_size = MAX_KEY_SIZE
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _value(self, value):
+        if isinstance(value, Ref):
+            return self.stream.heap.read(value.offset, value.length)
+        return value
+
+    def _store(self, value):
+        if len(value) > INLINE_VALUE_SIZE:
+            return Ref(self.stream.heap.append(value), len(value))
+        return value
+
+    def _leaf(self, key):
+        page = self.stream.get_page(self.stream.root)
+        while page is not None and not page.leaf:
+            page = self.stream.get_page(
+                page.children[bisect_right(page.keys, key)])
+        return page
+
+    def get(self, key):
+        page = self._leaf(key)
+        if page is None:
+            return None
+        i = bisect_left(page.keys, key)
+        if i < len(page.keys) and page.keys[i] == key:
+            return self._value(page.values[i])
+
+    def __contains__(self, key):
+        page = self._leaf(key)
+        if page is None:
+            return False
+        i = bisect_left(page.keys, key)
+        return i < len(page.keys) and page.keys[i] == key
+
+    def get_many(self, keys, values=True):
+        # keys - отсортированные различные ключи; на каждой странице
+        # набор делится между потомками, так что страница читается один раз
+        found = dict()
+        stack = [(self.stream.root, 0, len(keys))]
+        while stack:
+            index, lo, hi = stack.pop()
+            if index == -1 or lo >= hi:
+                continue
+            page = self.stream.get_page(index)
+            if page.leaf:
+                for key in keys[lo:hi]:
+                    i = bisect_left(page.keys, key)
+                    if i < len(page.keys) and page.keys[i] == key:
+                        found[key] = \
+                            self._value(page.values[i]) if values else True
+                continue
+            start = lo
+            for i, separator in enumerate(page.keys):
+                end = bisect_left(keys, separator, start, hi)
+                stack.append((page.children[i], start, end))
+                start = end
+            stack.append((page.children[-1], start, hi))
+        return found
+
+    def __len__(self):
+        return self.stream.count
+
+    def rank(self, key):
+        # Число ключей меньше key: суммы потомков левее пути поиска
+        rank = 0
+        page = self.stream.get_page(self.stream.root)
+        while page is not None and not page.leaf:
+            i = bisect_right(page.keys, key)
+            rank += sum(page.counts[:i])
+            page = self.stream.get_page(page.children[i])
+        if page is not None:
+            rank += bisect_left(page.keys, key)
+        return rank
+
+    def select(self, i):
+        # i-й по порядку ключ, считая с нуля
+        page = self.stream.get_page(self.stream.root)
+        while page is not None and not page.leaf:
+            for child, count in zip(page.children, page.counts):
+                if i < count:
+                    break
+                i -= count
+            page = self.stream.get_page(child)
+        if page is not None and i < len(page.keys):
+            return page.keys[i]
+
+    def is_empty(self):
+        return self.stream.count == 0
+
+    def insert(self, key, value):
+        if len(key) > MAX_KEY_SIZE:
+            raise ValueError(
+                f"Key longer than {MAX_KEY_SIZE} bytes "
+                "is not supported by btree engine")
+        value = self._store(value)
+        count = self.stream.count
+
+        root = self.stream.get_page(self.stream.root)
+        if root is None:
+            root = self.stream.new_page(leaf=True)
+            self.stream.set_header(root=root.index, height=1)
+
+        split = self._insert(root, key, value)
+        if split:
+            separator, right = split
+            new_root = self.stream.new_page(leaf=False)
+            new_root.keys = [separator]
+            new_root.children = [root.index, right.index]
+            new_root.counts = [root.total(), right.total()]
+            self.stream.set_header(
+                root=new_root.index, height=self.stream.height + 1)
+        return self.stream.count > count
+
+    def _insert(self, page, key, value):
+        if page.leaf:
+            i = bisect_left(page.keys, key)
+            if i < len(page.keys) and page.keys[i] == key:
+                page.values[i] = value
+            else:
+                page.keys.insert(i, key)
+                page.values.insert(i, value)
+                self.stream.set_header(count=self.stream.count + 1)
+            self.stream.set_page(page)
+        else:
+            i = bisect_right(page.keys, key)
+            child = self.stream.get_page(page.children[i])
+            count = self.stream.count
+            split = self._insert(child, key, value)
+            if split:
+                self._add_child(page, i, child, split)
+            elif self.stream.count != count:
+                page.counts[i] += 1
+                self.stream.set_page(page)
+
+        if page.size() > PAGE_SIZE:
+            return self._split(page)
+
+    def _add_child(self, page, i, child, split):
+        separator, right = split
+        page.keys.insert(i, separator)
+        page.children.insert(i + 1, right.index)
+        page.counts[i] = child.total()
+        page.counts.insert(i + 1, right.total())
+        self.stream.set_page(page)
+
+    def _split(self, page):
+        if self.stream.stats is not None:
+            self.stream.stats.splits += 1
+        mid = page.split_point()
+        right = self.stream.new_page(leaf=page.leaf)
+        if page.leaf:
+            right.keys, page.keys = page.keys[mid:], page.keys[:mid]
+            right.values, page.values = page.values[mid:], page.values[:mid]
+            right.next, right.prev = page.next, page.index
+            if page.next != -1:
+                following = self.stream.get_page(page.next)
+                following.prev = right.index
+                self.stream.set_page(following)
+            page.next = right.index
+            separator = right.keys[0]
+        else:
+            separator = page.keys[mid]
+            right.keys, page.keys = page.keys[mid + 1:], page.keys[:mid]
+            right.children, page.children = \
+                page.children[mid + 1:], page.children[:mid + 1]
+            right.counts, page.counts = \
+                page.counts[mid + 1:], page.counts[:mid + 1]
+        self.stream.set_page(page)
+        self.stream.set_page(right)
+        return separator, right
+
+    def delete(self, key):
+        root = self.stream.get_page(self.stream.root)
+        if root is None:
+            return False
+
+        found, split = self._delete(root, key)
+        if split:
+            separator, right = split
+            new_root = self.stream.new_page(leaf=False)
+            new_root.keys = [separator]
+            new_root.children = [root.index, right.index]
+            new_root.counts = [root.total(), right.total()]
+            self.stream.set_header(
+                root=new_root.index, height=self.stream.height + 1)
+        elif not root.leaf and not root.keys:
+            # Корень с единственным потомком: дерево становится ниже
+            self.stream.set_header(
+                root=root.children[0], height=self.stream.height - 1)
+            self.stream.free_page(root)
+        return found
+
+    def _delete(self, page, key):
+        if page.leaf:
+            i = bisect_left(page.keys, key)
+            if i == len(page.keys) or page.keys[i] != key:
+                return False, None
+            del page.keys[i]
+            del page.values[i]
+            self.stream.set_page(page)
+            self.stream.set_header(count=self.stream.count - 1)
+            return True, None
+
+        i = bisect_right(page.keys, key)
+        child = self.stream.get_page(page.children[i])
+        found, split = self._delete(child, key)
+        if split:
+            self._add_child(page, i, child, split)
+        elif found:
+            page.counts[i] -= 1
+            self.stream.set_page(page)
+            if child.size() < UNDERFLOW_SIZE:
+                self._rebalance(page, i)
+
+        if page.size() > PAGE_SIZE:
+            return found, self._split(page)
+        return found, None
+
+    def _rebalance(self, parent, i):
+        # Сливаем потомка с соседом, а если вместе они не помещаются
+        # в страницу - делим записи между ними поровну
+        i = i - 1 if i > 0 else i
+        left = self.stream.get_page(parent.children[i])
+        right = self.stream.get_page(parent.children[i + 1])
+        separator = parent.keys[i]
+
+        if left.leaf:
+            merged = Page(left.index, True, left.keys + right.keys,
+                          left.values + right.values)
+        else:
+            merged = Page(left.index, False,
+                          left.keys + [separator] + right.keys,
+                          children=left.children + right.children,
+                          counts=left.counts + right.counts)
+
+        if merged.size() <= PAGE_SIZE:
+            if self.stream.stats is not None:
+                self.stream.stats.merges += 1
+            left.keys, left.values, left.children, left.counts = \
+                merged.keys, merged.values, merged.children, merged.counts
+            if left.leaf:
+                left.next = right.next
+                if right.next != -1:
+                    following = self.stream.get_page(right.next)
+                    following.prev = left.index
+                    self.stream.set_page(following)
+            del parent.keys[i]
+            del parent.children[i + 1]
+            parent.counts[i] += parent.counts.pop(i + 1)
+            self.stream.set_page(left)
+            self.stream.free_page(right)
+        else:
+            mid = merged.split_point()
+            if left.leaf:
+                left.keys, right.keys = merged.keys[:mid], merged.keys[mid:]
+                left.values, right.values = \
+                    merged.values[:mid], merged.values[mid:]
+                parent.keys[i] = right.keys[0]
+            else:
+                left.keys, right.keys = \
+                    merged.keys[:mid], merged.keys[mid + 1:]
+                left.children, right.children = \
+                    merged.children[:mid + 1], merged.children[mid + 1:]
+                left.counts, right.counts = \
+                    merged.counts[:mid + 1], merged.counts[mid + 1:]
+                parent.keys[i] = merged.keys[mid]
+            parent.counts[i], parent.counts[i + 1] = \
+                left.total(), right.total()
+            self.stream.set_page(left)
+            self.stream.set_page(right)
+        self.stream.set_page(parent)
+
+    def items(self, lo=None, hi=None, reverse=False):
+        # Листья связаны в список: после спуска к первому листу
+        # диапазона чтение идет страница за страницей
+        if self.stream.root == -1:
+            return
+        if not reverse:
+            page = self._leaf(lo) if lo is not None else self._edge(0)
+            i = bisect_left(page.keys, lo) if lo is not None else 0
+        else:
+            page = self._leaf(hi) if hi is not None else self._edge(-1)
+            i = (bisect_left(page.keys, hi) if hi is not None
+                 else len(page.keys)) - 1
+
+        while page is not None:
+            keys, values = page.keys, page.values
+            if not reverse:
+                while i < len(keys):
+                    if hi is not None and keys[i] >= hi:
+                        return
+                    yield keys[i], self._value(values[i])
+                    i += 1
+                page = self.stream.get_page(page.next)
+                i = 0
+            else:
+                while i >= 0:
+                    if lo is not None and keys[i] < lo:
+                        return
+                    yield keys[i], self._value(values[i])
+                    i -= 1
+                page = self.stream.get_page(page.prev)
+                i = len(page.keys) - 1 if page is not None else -1
+            self.stream.trim()
+
+    def _edge(self, side):
+        page = self.stream.get_page(self.stream.root)
+        while not page.leaf:
+            page = self.stream.get_page(page.children[side])
+        return page
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def structure(self):
+        # Обход всех страниц: сколько их достижимо из корня и насколько
+        # они заполнены
+        pages = used = 0
+        stack = [self.stream.root] if self.stream.root != -1 else []
+        while stack:
+            page = self.stream.get_page(stack.pop())
+            pages += 1
+            used += page.size()
+            if not page.leaf:
+                stack.extend(page.children)
+        return {
+            "keys": self.stream.count,
+            "nodes": pages,
+            "height": self.stream.height,
+            "free_pages": self.stream.pages_count - 1 - pages,
+            "fill_ratio": used / (pages * PAGE_SIZE) if pages else 1.0,
+        }
+
+    def compact_into(self, stream, convert=None):
+        # Листья нового файла идут подряд в порядке ключей. convert,
+        # если задан, переводит значения для нового файла
+        pairs = self.items()
+        if convert is not None:
+            pairs = ((key, convert(value)) for key, value in pairs)
+        BTree(stream).build(pairs, len(self))
+
+    def build(self, pairs, count):
+        # Страницы пишутся в файл по мере заполнения, в памяти остаются
+        # только первый ключ, номер и число ключей каждой, по ним
+        # строятся верхние уровни
+        fill = PAGE_SIZE * 9 // 10
+        self.stream.begin_pages()
+        level = list()
+        index = 0
+        page = None
+        size = 0
+        page_key = None
+        for key, value in pairs:
+            if len(key) > MAX_KEY_SIZE:
+                raise ValueError(
+                    f"Key longer than {MAX_KEY_SIZE} bytes "
+                    "is not supported by btree engine")
+            value = self._store(value)
+            entry = Page.leaf_entry.size + len(key) + (
+                Page.ref.size if isinstance(value, Ref) else len(value))
+            if page is None or size + entry > fill:
+                index += 1
+                if page is not None:
+                    page.next = index
+                    level.append(self._write_page(page, page.keys[0]))
+                page = Page(index, True, prev=index - 1 if level else -1)
+                size = Page.header.size
+            page.keys.append(key)
+            page.values.append(value)
+            size += entry
+        if page is not None:
+            level.append(self._write_page(page, page.keys[0]))
+        self.stream.heap.flush()
+
+        height = 1 if level else 0
+        while len(level) > 1:
+            height += 1
+            upper = list()
+            page = None
+            for first_key, child, child_count in level:
+                entry = Page.inner_entry.size + len(first_key)
+                if page is None or size + entry > fill:
+                    if page is not None:
+                        upper.append(self._write_page(page, page_key))
+                    index += 1
+                    page = Page(index, False, children=[child],
+                                counts=[child_count])
+                    page_key = first_key
+                    size = Page.header.size
+                    continue
+                page.keys.append(first_key)
+                page.children.append(child)
+                page.counts.append(child_count)
+                size += entry
+            upper.append(self._write_page(page, page_key))
+            level = upper
+
+        root = level[0][1] if level else -1
+        self.stream.end_pages(index + 1, root, height, count)
+
+    def _write_page(self, page, first_key):
+        self.stream.append_page(page)
+        return first_key, page.index, page.total()
@@ -0,0 +1,121 @@
+import csv
+import heapq
+import json
+import os
+import pickle
+import tempfile
+from itertools import count
+
+
+CHUNK_SIZE = 100000
+
+
+def _convert(item):
+    try:
+        return int(item)
+    except ValueError:
+        return item
+
+
+def read_csv(path):
+    with open(path, newline="") as source:
+        for row in csv.reader(source):
+            if not row:
+                continue
+            if len(row) != 2:
+                raise ValueError(f"Expected key and value, got {row}")
+            yield _convert(row[0]), _convert(row[1])
+
+
+def read_jsonl(path):
+    with open(path) as source:
+        for line in source:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, dict):
+                yield item["key"], item["value"]
+            else:
+                key, value = item
+                yield key, value
+
+
+def read_pairs(path, file_format=None):
+    if file_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        file_format = "jsonl" if extension in (".jsonl", ".json") else "csv"
+    if file_format == "jsonl":
+        return read_jsonl(path)
+    return read_csv(path)
+
+
+def _dump_chunk(chunk, directory):
+    chunk.sort(key=lambda row: (row[0], row[1]))
+    with tempfile.NamedTemporaryFile(
+            dir=directory, suffix=".chunk", delete=False) as file:
+        for row in chunk:
+            pickle.dump(row, file, pickle.HIGHEST_PROTOCOL)
+        return file.name
+
+
+def _load_chunk(path):
+    with open(path, "rb") as file:
+        while True:
+            try:
+                yield pickle.load(file)
+            except EOFError:
+                return
+
+
+def _unique(rows):
+    # Строки отсортированы по (key, seq): из повторов берем последний
+    last = None
+    for row in rows:
+        if last is not None and row[0] != last[0]:
+            yield last[0], last[2]
+        last = row
+    if last is not None:
+        yield last[0], last[2]
+
+
+def sort_pairs(pairs, chunk_size=CHUNK_SIZE, directory=None):
+    # Возвращает количество уникальных ключей и итератор по парам.
+    # Пока данные помещаются в один блок, сортировка идет в памяти,
+    # иначе блоки сбрасываются во временные файлы и сливаются
+    sequence = count()
+    chunk = list()
+    chunks = list()
+    try:
+        for key, value in pairs:
+            chunk.append((key, next(sequence), value))
+            if len(chunk) >= chunk_size:
+                chunks.append(_dump_chunk(chunk, directory))
+                chunk = list()
+
+        if not chunks:
+            chunk.sort(key=lambda row: (row[0], row[1]))
+            rows = list(_unique(chunk))
+            return len(rows), iter(rows)
+
+        chunks.append(_dump_chunk(chunk, directory))
+        merged = heapq.merge(
+            *(_load_chunk(path) for path in chunks),
+            key=lambda row: (row[0], row[1]))
+        total = 0
+        with tempfile.NamedTemporaryFile(
+                dir=directory, suffix=".sorted", delete=False) as file:
+            for pair in _unique(merged):
+                pickle.dump(pair, file, pickle.HIGHEST_PROTOCOL)
+                total += 1
+        return total, _drain(file.name)
+    finally:
+        for path in chunks:
+            os.remove(path)
+
+
+def _drain(path):
+    try:
+        yield from _load_chunk(path)
+    finally:
+        os.remove(path)
@@ -0,0 +1,301 @@
+import json
+import socket
+
+from bulk import CHUNK_SIZE
+from codec import BYTES, STR, decode, encode
+from protocol import (
+    BACKUP, BLOOM, COMPACT, COUNT, DELETE, ERROR, EXIST, FIND, GET, KEYS,
+    LOAD, OK, PUT, PUT_TTL, RANK, REAP, SCAN, SELECT, SNAPSHOT, STATS, TTL,
+    VALUES, frame, pack, parse_address, unpack)
+
+
+# Сколько запросов конвейера уходит до чтения ответов. Без предела
+# клиент и сервер могут упереться в заполненные буферы сокета
+PIPELINE_DEPTH = 128
+
+
+class ServerError(Exception):
+    def __init__(self, text=""):
+        self.text = text
+
+
+class Client:
+    # Тонкий клиент `kvs serve` с тем же интерфейсом, что у Storage
+    def __init__(self, address):
+        self.address = address
+        self._socket = None
+        self._file = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def connect(self):
+        family, address = parse_address(self.address)
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(address)
+        except OSError as error:
+            self._socket.close()
+            text = f"Cannot connect to '{self.address}': {error.strerror}"
+            raise ServerError(text)
+        if family == socket.AF_INET:
+            self._socket.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile("rb")
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._file = None
+            self._socket = None
+
+    def _frames(self):
+        # Кадры одного ответа: потоковый ответ приходит частями
+        while True:
+            header = self._file.read(frame.size)
+            if len(header) < frame.size:
+                raise ServerError("Connection closed by server")
+            length, status = frame.unpack(header)
+            items = unpack(self._file.read(length))
+            if status == ERROR:
+                raise ServerError(items[0].decode("utf-8"))
+            yield items
+            if status == OK:
+                return
+
+    def _receive(self):
+        items = list()
+        for chunk in self._frames():
+            items.extend(chunk)
+        return items
+
+    def _call(self, code, items=()):
+        self._socket.sendall(pack(code, items))
+        return self._receive()
+
+    def _stream(self, code, items=(), width=1):
+        self._socket.sendall(pack(code, items))
+        frames = self._frames()
+        try:
+            for chunk in frames:
+                for i in range(0, len(chunk), width):
+                    row = tuple(decode(data) for data in chunk[i:i + width])
+                    yield row if width > 1 else row[0]
+        finally:
+            # Остаток ответа дочитывается, иначе он достанется
+            # следующему запросу
+            for _ in frames:
+                pass
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def __getitem__(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        return _values(self._call(GET, [encode(key) for key in keys]))
+
+    def get_view(self, key):
+        # Представление принятого кода значения, без разбора в объект
+        value = self._call(GET, [encode(key)])[0]
+        if not value:
+            return None
+        view = memoryview(value)
+        if view[0] not in (BYTES, STR):
+            raise TypeError(f"Value of key {key!r} is not bytes or str")
+        return view[1:]
+
+    def contains_many(self, keys):
+        found = self._call(EXIST, [encode(key) for key in keys])
+        return [bool(exist) for exist in found]
+
+    def __contains__(self, item):
+        return self.contains_many([item])[0]
+
+    def __setitem__(self, key, value):
+        self.update([(key, value)])
+
+    def set(self, key, value, ttl=None):
+        self.update([(key, value)], ttl)
+
+    def update(self, items, ttl=None):
+        if ttl is None:
+            self._call(PUT, _pairs(items))
+        else:
+            self._call(PUT_TTL, [str(ttl).encode()] + _pairs(items))
+
+    def set_file(self, key, file, ttl=None):
+        # Значение уходит одним кадром протокола, целиком в памяти
+        self.set(key, file.read(), ttl)
+
+    def ttl(self, key):
+        ttl = self._call(TTL, [encode(key)])[0]
+        return float(ttl) if ttl else None
+
+    def reap(self, limit=None):
+        limit = b"" if limit is None else str(limit).encode()
+        return int(self._call(REAP, [limit])[0])
+
+    def __delitem__(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        self._call(DELETE, [encode(key) for key in keys])
+
+    def bulk_load(self, items, chunk_size=CHUNK_SIZE):
+        # Пары уходят частями, сервер загружает их одним вызовом
+        if hasattr(items, "items"):
+            items = items.items()
+        size = str(chunk_size).encode()
+        chunk = list()
+        for key, value in items:
+            chunk.append(encode(key))
+            chunk.append(encode(value))
+            if len(chunk) >= 2 * chunk_size:
+                self._call(LOAD, [b"", size] + chunk)
+                chunk = list()
+        return int(self._call(LOAD, [b"\x01", size] + chunk)[0])
+
+    def __len__(self):
+        return self.count()
+
+    def count(self, lo=None, hi=None):
+        lo = b"" if lo is None else encode(lo)
+        hi = b"" if hi is None else encode(hi)
+        return int(self._call(COUNT, [lo, hi])[0])
+
+    def rank(self, key):
+        return int(self._call(RANK, [encode(key)])[0])
+
+    def select(self, i):
+        return decode(self._call(SELECT, [str(i).encode()])[0])
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        return self._stream(KEYS)
+
+    def values(self):
+        return self._stream(VALUES)
+
+    def items(self, reverse=False):
+        return self.range(reverse=reverse)
+
+    def range(self, lo=None, hi=None, reverse=False):
+        lo = b"" if lo is None else encode(lo)
+        hi = b"" if hi is None else encode(hi)
+        return self._stream(
+            SCAN, [lo, hi, b"\x01" if reverse else b""], width=2)
+
+    def keys_for(self, value):
+        return self._stream(FIND, [b"", encode(value), b"", b""])
+
+    def value_range(self, lo=None, hi=None, reverse=False):
+        lo = b"" if lo is None else encode(lo)
+        hi = b"" if hi is None else encode(hi)
+        return self._stream(
+            FIND, [b"\x01", lo, hi, b"\x01" if reverse else b""], width=2)
+
+    def compact(self):
+        return json.loads(self._call(COMPACT)[0])
+
+    def snapshot(self, dest):
+        # Путь разбирает сервер, поэтому он должен быть ему виден
+        return json.loads(self._call(SNAPSHOT, [dest.encode()])[0])
+
+    def backup(self, directory, incremental=False):
+        return json.loads(self._call(BACKUP, [
+            directory.encode(), b"\x01" if incremental else b""])[0])
+
+    def rebuild_bloom(self, fp_rate=None):
+        fp_rate = b"" if fp_rate is None else str(fp_rate).encode()
+        self._call(BLOOM, [b"\x01", fp_rate])
+
+    def bloom_stats(self):
+        stats = self._call(BLOOM, [b"", b""])[0]
+        return json.loads(stats) if stats else None
+
+    def stats(self):
+        report = self._call(STATS, [b""])[0]
+        return json.loads(report) if report else None
+
+    def tree_stats(self):
+        return json.loads(self._call(STATS, [b"\x01"])[0])
+
+
+class Pipeline:
+    # Запросы копятся и уходят пачками без ожидания ответов; execute
+    # возвращает результаты в порядке запросов
+    def __init__(self, client):
+        self._client = client
+        self._requests = list()
+
+    def get_many(self, keys):
+        self._requests.append(
+            (pack(GET, [encode(key) for key in keys]), _values))
+        return self
+
+    def get(self, key):
+        self._requests.append(
+            (pack(GET, [encode(key)]), lambda items: _values(items)[0]))
+        return self
+
+    def contains(self, key):
+        self._requests.append(
+            (pack(EXIST, [encode(key)]), lambda items: bool(items[0])))
+        return self
+
+    def update(self, items):
+        self._requests.append((pack(PUT, _pairs(items)), _none))
+        return self
+
+    def set(self, key, value):
+        return self.update([(key, value)])
+
+    def delete(self, key):
+        self._requests.append((pack(DELETE, [encode(key)]), _none))
+        return self
+
+    def execute(self):
+        results = list()
+        requests, self._requests = self._requests, list()
+        for start in range(0, len(requests), PIPELINE_DEPTH):
+            window = requests[start:start + PIPELINE_DEPTH]
+            self._client._socket.sendall(
+                b"".join(request for request, _ in window))
+            # Ответы окна дочитываются и после ошибки, чтобы соединение
+            # осталось согласованным; следующие окна уже не отправляются
+            failure = None
+            for _, parse in window:
+                try:
+                    results.append(parse(self._client._receive()))
+                except ServerError as error:
+                    failure = failure or error
+            if failure:
+                raise failure
+        return results
+
+
+def _pairs(items):
+    if hasattr(items, "items"):
+        items = items.items()
+    pairs = list()
+    for key, value in items:
+        pairs.append(encode(key))
+        pairs.append(encode(value))
+    return pairs
+
+
+def _values(items):
+    return [decode(value) if value else None for value in items]
+
+
+def _none(items):
+    return None
@@ -0,0 +1,31 @@
+INT = 0x01
+STR = 0x02
+BYTES = 0x03
+
+INT_BIAS = 1 << 63
+
+
+# Ключи и значения хранятся как байты с меткой типа. Кодирование
+# сохраняет порядок: побайтовое сравнение кодов совпадает со сравнением
+# значений одного типа, а разные типы упорядочены как int < str < bytes
+def encode(item):
+    if isinstance(item, int):
+        if not -INT_BIAS <= item < INT_BIAS:
+            raise ValueError(f"Integer {item} out of 64-bit range")
+        return bytes([INT]) + (item + INT_BIAS).to_bytes(8, "big")
+    if isinstance(item, str):
+        return bytes([STR]) + item.encode("utf-8")
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return bytes([BYTES]) + bytes(item)
+    raise TypeError(f"Unsupported type {type(item).__name__}")
+
+
+def decode(data):
+    tag = data[0]
+    if tag == INT:
+        return int.from_bytes(data[1:9], "big") - INT_BIAS
+    if tag == STR:
+        return bytes(data[1:]).decode("utf-8")
+    if tag == BYTES:
+        return bytes(data[1:])
+    raise ValueError(f"Unknown type tag {tag}")
@@ -0,0 +1,89 @@
+import struct
+import time
+
+from index import SideTree
+
+
+# Момент истечения - миллисекунды от эпохи, big-endian, поэтому порядок
+# байтов совпадает с порядком времени
+moment = struct.Struct(">Q")
+
+# Записи дерева: KEY + ключ -> момент, TIME + момент + ключ -> b""
+KEY = b"k"
+TIME = b"t"
+
+
+def now():
+    return int(time.time() * 1000)
+
+
+def deadline(ttl):
+    # Код момента истечения через ttl секунд
+    return moment.pack(now() + max(int(ttl * 1000), 0))
+
+
+class ExpiryIndex(SideTree):
+    # Сроки жизни ключей в файле <path>.ttl. Ключи упорядочены по моменту
+    # истечения, так что истекшие читаются одним диапазоном от начала
+    suffix = ".ttl"
+
+    def __init__(self, path, engine, cache_size=None):
+        super().__init__(path, engine, cache_size)
+        # Нижняя граница ближайшего истечения: пока текущее время
+        # меньше, ни один ключ не истек и проверки не нужны
+        self.earliest = None
+
+    def open(self):
+        super().open()
+        self._find_earliest()
+
+    def _find_earliest(self):
+        self.earliest = None
+        for data, _ in self.tree.items(TIME, TIME + b"\xff"):
+            self.earliest = moment.unpack_from(data, len(TIME))[0]
+            break
+
+    def expires_at(self, key):
+        data = self.tree.get(KEY + key)
+        if data is not None:
+            return moment.unpack(data)[0]
+
+    def set(self, key, when):
+        self.clear(key)
+        self.tree.insert(KEY + key, when)
+        self.tree.insert(TIME + when + key, b"")
+        when = moment.unpack(when)[0]
+        if self.earliest is None or when < self.earliest:
+            self.earliest = when
+
+    def clear(self, key):
+        data = self.tree.get(KEY + key)
+        if data is not None:
+            self.tree.delete(KEY + key)
+            self.tree.delete(TIME + data + key)
+
+    def maybe_expired(self, at):
+        return self.earliest is not None and self.earliest <= at
+
+    def is_expired(self, key, at):
+        if not self.maybe_expired(at):
+            return False
+        when = self.expires_at(key)
+        return when is not None and when <= at
+
+    def expired(self, at, limit):
+        # Не больше limit ключей, истекших к моменту at, по порядку сроков
+        keys = list()
+        if self.maybe_expired(at):
+            start = len(TIME) + moment.size
+            for data, _ in self.tree.items(
+                    TIME, TIME + moment.pack(at + 1)):
+                keys.append(data[start:])
+                if len(keys) == limit:
+                    break
+        return keys
+
+    def refresh(self, at):
+        # После удаления истекших граница пересчитывается по дереву
+        if self.maybe_expired(at):
+            self._find_earliest()
@@ -0,0 +1,56 @@
+import os
+
+
+class Heap:
+    # Файл с длинными ключами и значениями: данные только дописываются
+    # в конец, запись вершины хранит смещение и длину
+    def __init__(self, path):
+        self.path = path
+        self.stats = None
+        self._file = None
+        self._size = 0
+
+    @staticmethod
+    def path_for(storage_path, generation=0):
+        # Номер поколения меняется при сжатии хранилища
+        if generation:
+            return f"{storage_path}.heap.{generation}"
+        return storage_path + ".heap"
+
+    def open(self):
+        self._file = open(self.path, "rb+")
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self.stats is not None:
+            self.stats.file_opens += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def append(self, data):
+        offset = self._size
+        self._file.seek(offset, 0)
+        self._file.write(data)
+        self._size += len(data)
+        if self.stats is not None:
+            self.stats.seeks += 1
+            self.stats.bytes_written += len(data)
+        return offset
+
+    def read(self, offset, length):
+        if self.stats is not None:
+            self.stats.seeks += 1
+            self.stats.bytes_read += length
+        self._file.seek(offset, 0)
+        return self._file.read(length)
+
+    def flush(self):
+        self._file.flush()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def __len__(self):
+        return self._size
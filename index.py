@@ -0,0 +1,167 @@
+import glob
+import hashlib
+import os
+
+from heap import Heap
+
+
+# Код значения в ключе индекса: нулевой байт экранируется, в конце
+# стоит терминатор, который меньше любого продолжения. Так коды разных
+# значений не бывают префиксами друг друга, а порядок кодов совпадает
+# с порядком значений
+ESCAPE = b"\x00\xff"
+TERMINATOR = b"\x00\x01"
+# Длинное значение: в ключе индекса только его начало, за ним эта
+# метка и хэш всего значения, так что ключ индекса ограничен. Метка
+# больше терминатора, поэтому длинные значения идут после своего
+# начала, но между собой упорядочены по хэшу, а не по значению
+INDEX_PREFIX = 256
+TRUNCATED = b"\x00\xfe"
+DIGEST_SIZE = 16
+
+
+def _escape(value):
+    return bytes(value).replace(b"\x00", ESCAPE)
+
+
+def is_truncated(value):
+    return len(value) > INDEX_PREFIX
+
+
+def _head(value):
+    # Начало ключа индекса для значения; value - байты или memoryview
+    if not is_truncated(value):
+        return _escape(value) + TERMINATOR
+    digest = hashlib.blake2b(value, digest_size=DIGEST_SIZE).digest()
+    return _escape(value[:INDEX_PREFIX]) + TRUNCATED + digest
+
+
+def _bound(value, upper):
+    # Граница диапазона по значению. Для длинного значения граница
+    # захватывает все значения с тем же началом: точно их сравнивает
+    # хранилище
+    if value is None:
+        return None
+    if not is_truncated(value):
+        return _escape(value) + TERMINATOR
+    return _escape(value[:INDEX_PREFIX]) + (ESCAPE if upper else TRUNCATED)
+
+
+def entry(key, value):
+    # Ключ индекса для пары хранилища
+    return _head(value) + key
+
+
+def split_key(data):
+    # Ключ индекса -> (код значения, код ключа хранилища, начало). У
+    # длинного значения кода нет (None), а начало - его экранированный
+    # префикс; у остальных начало None
+    end = data.index(b"\x00")
+    while data[end + 1] == ESCAPE[1]:
+        end = data.index(b"\x00", end + len(ESCAPE))
+    if data[end:end + len(TERMINATOR)] == TERMINATOR:
+        value = data[:end].replace(ESCAPE, b"\x00")
+        return value, data[end + len(TERMINATOR):], None
+    return None, data[end + len(TRUNCATED) + DIGEST_SIZE:], data[:end]
+
+
+class SideTree:
+    # Дополнительное дерево того же движка в файле рядом с хранилищем.
+    # Его записи попадают в образы журнала вместе с основным файлом
+    suffix = ""
+
+    def __init__(self, path, engine, cache_size=None):
+        self.path = path
+        self._stream_class, self._tree_class = engine
+        self._cache_size = cache_size
+        self.stream = None
+        self.tree = None
+
+    @classmethod
+    def path_for(cls, storage_path):
+        return storage_path + cls.suffix
+
+    @staticmethod
+    def create(path, engine):
+        stream_class, _ = engine
+        stream_class.create(path)
+
+    def open(self):
+        self.stream = self._stream_class(self.path, self._cache_size)
+        self.stream.open()
+        self.tree = self._tree_class(self.stream)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+            self.tree = None
+
+
+class ValueIndex(SideTree):
+    # Индекс значений в файле <path>.index. Ключ дерева - код значения
+    # и код ключа хранилища, значение пустое, поэтому ключи с данным
+    # значением лежат подряд и читаются одним диапазоном
+    suffix = ".index"
+
+    def add(self, key, value):
+        self.tree.insert(entry(key, value), b"")
+
+    def remove(self, key, value):
+        self.tree.delete(entry(key, value))
+
+    def keys_for(self, value, after=None):
+        # Для длинного значения - ключи всех значений с тем же хэшем.
+        # after - код ключа, за которым продолжить
+        head = _head(value)
+        start = head if after is None else head + after
+        for data, _ in self.tree.items(start):
+            if not data.startswith(head):
+                break
+            if after is None or data != start:
+                yield data[len(head):]
+
+    def range(self, lo=None, hi=None, reverse=False, after=None):
+        # Тройки split_key с lo <= значение < hi; длинные значения у
+        # границ могут выходить за них. after - пара кодов (значение,
+        # ключ), за которой продолжить; группа длинных значений с тем же
+        # началом читается снова целиком, отбирает хранилище
+        start, end = _bound(lo, False), _bound(hi, True)
+        point = None
+        if after is not None:
+            value, key = after
+            if is_truncated(value):
+                point = _bound(value, reverse)
+            else:
+                point = entry(key, value)
+            if reverse:
+                end = point
+            else:
+                start = point
+        for data, _ in self.tree.items(start, end, reverse):
+            if data != point:
+                yield split_key(data)
+
+    def rebuild(self, entries, count):
+        # Новый файл из отсортированных пар (ключ индекса, b""). Куча
+        # получает следующее поколение и старая цела до подмены файла
+        temp = self.path + ".rebuild"
+        for path in glob.glob(glob.escape(temp) + "*"):
+            os.remove(path)
+        old_heap = self.stream.heap.path if self.stream else None
+        generation = self.stream.heap_gen + 1 if self.stream else 0
+        self._stream_class.create(temp, heap_gen=generation)
+        target = self._stream_class(temp)
+        target.open()
+        self._tree_class(target).build(entries, count)
+        target.sync()
+        target.close()
+
+        self.close()
+        os.replace(Heap.path_for(temp, generation),
+                   Heap.path_for(self.path, generation))
+        os.replace(temp, self.path)
+        if old_heap is not None and \
+                old_heap != Heap.path_for(self.path, generation):
+            os.remove(old_heap)
+        self.open()
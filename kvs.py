@@ -1,95 +1,399 @@
-import sys
-import os
-
-
-STORAGE_INIT_ERROR = -3
-STORAGE_NOT_FOUND_ERROR = -4
-STORAGE_PATH_ERROR = -2
-MODULE_IMPORT_ERROR = -1
-
-
-try:
-    from args_parser import parse_args
-    from storage import Storage, StorageInitError
-except (ModuleNotFoundError, ImportError) as err:
-    sys.stdout.write(str(err))
-    sys.exit(MODULE_IMPORT_ERROR)
-
-
-def check_path(path):
-    if not os.path.exists(path):
-        text = f"Storage '{path}' not found"
-        sys.stdout.write(text)
-        sys.exit(STORAGE_PATH_ERROR)
-
-
-def main():
-    args = parse_args()
-
-    storage = Storage(args.storage)
-    if args.command == "init":
-        try:
-            storage.init()
-            return
-        except StorageInitError as error:
-            sys.stdout.write(error.text)
-            sys.exit(STORAGE_INIT_ERROR)
-
-    check_path(args.storage)
-    with storage:
-
-        if args.command == "add":
-            if len(args.items) % 2 != 0:
-                # Выкидывать ошибку
-                return
-
-            pair = list()
-            for item in args.items:
-                pair.append(item)
-                if len(pair) == 2:
-                    value = pair.pop()
-                    key = pair.pop()
-                    try:
-                        key = int(key)
-                    except ValueError:
-                        pass
-                    try:
-                        value = int(value)
-                    except ValueError:
-                        pass
-                    storage[key] = value
-
-        elif args.command == "get":
-            for key in args.keys:
-                try:
-                    key = int(key)
-                except ValueError:
-                    pass
-                value = storage[key]
-                print(value, file=sys.stdout)
-
-        elif args.command == "del":
-            for key in args.keys:
-                del storage[key]
-
-        elif args.command == "exist":
-            for key in args.keys:
-                try:
-                    key = int(key)
-                except ValueError:
-                    pass
-                exist = key in storage
-                print(exist)
-
-        elif args.command == "keys":
-            for key in storage:
-                print(key, end=" ")
-
-        elif args.command == "values":
-            for key in storage:
-                value = storage[key]
-                print(value, end=" ")
-
-
-if __name__ == "__main__":
-    main()
+import sys
+import os
+import time
+
+
+STORAGE_INIT_ERROR = -3
+STORAGE_NOT_FOUND_ERROR = -4
+STORAGE_PATH_ERROR = -2
+MODULE_IMPORT_ERROR = -1
+STORAGE_FORMAT_ERROR = -5
+SERVER_ERROR = -6
+BATCH_ERROR = -7
+
+# Команды, которым хватает разделяемой блокировки хранилища. Локальный
+# snapshot держит ее до конца копии, и писатели ждут; без остановки
+# записи копирует только сервер
+READ_COMMANDS = ("get", "exist", "keys", "values", "scan", "stats",
+                 "count", "rank", "select", "find-value", "ttl",
+                 "snapshot")
+
+
+try:
+    from args_parser import parse_args
+    from backup import BackupError, restore
+    from oplog import OpLogError
+    from replica import Follower
+    from batch import Batch, BatchError
+    from bulk import read_pairs
+    from client import Client, ServerError
+    from protocol import path_for
+    from server import serve
+    from sharded import ShardedStorage
+    from storage import Storage, StorageError, StorageInitError
+except (ModuleNotFoundError, ImportError) as err:
+    sys.stdout.write(str(err))
+    sys.exit(MODULE_IMPORT_ERROR)
+
+
+def check_path(path):
+    if not os.path.exists(path):
+        text = f"Storage '{path}' not found"
+        sys.stdout.write(text)
+        sys.exit(STORAGE_PATH_ERROR)
+
+
+def main():
+    args = parse_args()
+    address = args.socket or path_for(args.storage)
+
+    if args.connect:
+        if args.command in ("init", "serve", "restore", "follow",
+                            "oplog"):
+            sys.stdout.write(f"Command '{args.command}' runs locally only")
+            sys.exit(SERVER_ERROR)
+        try:
+            with Client(address) as client:
+                run(client, args)
+        except ServerError as error:
+            sys.stdout.write(error.text)
+            sys.exit(SERVER_ERROR)
+        return
+
+    readonly = args.command in READ_COMMANDS or \
+        args.command == "bloom" and not args.rebuild
+    stats = args.command == "stats" or \
+        args.command == "serve" and args.stats
+    mode = "memory" if args.command == "serve" and args.memory else "disk"
+    if args.command == "init" and args.shards is not None or \
+            ShardedStorage.is_sharded(args.storage):
+        storage = ShardedStorage(
+            args.storage, sync=args.fsync, readonly=readonly, stats=stats,
+            mode=mode)
+    else:
+        storage = Storage(
+            args.storage, sync=args.fsync, readonly=readonly, stats=stats,
+            mode=mode)
+    if args.command == "init":
+        try:
+            if args.shards is not None:
+                storage.init(args.engine, args.bloom, args.shards,
+                             args.index_values, args.oplog)
+            else:
+                storage.init(args.engine, args.bloom, args.index_values,
+                             args.oplog)
+            return
+        except StorageInitError as error:
+            sys.stdout.write(error.text)
+            sys.exit(STORAGE_INIT_ERROR)
+
+    if args.command == "restore":
+        try:
+            if ShardedStorage.is_sharded_backup(args.directory):
+                generation = ShardedStorage(args.storage).restore(
+                    args.directory, args.generation)
+            else:
+                generation = restore(
+                    args.directory, args.storage, args.generation)
+        except BackupError as error:
+            sys.stdout.write(error.text)
+            sys.exit(STORAGE_INIT_ERROR)
+        print(f"restored generation {generation}")
+        return
+
+    check_path(args.storage)
+    try:
+        storage.engine
+    except StorageError as error:
+        sys.stdout.write(error.text)
+        sys.exit(STORAGE_FORMAT_ERROR)
+
+    if args.command in ("oplog", "follow") and \
+            ShardedStorage.is_sharded(args.storage):
+        # У шардов свои журналы операций, общего номера у них нет
+        sys.stdout.write(
+            f"Command '{args.command}' does not support sharded storages")
+        sys.exit(STORAGE_FORMAT_ERROR)
+
+    if args.command == "follow":
+        follower = Follower(args.storage, args.follower, args.fsync)
+        try:
+            if args.status:
+                print_lag(follower.lag())
+            else:
+                follower.run(args.interval, args.once, print_lag)
+        except (OpLogError, StorageError) as error:
+            sys.stdout.write(error.text)
+            sys.exit(STORAGE_FORMAT_ERROR)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.command == "serve":
+        try:
+            serve(storage, address,
+                  lambda: print(f"Serving '{args.storage}' on {address}",
+                                flush=True), args.fsync)
+        except (StorageError, OSError) as error:
+            sys.stdout.write(getattr(error, "text", None) or str(error))
+            sys.exit(SERVER_ERROR)
+        return
+
+    with storage:
+        run(storage, args)
+
+
+def print_lag(lag):
+    print(f"seq: {lag['seq']}, pending: {lag['pending']} ops, "
+          f"lag: {lag['seconds']:.3f}s", flush=True)
+
+
+def run(storage, args):
+    # Хранилище или клиент сервера: интерфейс у них общий
+    if args.command == "add":
+        if len(args.items) % 2 != 0:
+            # Выкидывать ошибку
+            return
+
+        pairs = list()
+        pair = list()
+        for item in args.items:
+            pair.append(item)
+            if len(pair) == 2:
+                value = pair.pop()
+                key = pair.pop()
+                try:
+                    key = int(key)
+                except ValueError:
+                    pass
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass
+                pairs.append((key, value))
+        storage.update(pairs, args.ttl)
+
+    elif args.command == "get":
+        keys = list()
+        for key in args.keys:
+            try:
+                key = int(key)
+            except ValueError:
+                pass
+            keys.append(key)
+        if not args.raw:
+            for value in storage.get_many(keys):
+                print(value, file=sys.stdout)
+            return
+        # Байты значений сразу в буфер stdout, без разбора в объекты и
+        # без копий: длинные значения читаются из отображения файла
+        output = sys.stdout.buffer
+        for key in keys:
+            try:
+                view = storage.get_view(key)
+            except TypeError as error:
+                sys.stdout.write(str(error))
+                return
+            if view is not None:
+                output.write(view)
+        output.flush()
+
+    elif args.command == "add-file":
+        key = args.key
+        try:
+            key = int(key)
+        except ValueError:
+            pass
+        if args.file == "-":
+            storage.set_file(key, sys.stdin.buffer, args.ttl)
+        else:
+            with open(args.file, "rb") as file:
+                storage.set_file(key, file, args.ttl)
+
+    elif args.command == "del":
+        keys = list()
+        for key in args.keys:
+            try:
+                key = int(key)
+            except ValueError:
+                pass
+            keys.append(key)
+        storage.delete_many(keys)
+
+    elif args.command == "exist":
+        keys = list()
+        for key in args.keys:
+            try:
+                key = int(key)
+            except ValueError:
+                pass
+            keys.append(key)
+        for exist in storage.contains_many(keys):
+            print(exist)
+
+    elif args.command == "batch":
+        try:
+            Batch(storage, sys.stdout, args.format).run(sys.stdin)
+        except BatchError as error:
+            sys.stdout.write(error.text)
+            sys.exit(BATCH_ERROR)
+
+    elif args.command == "import":
+        started = time.perf_counter()
+        pairs = read_pairs(args.file, args.format)
+        total = storage.bulk_load(pairs, args.chunk_size)
+        elapsed = time.perf_counter() - started
+        rate = total / elapsed if elapsed else 0
+        print(f"{total} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+
+    elif args.command == "compact":
+        report = storage.compact()
+        reclaimed = report["size_before"] - report["size_after"]
+        print(f"size: {report['size_before']} -> "
+              f"{report['size_after']} bytes ({reclaimed} reclaimed)")
+        print(f"lookup: {report['lookup_before'] * 1e6:.1f} -> "
+              f"{report['lookup_after'] * 1e6:.1f} us")
+
+    elif args.command == "bloom":
+        if args.rebuild:
+            try:
+                storage.rebuild_bloom(args.fp_rate)
+            except ValueError as error:
+                sys.stdout.write(str(error))
+                return
+        stats = storage.bloom_stats()
+        if stats is None:
+            print("Bloom filter is not enabled")
+            return
+        print(f"slots: {stats['slots']}, hashes: {stats['hashes']}, "
+              f"fp rate: {stats['fp_rate']}")
+        print(f"checks: {stats['checks']}, "
+              f"negatives: {stats['negatives']}, "
+              f"false positives: {stats['false_positives']}")
+
+    elif args.command == "stats":
+        for name, value in storage.tree_stats().items():
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            print(f"{name}: {value}")
+        report = storage.stats()
+        if report is None:
+            # Сервер запущен без --stats
+            return
+        for name, value in report["counters"].items():
+            print(f"{name}: {value}")
+        for operation, latency in report["latency"].items():
+            print(f"{operation}: {latency['count']} ops, "
+                  f"p50 <= {latency['p50_us']} us, "
+                  f"p99 <= {latency['p99_us']} us")
+
+    elif args.command == "count":
+        lo, hi = args.lo, args.hi
+        try:
+            lo = int(lo)
+        except (TypeError, ValueError):
+            pass
+        try:
+            hi = int(hi)
+        except (TypeError, ValueError):
+            pass
+        print(storage.count(lo, hi))
+
+    elif args.command == "rank":
+        key = args.key
+        try:
+            key = int(key)
+        except ValueError:
+            pass
+        print(storage.rank(key))
+
+    elif args.command == "select":
+        try:
+            print(storage.select(args.index))
+        except IndexError as error:
+            sys.stdout.write(str(error))
+
+    elif args.command == "find-value":
+        lo, hi, value = args.lo, args.hi, args.value
+        try:
+            lo = int(lo)
+        except (TypeError, ValueError):
+            pass
+        try:
+            hi = int(hi)
+        except (TypeError, ValueError):
+            pass
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            pass
+        try:
+            if value is not None:
+                for key in storage.keys_for(value):
+                    print(key)
+            else:
+                rows = storage.value_range(lo, hi, args.reverse)
+                for value, key in rows:
+                    print(value, key)
+        except StorageError as error:
+            sys.stdout.write(error.text)
+
+    elif args.command == "expire":
+        print(storage.reap(args.limit))
+
+    elif args.command == "ttl":
+        key = args.key
+        try:
+            key = int(key)
+        except ValueError:
+            pass
+        print(storage.ttl(key))
+
+    elif args.command in ("snapshot", "backup"):
+        try:
+            if args.command == "snapshot":
+                report = storage.snapshot(os.path.abspath(args.dest))
+            else:
+                report = storage.backup(
+                    os.path.abspath(args.directory), args.incremental)
+        except (BackupError, StorageError) as error:
+            sys.stdout.write(error.text)
+            return
+        if args.command == "backup":
+            print(f"generation {report['generation']} "
+                  f"({report['kind']}): {report['bytes']} bytes")
+        else:
+            print(f"{report['bytes']} bytes")
+
+    elif args.command == "oplog":
+        try:
+            if args.enable:
+                storage.enable_oplog()
+            print(storage.oplog_seq())
+        except StorageError as error:
+            sys.stdout.write(error.text)
+
+    elif args.command == "keys":
+        for key in storage:
+            print(key, end=" ")
+
+    elif args.command == "values":
+        for value in storage.values():
+            print(value, end=" ")
+
+    elif args.command == "scan":
+        lo, hi = args.lo, args.hi
+        try:
+            lo = int(lo)
+        except ValueError:
+            pass
+        try:
+            hi = int(hi)
+        except ValueError:
+            pass
+        for key, value in storage.range(lo, hi, reverse=args.reverse):
+            print(key, value)
+
+
+if __name__ == "__main__":
+    main()
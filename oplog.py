@@ -0,0 +1,158 @@
+import os
+import struct
+import time
+import zlib
+
+from wal import pack_ops, unpack_ops
+
+
+class OpLogError(Exception):
+    def __init__(self, text=""):
+        self.text = text
+
+
+class OpLog:
+    # Журнал операций <path>.oplog для последователей: записи только
+    # дописываются, у каждой операции свой номер. В отличие от журнала
+    # восстановления он не очищается на контрольной точке. Заголовок
+    # хранит номер и смещение, до которых журнал согласован с файлами
+    # данных, и пишется образом контрольной точки вместе с ними, поэтому
+    # после сбоя хвост журнала пересобирается из пакетов восстановления
+    magic = b"KVSO"
+    # Метка журнала, начат ли он на пустом хранилище, номер последней
+    # операции в файлах данных, смещение записи после нее
+    header = struct.Struct(">4s16s?QQ")
+    # Длина тела записи и его crc
+    record = struct.Struct(">II")
+    # Начало тела: номер первой операции, число операций, время в мс
+    meta = struct.Struct(">QIQ")
+
+    def __init__(self, path):
+        self.path = path
+        self.token = None
+        self.complete = False
+        # Номер последней записанной операции и конец журнала
+        self.seq = 0
+        self.end = 0
+        self.checkpoint_seq = 0
+        self.checkpoint_end = 0
+        self._file = None
+
+    @staticmethod
+    def path_for(storage_path):
+        return storage_path + ".oplog"
+
+    @classmethod
+    def create(cls, path, complete):
+        with open(path, "wb") as oplog:
+            oplog.write(cls.header.pack(
+                cls.magic, os.urandom(16), complete, 0, cls.header.size))
+            oplog.flush()
+            os.fsync(oplog.fileno())
+
+    def open(self, readonly=False):
+        self._file = open(self.path, "rb" if readonly else "rb+")
+        magic, token, self.complete, self.checkpoint_seq, \
+            self.checkpoint_end = self.header.unpack(
+                self._file.read(self.header.size))
+        if magic != self.magic:
+            self.close()
+            text = f"File '{self.path}' is not an operation log"
+            raise OpLogError(text)
+        self.token = token.hex()
+        self.seq, self.end = self.checkpoint_seq, self.checkpoint_end
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def recover(self, batches):
+        # Хвост после контрольной точки заменяется пакетами, которые
+        # восстановление применило к дереву: журнал совпадает с данными,
+        # даже если процесс упал между записью в два журнала
+        self._file.truncate(self.checkpoint_end)
+        for ops in batches:
+            self.append(ops)
+
+    def append(self, ops):
+        body = self.meta.pack(self.seq + 1, len(ops),
+                              int(time.time() * 1000)) + pack_ops(ops)
+        self._file.seek(self.end, 0)
+        self._file.write(self.record.pack(len(body), zlib.crc32(body)))
+        self._file.write(body)
+        self._file.flush()
+        self.seq += len(ops)
+        self.end += self.record.size + len(body)
+
+    def image(self):
+        # Заголовок с текущей позицией для образа контрольной точки
+        return self.header.pack(
+            self.magic, bytes.fromhex(self.token), self.complete,
+            self.seq, self.end)
+
+    def dirty(self):
+        return self.seq != self.checkpoint_seq
+
+    def write_header(self):
+        self._file.seek(0, 0)
+        self._file.write(self.image())
+        self.sync()
+        self.checkpoint_seq, self.checkpoint_end = self.seq, self.end
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _bodies(self, offset):
+        # Целые записи начиная со смещения: (тело, смещение следующей).
+        # Чтение идет без блокировок и останавливается на недописанной
+        # записи
+        while True:
+            self._file.seek(offset, 0)
+            head = self._file.read(self.record.size)
+            if len(head) < self.record.size:
+                return
+            length, crc = self.record.unpack(head)
+            body = self._file.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                return
+            offset += self.record.size + length
+            yield body, offset
+
+    def read(self, after, offset=None):
+        # Записи с операциями после номера after: (номер первой
+        # операции, операции, смещение следующей записи). offset -
+        # подсказка, где лежит нужная запись
+        start = self.header.size if offset is None else offset
+        for body, position in self._bodies(start):
+            seq, count, _ = self.meta.unpack_from(body)
+            if seq + count - 1 <= after:
+                continue
+            if seq != after + 1:
+                if offset is not None:
+                    # Подсказка устарела: поиск с начала журнала
+                    yield from self.read(after)
+                    return
+                text = f"Operation {after + 1} is not in '{self.path}'"
+                raise OpLogError(text)
+            yield seq, unpack_ops(body[self.meta.size:]), position
+            after = seq + count - 1
+
+    def pending(self, offset):
+        # Сколько операций записано после смещения и время самой старой
+        # из них в мс (None, если их нет). Читаются только заголовки
+        count, oldest = 0, None
+        size = os.fstat(self._file.fileno()).st_size
+        while offset + self.record.size + self.meta.size <= size:
+            self._file.seek(offset, 0)
+            length, _ = self.record.unpack(self._file.read(self.record.size))
+            if offset + self.record.size + length > size:
+                break
+            _, ops, moment = self.meta.unpack(
+                self._file.read(self.meta.size))
+            count += ops
+            if oldest is None:
+                oldest = moment
+            offset += self.record.size + length
+        return count, oldest
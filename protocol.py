@@ -0,0 +1,76 @@
+import re
+import socket
+import struct
+
+
+# Команды
+GET = 1
+PUT = 2
+DELETE = 3
+EXIST = 4
+KEYS = 5
+VALUES = 6
+SCAN = 7
+LOAD = 8
+COMPACT = 9
+BLOOM = 10
+STATS = 11
+COUNT = 12
+RANK = 13
+SELECT = 14
+FIND = 15
+PUT_TTL = 16
+TTL = 17
+REAP = 18
+SNAPSHOT = 19
+BACKUP = 20
+
+# Статусы ответа
+OK = 0
+ERROR = 1
+# Часть потокового ответа, за ней следуют еще кадры
+MORE = 2
+
+# Сколько элементов уходит в одном кадре потокового ответа
+STREAM_CHUNK = 1000
+
+# Кадр: длина полезной нагрузки, команда или статус, затем элементы,
+# каждый со своей длиной. Пустой элемент означает отсутствие значения
+frame = struct.Struct(">IB")
+item = struct.Struct(">I")
+
+TCP_ADDRESS = re.compile(r"^([\w.-]*):(\d+)$")
+
+
+def path_for(storage_path):
+    # Сокет сервера по умолчанию лежит рядом с хранилищем
+    return storage_path + ".sock"
+
+
+def parse_address(address):
+    # host:port - локальный TCP, все остальное - путь к Unix сокету
+    match = TCP_ADDRESS.match(address)
+    if match:
+        return socket.AF_INET, (match.group(1) or "127.0.0.1",
+                                int(match.group(2)))
+    return socket.AF_UNIX, address
+
+
+def pack(code, items=()):
+    parts = list()
+    for data in items:
+        parts.append(item.pack(len(data)))
+        parts.append(data)
+    payload = b"".join(parts)
+    return frame.pack(len(payload), code) + payload
+
+
+def unpack(payload):
+    items = list()
+    offset = 0
+    while offset < len(payload):
+        length = item.unpack_from(payload, offset)[0]
+        offset += item.size
+        items.append(payload[offset:offset + length])
+        offset += length
+    return items
@@ -1,475 +1,1126 @@
-from itertools import chain
-from enum import Enum
-import struct
-
-
-class NodeColor(Enum):
-    Black = 0,
-    Red = 1
-
-    @staticmethod
-    def to_byte(color):
-        color = color == NodeColor.Red
-        return struct.pack(">?", color)
-
-    @staticmethod
-    def to_bool(color):
-        return color == NodeColor.Red
-
-    @staticmethod
-    def from_byte(color_byte):
-        color = struct.unpack(">?", color_byte)[0]
-        return NodeColor.Red if color else NodeColor.Black
-
-
-class NodeStream:
-    storage = r"\\"
-    tree_size = 128
-    size_row = 25
-    len_size = 4
-    root_pointer_size = 4
-
-    @classmethod
-    def get_node(cls, index):
-        if index == -1:
-            return None
-        with open(cls.storage, "rb") as storage:
-            storage.seek(
-                index * cls.size_row + NodeStream.len_size +
-                NodeStream.root_pointer_size, 0)
-            data = storage.read(NodeStream.size_row)
-            if len(data) != NodeStream.size_row:
-                return None
-            index = struct.unpack(">i", data[0:4])[0]
-            left = struct.unpack(">i", data[4:8])[0]
-            right = struct.unpack(">i", data[8:12])[0]
-            parent = struct.unpack(">i", data[12:16])[0]
-            color = NodeColor.from_byte(data[16:17])
-            key = struct.unpack(">i", data[17:21])[0]
-            value = struct.unpack(">i", data[21:25])[0]
-            return Node(index, key, value,
-                        left=left, right=right,
-                        parent=parent, color=color)
-
-    @classmethod
-    def nodes_count(cls):
-        with open(cls.storage, "rb") as storage:
-            data = storage.read(4)
-            return struct.unpack(">i", data)[0]
-
-    @classmethod
-    def nodes_count_up(cls, last):
-        with open(cls.storage, "rb+") as storage:
-            storage.write(struct.pack(">i", last + 1))
-
-    @classmethod
-    def get_root(cls):
-        with open(cls.storage, "rb") as storage:
-            storage.seek(NodeStream.len_size)
-            data = storage.read(4)
-            index = struct.unpack(">i", data)[0]
-            return cls.get_node(index)
-
-    @classmethod
-    def set_root(cls, node):
-        with open(cls.storage, "rb+") as storage:
-            storage.seek(NodeStream.len_size)
-            storage.write(struct.pack(">i", node.index))
-
-    @classmethod
-    def set_node(cls, node):
-        if not isinstance(node, Node):
-            raise TypeError("Expected node")
-        if node.index == -1:
-            return None
-        with open(cls.storage, "rb+") as storage:
-            storage.seek(
-                node.index * cls.size_row + NodeStream.len_size +
-                NodeStream.root_pointer_size, 0)
-            storage.writelines([
-                struct.pack(">i", node.index),
-                struct.pack(
-                    ">i", -1 if isinstance(node.left, ImagineNode)
-                    else node.left.index),
-                struct.pack(
-                    ">i", -1 if isinstance(node.right, ImagineNode)
-                    else node.right.index),
-                struct.pack(
-                    ">i", -1 if isinstance(node.parent, ImagineNode)
-                    else node.parent.index),
-                NodeColor.to_byte(node.color),
-                struct.pack(">i", node.key),
-                struct.pack(">i", node.value)
-            ])
-
-    @classmethod
-    def set_attribute(cls, offset, mask, index, value):
-        if index == -1:
-            return None
-        with open(cls.storage, "rb+") as storage:
-            storage.seek(
-                index * cls.size_row + NodeStream.len_size +
-                NodeStream.root_pointer_size + offset, 0)
-            storage.write(struct.pack(mask, value))
-
-
-class Node:
-    def __init__(self, index, key, value, left=-1,
-                 right=-1, parent=-1, color=NodeColor.Red):
-        self.index = index
-        self.key = key
-        self.value = value
-        self._color = color
-        self._parent = parent
-        self._left = left
-        self._right = right
-
-    @property
-    def parent(self):
-        node = NodeStream.get_node(self._parent)
-        return node if node else ImagineNode(self.index)
-
-    @parent.setter
-    def parent(self, node):
-        self._parent = node.index
-        NodeStream.set_attribute(12, ">i", self.index, node.index)
-
-    @property
-    def left(self):
-        node = NodeStream.get_node(self._left)
-        return node if node else ImagineNode(self.index)
-
-    @left.setter
-    def left(self, node):
-        self._left = node.index
-        NodeStream.set_attribute(4, ">i", self.index, node.index)
-
-    @property
-    def right(self):
-        node = NodeStream.get_node(self._right)
-        return node if node else ImagineNode(self.index)
-
-    @right.setter
-    def right(self, node):
-        self._right = node.index
-        NodeStream.set_attribute(8, ">i", self.index, node.index)
-
-    @property
-    def color(self):
-        return self._color
-
-    @color.setter
-    def color(self, color):
-        if not isinstance(color, NodeColor):
-            raise TypeError("Expected color")
-        self._color = color
-        NodeStream.set_attribute(
-            16, ">?", self.index, NodeColor.to_bool(color))
-
-    def __eq__(self, other):
-        if not isinstance(other, Node):
-            raise TypeError("Expected node")
-        return self.index == other.index
-
-    def __bool__(self):
-        return self.index != -1
-
-
-class ImagineNode(Node):
-    def __init__(self, parent):
-        super().__init__(
-            -1, -1, -1, parent=parent,
-            color=NodeColor.Black)
-
-
-class Tree:
-    def __init__(self, storage):
-        NodeStream.storage = storage
-        self.root = None
-
-    def grandparent(self, node):
-        if node and node.parent:
-            return node.parent.parent
-
-    def uncle(self, node):
-        g = self.grandparent(node)
-        if not g:
-            return g
-        if node.parent == g.left:
-            return g.right
-        return g.left
-
-    def sibling(self, node):
-        if node == node.parent.left:
-            return node.parent.right
-        return node.parent.left
-
-    def replace_node(self, node_1, node_2):
-        node_2.parent = node_1.parent
-        if not node_1.parent:
-            self.root = node_2
-            NodeStream.set_node(self.root)
-            NodeStream.set_root(self.root)
-            return
-        if node_1 == node_1.parent.left:
-            node_1.parent.left = node_2
-        else:
-            node_1.parent.right = node_2
-
-    def rotate_left(self, node):
-        pivot = node.right
-        pivot.parent = node.parent
-        if node.parent:
-            if node.parent.left == node:
-                node.parent.left = pivot
-            else:
-                node.parent.right = pivot
-
-        node.right = pivot.left
-        if pivot.left:
-            pivot.left.parent = node
-
-        node.parent = pivot
-        pivot.left = node
-
-        if not pivot.parent:
-            self.root = pivot
-            NodeStream.set_node(self.root)
-            NodeStream.set_root(self.root)
-
-    def rotate_right(self, node):
-        pivot = node.left
-        pivot.parent = node.parent
-        if node.parent:
-            if node.parent.left == node:
-                node.parent.left = pivot
-            else:
-                node.parent.right = pivot
-
-        node.left = pivot.right
-        if pivot.right:
-            pivot.right.parent = node
-
-        node.parent = pivot
-        pivot.right = node
-
-        if not pivot.parent:
-            self.root = pivot
-            NodeStream.set_node(self.root)
-            NodeStream.set_root(self.root)
-
-    def insert(self, key, value):
-        self.root = NodeStream.get_root()
-        if not self.root:
-            self.root = Node(0, key, value, color=NodeColor.Black)
-            NodeStream.nodes_count_up(0)
-            NodeStream.set_node(self.root)
-            NodeStream.set_root(self.root)
-            return
-
-        node = self.root
-        while True:
-            index = NodeStream.nodes_count()
-            if key < node.key:
-                if not node.left:
-                    NodeStream.nodes_count_up(index)
-                    _node = Node(index, key, value, parent=node.index)
-                    NodeStream.set_node(_node)
-                    node.left = _node
-                    self._insert_case1(_node)
-                    break
-                node = node.left
-
-            else:
-                if not node.right:
-                    if key != node.key:
-                        NodeStream.nodes_count_up(index)
-                    else:
-                        NodeStream.set_attribute(21, ">i", node.index, value)
-                        return
-                    _node = Node(index, key, value, parent=node.index)
-                    NodeStream.set_node(_node)
-                    node.right = _node
-                    self._insert_case1(_node)
-                    break
-                node = node.right
-
-    def _insert_case1(self, node):
-        if not node.parent:
-            node.color = NodeColor.Black
-        else:
-            self._insert_case2(node)
-
-    def _insert_case2(self, node):
-        if node.parent.color == NodeColor.Black:
-            return
-        else:
-            self._insert_case3(node)
-
-    def _insert_case3(self, node):
-        u = self.uncle(node)
-        if u and u.color == NodeColor.Red:
-            node.parent.color = NodeColor.Black
-            u.color = NodeColor.Black
-            g = self.grandparent(node)
-            g.color = NodeColor.Red
-            self._insert_case1(g)
-        else:
-            self._insert_case4(node)
-
-    def _insert_case4(self, node):
-        g = self.grandparent(node)
-        if node == node.parent.right \
-                and node.parent == g.left:
-            self.rotate_left(node.parent)
-            node = node.left
-
-        elif node == node.parent.left \
-                and node.parent == g.right:
-            self.rotate_right(node.parent)
-            node = node.right
-
-        self._insert_case5(node)
-
-    def _insert_case5(self, node):
-        node.parent.color = NodeColor.Black
-        g = self.grandparent(node)
-        if not g:
-            return
-        g.color = NodeColor.Red
-
-        if node == node.parent.left \
-                and node.parent == g.left:
-            self.rotate_right(g)
-        else:
-            self.rotate_left(g)
-
-    def delete(self, key):
-        node = self.find(key)
-        if not node:
-            return
-
-        rm_node = node
-        if node.left and node.right:
-            rm_node = node.right
-            while rm_node.left:
-                rm_node = rm_node.left
-            node.key = rm_node.key
-
-        if rm_node.color == NodeColor.Red:
-            if rm_node == rm_node.parent.left:
-                rm_node.parent.left = ImagineNode(rm_node.parent.index)
-            else:
-                rm_node.parent.right = ImagineNode(rm_node.parent.index)
-
-        elif rm_node.color == NodeColor.Black:
-            child = rm_node.left or rm_node.right
-            if child and child.color == NodeColor.Red:
-                child.color = NodeColor.Black
-                self.replace_node(rm_node, child)
-            else:
-                self._delete_case1(rm_node)
-
-    def _delete_case1(self, node):
-        if node.parent:
-            self._delete_case2(node)
-        else:
-            self.root = ImagineNode(0)
-            NodeStream.set_node(self.root)
-
-    def _delete_case2(self, node):
-        s = self.sibling(node)
-        if s.color == NodeColor.Red:
-            node.parent.color = NodeColor.Red
-            s.color = NodeColor.Black
-            if node == node.parent.left:
-                self.rotate_left(node.parent)
-            else:
-                self.rotate_right(node.parent)
-        self._delete_case3(node)
-
-    def _delete_case3(self, node):
-        s = self.sibling(node)
-        if node.parent.color == NodeColor.Black \
-                and s.color == NodeColor.Black \
-                and s.left.color == NodeColor.Black \
-                and s.right.color == NodeColor.Black:
-            s.color = NodeColor.Red
-            self._delete_case1(node.parent)
-        else:
-            self._delete_case4(node)
-
-    def _delete_case4(self, node):
-        s = self.sibling(node)
-        if node.parent.color == NodeColor.Red \
-                and s.color == NodeColor.Black \
-                and s.left.color == NodeColor.Black \
-                and s.right.color == NodeColor.Black:
-            s.color = NodeColor.Red
-            node.parent.color = NodeColor.Black
-        else:
-            self._delete_case5(node)
-
-    def _delete_case5(self, node):
-        s = self.sibling(node)
-        if s.color == NodeColor.Black:
-            if node == node.parent.left \
-                    and s.right.color == NodeColor.Black \
-                    and s.left.color == NodeColor.Red:
-                s.color = NodeColor.Red
-                s.left.color = NodeColor.Black
-                self.rotate_right(s)
-            elif node == node.parent.right \
-                    and s.left.color == NodeColor.Black \
-                    and s.right.color == NodeColor.Red:
-                s.color = NodeColor.Red
-                s.right.color = NodeColor.Black
-                self.rotate_left(s)
-        self._delete_case6(node)
-
-    def _delete_case6(self, node):
-        s = self.sibling(node)
-        s.color = node.parent.color
-        node.parent.color = NodeColor.Black
-
-        if node == node.parent.left:
-            s.right.color = NodeColor.Black
-            self.rotate_left(node.parent)
-        else:
-            s.left.color = NodeColor.Black
-            self.rotate_right(node.parent)
-
-    def find(self, key):
-        self.root = NodeStream.get_root()
-        if not self.root:
-            return
-
-        node = self.root
-        while node:
-            if key == node.key:
-                return node
-
-            if key < node.key:
-                node = node.left
-            else:
-                node = node.right
-
-    def _search(self, node):
-        yield str(node)
-        if node.left:
-            yield self._search(node.left)
-        if node.right:
-            yield self._search(node.right)
-
-    def __iter__(self):
-        if not self.root:
-            raise StopIteration
-
-        left = list()
-        right = list()
-        node = self.root
-        if node.left:
-            left = list(self._search(node.left))
-        if node.right:
-            right = list(self._search(node.right))
-        return iter(chain([str(node)], left, right))
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from enum import Enum
+import os
+import struct
+import sys
+
+from heap import Heap
+
+
+class NodeColor(Enum):
+    Black = 0,
+    Red = 1
+
+    @staticmethod
+    def to_byte(color):
+        color = color == NodeColor.Red
+        return struct.pack(">?", color)
+
+    @staticmethod
+    def to_bool(color):
+        return color == NodeColor.Red
+
+    @staticmethod
+    def from_byte(color_byte):
+        color = struct.unpack(">?", color_byte)[0]
+        return NodeColor.Red if color else NodeColor.Black
+
+
+class NodeStream:
+    tree_size = 128
+    magic = b"KVSR"
+    cache_size = 4096
+    # Ключи и значения не длиннее prefix_size хранятся прямо в записи,
+    # для длинных ключей запись хранит начало ключа и смещение в куче
+    prefix_size = 16
+
+    # Метка формата, количество вершин, позиция корня,
+    # голова списка свободных записей, поколение кучи
+    header = struct.Struct(">4siiii")
+    # index, left, right, parent, color, size (ключей в поддереве),
+    # key_len, key_prefix, key_ref, value_len, value_inline_or_ref
+    row = struct.Struct(">iiii?II16sqI16s")
+    ref = struct.Struct(">q")
+    size_row = row.size
+
+    def __init__(self, path, cache_size=None):
+        self.path = path
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.heap = None
+        self.heap_gen = 0
+        # Счетчики stats.Stats, None - сбор выключен
+        self.stats = None
+        self._file = None
+        # Кэш вершин: индекс -> Node, порядок элементов - порядок LRU
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._count = 0
+        self._root = -1
+        self._free = -1
+        self._header_dirty = False
+
+    @classmethod
+    def create(cls, path, heap_gen=0):
+        with open(path, "wb") as storage:
+            storage.write(cls.header.pack(cls.magic, 0, -1, -1, heap_gen))
+        with open(Heap.path_for(path, heap_gen), "wb"):
+            pass
+
+    def open(self):
+        self._file = open(self.path, "rb+")
+        _, self._count, self._root, self._free, self.heap_gen = \
+            self.header.unpack(self._file.read(self.header.size))
+        self.heap = Heap(Heap.path_for(self.path, self.heap_gen))
+        self.heap.stats = self.stats
+        self.heap.open()
+        if self.stats is not None:
+            self.stats.file_opens += 1
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+            self.heap.close()
+        self._cache.clear()
+
+    def _offset(self, index):
+        return self.header.size + index * self.size_row
+
+    def get_node(self, index):
+        if index == -1:
+            return None
+        node = self._cache.get(index)
+        stats = self.stats
+        if node is not None:
+            self._cache.move_to_end(index)
+            if stats is not None:
+                stats.cache_hits += 1
+            return node
+
+        self._file.seek(self._offset(index), 0)
+        data = self._file.read(self.size_row)
+        if stats is not None:
+            stats.cache_misses += 1
+            stats.seeks += 1
+            stats.bytes_read += len(data)
+            stats.nodes_read += 1
+        if len(data) != self.size_row:
+            return None
+        node = self._unpack(data)
+        self._cache[index] = node
+        return node
+
+    def _unpack(self, data):
+        index, left, right, parent, color, size, key_len, prefix, \
+            key_ref, value_len, value = self.row.unpack(data)
+        node = Node(self, index, None, None,
+                    left=left, right=right, parent=parent,
+                    color=NodeColor.Red if color else NodeColor.Black,
+                    size=size)
+        node.key_len = key_len
+        node.prefix = prefix[:key_len]
+        node.key_ref = key_ref
+        node.value_len = value_len
+        if value_len <= self.prefix_size:
+            node._value = value[:value_len]
+        else:
+            node.value_ref = self.ref.unpack(value[:self.ref.size])[0]
+        return node
+
+    def _pack(self, node):
+        # Длинные ключи и значения дописываются в кучу при первой записи
+        if node.key_len > self.prefix_size and node.key_ref == -1:
+            node.key_ref = self.heap.append(node.key)
+        if node.value_len > self.prefix_size:
+            if node.value_ref == -1:
+                node.value_ref = self.heap.append(node.value)
+            value = self.ref.pack(node.value_ref)
+        else:
+            value = node.value
+        return self.row.pack(
+            node.index, node._left, node._right, node._parent,
+            NodeColor.to_bool(node.color), node.size, node.key_len,
+            node.prefix,
+            node.key_ref, node.value_len, value)
+
+    def nodes_count(self):
+        return self._count
+
+    def allocate(self):
+        # Сначала переиспользуются записи удаленных вершин
+        if self._free != -1:
+            index = self._free
+            self._free = self.get_node(index)._left
+        else:
+            index = self._count
+            self._count += 1
+        self._header_dirty = True
+        return index
+
+    def free_node(self, node):
+        # Свободная запись хранит в поле left ссылку на следующую
+        node._left, node._right, node._parent = self._free, -1, -1
+        node.key, node.value = b"", b""
+        node.size = 0
+        self.set_node(node)
+        self._free = node.index
+        self._header_dirty = True
+
+    def get_root(self):
+        return self.get_node(self._root)
+
+    def set_root(self, node):
+        self._root = node.index
+        self._header_dirty = True
+
+    def set_node(self, node):
+        if not isinstance(node, Node):
+            raise TypeError("Expected node")
+        if node.index == -1:
+            return None
+        self._cache[node.index] = node
+        self._cache.move_to_end(node.index)
+        self._dirty.add(node.index)
+
+    def write_rows(self, rows, count, root):
+        # Последовательная запись массива вершин начиная с индекса 0
+        self._cache.clear()
+        self._dirty.clear()
+        self._file.seek(self._offset(0), 0)
+        for node in rows:
+            self._file.write(self._pack(node))
+        self._file.truncate()
+        if self.stats is not None:
+            self.stats.seeks += 1
+            self.stats.nodes_written += count
+            self.stats.bytes_written += count * self.size_row
+        self._count = count
+        self._root = root
+        self._free = -1
+        self._header_dirty = True
+        self.flush()
+
+    def drop_cache(self):
+        if not self._dirty:
+            self._cache.clear()
+
+    def blocks(self):
+        # Образы измененных записей и заголовка: (смещение, данные)
+        blocks = list()
+        for index in sorted(self._dirty):
+            blocks.append(
+                (self._offset(index), self._pack(self._cache[index])))
+        if self._header_dirty:
+            blocks.append((0, self.header.pack(
+                self.magic, self._count, self._root, self._free,
+                self.heap_gen)))
+        return blocks
+
+    def write_blocks(self, blocks):
+        for offset, data in blocks:
+            self._file.seek(offset, 0)
+            self._file.write(data)
+        if self.stats is not None:
+            self.stats.seeks += len(blocks)
+            self.stats.bytes_written += sum(len(data) for _, data in blocks)
+            self.stats.nodes_written += len(blocks) - self._header_dirty
+        self._dirty.clear()
+        self._header_dirty = False
+        self._file.flush()
+        self.trim()
+
+    def dirty_count(self):
+        return len(self._dirty)
+
+    def flush(self):
+        # Изменения копятся в памяти и пишутся один раз на операцию
+        blocks = self.blocks()
+        # Куча сбрасывается раньше записей, которые на нее ссылаются
+        self.heap.flush()
+        self.write_blocks(blocks)
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.heap.sync()
+
+    def trim(self):
+        # Вытесняются только чистые вершины, начиная с давно не нужных
+        excess = len(self._cache) - self.cache_size
+        if excess <= 0:
+            return
+        victims = list()
+        for index in self._cache:
+            if index not in self._dirty:
+                victims.append(index)
+                if len(victims) == excess:
+                    break
+        for index in victims:
+            del self._cache[index]
+
+
+class Node:
+    def __init__(self, stream, index, key, value, left=-1,
+                 right=-1, parent=-1, color=NodeColor.Red, size=1):
+        self.stream = stream
+        self.index = index
+        self.key_len = 0
+        self.prefix = b""
+        self.key_ref = -1
+        self.value_len = 0
+        self.value_ref = -1
+        self._key = None
+        self._value = None
+        if key is not None:
+            self.key = key
+        if value is not None:
+            self.value = value
+        self._color = color
+        # Число ключей в поддереве с корнем в этой вершине
+        self.size = size
+        self._parent = parent
+        self._left = left
+        self._right = right
+
+    @property
+    def key(self):
+        if self._key is None:
+            if self.key_len <= self.stream.prefix_size:
+                self._key = self.prefix
+            else:
+                self._key = self.stream.heap.read(self.key_ref, self.key_len)
+        return self._key
+
+    @key.setter
+    def key(self, key):
+        self._key = key
+        self.key_len = len(key)
+        self.prefix = key[:self.stream.prefix_size]
+        self.key_ref = -1
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self.stream.heap.read(
+                self.value_ref, self.value_len)
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self.value_len = len(value)
+        self.value_ref = -1
+
+    def copy_from(self, node):
+        # Перенос ключа и значения без повторной записи в кучу
+        self._key, self.key_len = node._key, node.key_len
+        self.prefix, self.key_ref = node.prefix, node.key_ref
+        self._value, self.value_len = node._value, node.value_len
+        self.value_ref = node.value_ref
+
+    def compare(self, key):
+        # Сравнение ключа с ключом вершины; в кучу идем, только если
+        # совпали префиксы, а сами ключи длиннее префикса
+        prefix = key[:self.stream.prefix_size]
+        if prefix != self.prefix:
+            return -1 if prefix < self.prefix else 1
+        if len(key) == self.key_len <= self.stream.prefix_size:
+            return 0
+        if len(key) <= self.stream.prefix_size \
+                or self.key_len <= self.stream.prefix_size:
+            return -1 if len(key) < self.key_len else 1
+        node_key = self.key
+        if key == node_key:
+            return 0
+        return -1 if key < node_key else 1
+
+    @property
+    def parent(self):
+        node = self.stream.get_node(self._parent)
+        return node if node else ImagineNode(self.stream, self.index)
+
+    @parent.setter
+    def parent(self, node):
+        self._parent = node.index
+        self.stream.set_node(self)
+
+    @property
+    def left(self):
+        node = self.stream.get_node(self._left)
+        return node if node else ImagineNode(self.stream, self.index)
+
+    @left.setter
+    def left(self, node):
+        self._left = node.index
+        self.stream.set_node(self)
+
+    @property
+    def right(self):
+        node = self.stream.get_node(self._right)
+        return node if node else ImagineNode(self.stream, self.index)
+
+    @right.setter
+    def right(self, node):
+        self._right = node.index
+        self.stream.set_node(self)
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, color):
+        if not isinstance(color, NodeColor):
+            raise TypeError("Expected color")
+        if self.stream.stats is not None and color != self._color:
+            self.stream.stats.recolors += 1
+        self._color = color
+        self.stream.set_node(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Node):
+            raise TypeError("Expected node")
+        return self.index == other.index
+
+    def __bool__(self):
+        return self.index != -1
+
+
+class ImagineNode(Node):
+    def __init__(self, stream, parent):
+        super().__init__(
+            stream, -1, None, None, parent=parent,
+            color=NodeColor.Black, size=0)
+
+
+class Tree:
+    # Длина ключа не ограничена: длинные ключи уходят в кучу
+    max_key_size = None
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.root = None
+
+    def grandparent(self, node):
+        if node and node.parent:
+            return node.parent.parent
+
+    def uncle(self, node):
+        g = self.grandparent(node)
+        if not g:
+            return g
+        if node.parent == g.left:
+            return g.right
+        return g.left
+
+    def sibling(self, node):
+        if node == node.parent.left:
+            return node.parent.right
+        return node.parent.left
+
+    def replace_node(self, node_1, node_2):
+        node_2.parent = node_1.parent
+        if not node_1.parent:
+            self.root = node_2
+            self.stream.set_node(self.root)
+            self.stream.set_root(self.root)
+            return
+        if node_1 == node_1.parent.left:
+            node_1.parent.left = node_2
+        else:
+            node_1.parent.right = node_2
+
+    def rotate_left(self, node):
+        if self.stream.stats is not None:
+            self.stream.stats.rotations += 1
+        pivot = node.right
+        pivot.parent = node.parent
+        if node.parent:
+            if node.parent.left == node:
+                node.parent.left = pivot
+            else:
+                node.parent.right = pivot
+
+        node.right = pivot.left
+        if pivot.left:
+            pivot.left.parent = node
+
+        node.parent = pivot
+        pivot.left = node
+        self._resize(node, pivot)
+
+        if not pivot.parent:
+            self.root = pivot
+            self.stream.set_node(self.root)
+            self.stream.set_root(self.root)
+
+    def rotate_right(self, node):
+        if self.stream.stats is not None:
+            self.stream.stats.rotations += 1
+        pivot = node.left
+        pivot.parent = node.parent
+        if node.parent:
+            if node.parent.left == node:
+                node.parent.left = pivot
+            else:
+                node.parent.right = pivot
+
+        node.left = pivot.right
+        if pivot.right:
+            pivot.right.parent = node
+
+        node.parent = pivot
+        pivot.right = node
+        self._resize(node, pivot)
+
+        if not pivot.parent:
+            self.root = pivot
+            self.stream.set_node(self.root)
+            self.stream.set_root(self.root)
+
+    def _resize(self, node, pivot):
+        # После поворота pivot занимает место node и все его поддерево
+        pivot.size = node.size
+        node.size = node.left.size + node.right.size + 1
+        self.stream.set_node(node)
+        self.stream.set_node(pivot)
+
+    def _add_to_path(self, node, delta):
+        # Изменение размеров всех предков вершины до корня
+        node = self.stream.get_node(node._parent)
+        while node:
+            node.size += delta
+            self.stream.set_node(node)
+            node = self.stream.get_node(node._parent)
+
+    def insert(self, key, value):
+        self.root = self.stream.get_root()
+        if not self.root:
+            self.root = Node(
+                self.stream, self.stream.allocate(), key, value,
+                color=NodeColor.Black)
+            self.stream.set_node(self.root)
+            self.stream.set_root(self.root)
+            return True
+
+        node = self.root
+        while True:
+            order = node.compare(key)
+            if order == 0:
+                node.value = value
+                self.stream.set_node(node)
+                return False
+
+            if order < 0:
+                if not node.left:
+                    index = self.stream.allocate()
+                    _node = Node(self.stream, index, key, value,
+                                 parent=node.index)
+                    self.stream.set_node(_node)
+                    node.left = _node
+                    self._add_to_path(_node, 1)
+                    self._insert_case1(_node)
+                    break
+                node = node.left
+
+            else:
+                if not node.right:
+                    index = self.stream.allocate()
+                    _node = Node(self.stream, index, key, value,
+                                 parent=node.index)
+                    self.stream.set_node(_node)
+                    node.right = _node
+                    self._add_to_path(_node, 1)
+                    self._insert_case1(_node)
+                    break
+                node = node.right
+        return True
+
+    def build(self, pairs, count):
+        # Идеально сбалансированное дерево из отсортированных пар:
+        # вершина с индексом i хранит i-й по порядку ключ, поэтому обход
+        # in-order выдает записи ровно в порядке их расположения в файле
+        height = count.bit_length()
+
+        def rows(lo, hi, parent, depth):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            yield from rows(lo, mid, mid, depth + 1)
+            key, value = next(pairs)
+            left = (lo + mid) // 2 if lo < mid else -1
+            right = (mid + 1 + hi) // 2 if mid + 1 < hi else -1
+            # Нижний уровень красный, остальные черные
+            red = depth == height - 1 and depth > 0
+            yield Node(self.stream, mid, key, value,
+                       left=left, right=right, parent=parent,
+                       color=NodeColor.Red if red else NodeColor.Black,
+                       size=hi - lo)
+            yield from rows(mid + 1, hi, mid, depth + 1)
+
+        pairs = iter(pairs)
+        root = count // 2 if count else -1
+        self.stream.write_rows(rows(0, count, -1, 0), count, root)
+        self.root = self.stream.get_root()
+
+    def compact_into(self, stream, convert=None):
+        # Живые вершины переписываются в порядке обхода в ширину:
+        # верхние уровни дерева оказываются рядом в начале файла.
+        # convert, если задан, переводит значения для нового файла
+        order = list()
+        root = self.stream.get_root()
+        if root:
+            order.append(root.index)
+        position = dict()
+        i = 0
+        while i < len(order):
+            node = self.stream.get_node(order[i])
+            position[node.index] = i
+            for child in (node._left, node._right):
+                if child != -1:
+                    order.append(child)
+            i += 1
+            self.stream.trim()
+
+        def rows():
+            for index in order:
+                node = self.stream.get_node(index)
+                value = node.value
+                if convert is not None:
+                    value = convert(value)
+                yield Node(stream, position[index], node.key, value,
+                           left=position.get(node._left, -1),
+                           right=position.get(node._right, -1),
+                           parent=position.get(node._parent, -1),
+                           color=node.color, size=node.size)
+                self.stream.trim()
+
+        stream.write_rows(rows(), len(order), 0 if order else -1)
+
+    def _insert_case1(self, node):
+        if not node.parent:
+            node.color = NodeColor.Black
+        else:
+            self._insert_case2(node)
+
+    def _insert_case2(self, node):
+        if node.parent.color == NodeColor.Black:
+            return
+        else:
+            self._insert_case3(node)
+
+    def _insert_case3(self, node):
+        u = self.uncle(node)
+        if u and u.color == NodeColor.Red:
+            node.parent.color = NodeColor.Black
+            u.color = NodeColor.Black
+            g = self.grandparent(node)
+            g.color = NodeColor.Red
+            self._insert_case1(g)
+        else:
+            self._insert_case4(node)
+
+    def _insert_case4(self, node):
+        g = self.grandparent(node)
+        if node == node.parent.right \
+                and node.parent == g.left:
+            self.rotate_left(node.parent)
+            node = node.left
+
+        elif node == node.parent.left \
+                and node.parent == g.right:
+            self.rotate_right(node.parent)
+            node = node.right
+
+        self._insert_case5(node)
+
+    def _insert_case5(self, node):
+        node.parent.color = NodeColor.Black
+        g = self.grandparent(node)
+        if not g:
+            return
+        g.color = NodeColor.Red
+
+        if node == node.parent.left \
+                and node.parent == g.left:
+            self.rotate_right(g)
+        else:
+            self.rotate_left(g)
+
+    def delete(self, key):
+        node = self.find(key)
+        if not node:
+            return False
+
+        if node.left and node.right:
+            rm_node = node.right
+            while rm_node.left:
+                rm_node = rm_node.left
+            node.copy_from(rm_node)
+            self.stream.set_node(node)
+            node = rm_node
+
+        child = node.left or node.right
+        # Вершина уходит из дерева: до балансировки она весит как ее
+        # потомок, поэтому повороты считают размеры уже без нее
+        self._add_to_path(node, -1)
+        node.size = child.size
+        self.stream.set_node(node)
+        if node.color == NodeColor.Black:
+            if child.color == NodeColor.Red:
+                child.color = NodeColor.Black
+            else:
+                self._delete_case1(node)
+        self.replace_node(node, child)
+        self.stream.free_node(node)
+        return True
+
+    def _delete_case1(self, node):
+        if node.parent:
+            self._delete_case2(node)
+
+    def _delete_case2(self, node):
+        s = self.sibling(node)
+        if s.color == NodeColor.Red:
+            node.parent.color = NodeColor.Red
+            s.color = NodeColor.Black
+            if node == node.parent.left:
+                self.rotate_left(node.parent)
+            else:
+                self.rotate_right(node.parent)
+        self._delete_case3(node)
+
+    def _delete_case3(self, node):
+        s = self.sibling(node)
+        if node.parent.color == NodeColor.Black \
+                and s.color == NodeColor.Black \
+                and s.left.color == NodeColor.Black \
+                and s.right.color == NodeColor.Black:
+            s.color = NodeColor.Red
+            self._delete_case1(node.parent)
+        else:
+            self._delete_case4(node)
+
+    def _delete_case4(self, node):
+        s = self.sibling(node)
+        if node.parent.color == NodeColor.Red \
+                and s.color == NodeColor.Black \
+                and s.left.color == NodeColor.Black \
+                and s.right.color == NodeColor.Black:
+            s.color = NodeColor.Red
+            node.parent.color = NodeColor.Black
+        else:
+            self._delete_case5(node)
+
+    def _delete_case5(self, node):
+        s = self.sibling(node)
+        if s.color == NodeColor.Black:
+            if node == node.parent.left \
+                    and s.right.color == NodeColor.Black \
+                    and s.left.color == NodeColor.Red:
+                s.color = NodeColor.Red
+                s.left.color = NodeColor.Black
+                self.rotate_right(s)
+            elif node == node.parent.right \
+                    and s.left.color == NodeColor.Black \
+                    and s.right.color == NodeColor.Red:
+                s.color = NodeColor.Red
+                s.right.color = NodeColor.Black
+                self.rotate_left(s)
+        self._delete_case6(node)
+
+    def _delete_case6(self, node):
+        s = self.sibling(node)
+        s.color = node.parent.color
+        node.parent.color = NodeColor.Black
+
+        if node == node.parent.left:
+            s.right.color = NodeColor.Black
+            self.rotate_left(node.parent)
+        else:
+            s.left.color = NodeColor.Black
+            self.rotate_right(node.parent)
+
+    def get(self, key):
+        node = self.find(key)
+        if node:
+            return node.value
+
+    def __contains__(self, key):
+        return bool(self.find(key))
+
+    def get_many(self, keys, values=True):
+        # keys - отсортированные различные ключи. Дерево обходится один
+        # раз: в каждой вершине набор ключей делится на две части, поэтому
+        # общие участки путей читаются однократно
+        found = dict()
+        root = self.stream.get_root()
+        stack = [(root.index if root else -1, 0, len(keys))]
+        while stack:
+            index, lo, hi = stack.pop()
+            if index == -1 or lo >= hi:
+                continue
+            node = self.stream.get_node(index)
+            left, right = lo, hi
+            while left < right:
+                mid = (left + right) // 2
+                if node.compare(keys[mid]) < 0:
+                    left = mid + 1
+                else:
+                    right = mid
+            split = left
+            if split < hi and node.compare(keys[split]) == 0:
+                found[keys[split]] = node.value if values else True
+                stack.append((node._right, split + 1, hi))
+            else:
+                stack.append((node._right, split, hi))
+            stack.append((node._left, lo, split))
+        return found
+
+    def __len__(self):
+        # Размер корня; nodes_count считает и свободные записи
+        root = self.stream.get_root()
+        return root.size if root else 0
+
+    def rank(self, key):
+        # Число ключей меньше key
+        rank = 0
+        node = self.stream.get_root()
+        while node:
+            if node.compare(key) > 0:
+                rank += node.left.size + 1
+                node = node.right
+            else:
+                node = node.left
+        return rank
+
+    def select(self, i):
+        # i-й по порядку ключ, считая с нуля
+        node = self.stream.get_root()
+        while node:
+            left = node.left.size
+            if i < left:
+                node = node.left
+            elif i == left:
+                return node.key
+            else:
+                i -= left + 1
+                node = node.right
+
+    def is_empty(self):
+        return not self.stream.get_root()
+
+    def find(self, key):
+        self.root = self.stream.get_root()
+        if not self.root:
+            return
+
+        node = self.root
+        while node:
+            order = node.compare(key)
+            if order == 0:
+                return node
+
+            if order < 0:
+                node = node.left
+            else:
+                node = node.right
+
+    def structure(self):
+        # Обход всех вершин: высота, черная высота (черные вершины от
+        # корня до листа) и доля живых записей среди записей файла
+        live = height = black_height = 0
+        root = self.stream.get_root()
+        stack = [(root.index, 1, 0)] if root else []
+        while stack:
+            index, depth, blacks = stack.pop()
+            node = self.stream.get_node(index)
+            live += 1
+            height = max(height, depth)
+            if node.color == NodeColor.Black:
+                blacks += 1
+            if node._left == -1 and node._right == -1:
+                black_height = max(black_height, blacks)
+            for child in (node._left, node._right):
+                if child != -1:
+                    stack.append((child, depth + 1, blacks))
+        slots = self.stream.nodes_count()
+        return {
+            "keys": live,
+            "nodes": slots,
+            "height": height,
+            "black_height": black_height,
+            "fill_ratio": live / slots if slots else 1.0,
+        }
+
+    def items(self, lo=None, hi=None, reverse=False):
+        # Обход in-order со стеком: в стеке лежит только путь от корня,
+        # поддеревья вне диапазона [lo, hi) не посещаются
+        stack = list()
+        node = self.stream.get_root()
+        while stack or node:
+            if node:
+                if not reverse:
+                    if lo is not None and node.compare(lo) > 0:
+                        node = node.right
+                    else:
+                        stack.append(node)
+                        node = node.left
+                else:
+                    if hi is not None and node.compare(hi) <= 0:
+                        node = node.left
+                    else:
+                        stack.append(node)
+                        node = node.right
+                continue
+
+            node = stack.pop()
+            if not reverse and hi is not None and node.compare(hi) <= 0:
+                return
+            if reverse and lo is not None and node.compare(lo) > 0:
+                return
+            yield node.key, node.value
+            self.stream.trim()
+            node = node.left if reverse else node.right
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+
+class MemoryNodeStream(NodeStream):
+    # Все записи в памяти колонками: файл вершин и куча читаются при
+    # открытии одним чтением каждый. Изменения идут обычным путем через
+    # кэш вершин и журнал, а колонки обновляются вместе с вершиной
+    # Смещения полей в записи вершины, см. NodeStream.row
+    offsets = {"left": 4, "right": 8, "parent": 12, "color": 16,
+               "size": 17, "key_len": 21, "prefix": 25, "key_ref": 41,
+               "value_len": 49, "value": 53}
+
+    def open(self):
+        super().open()
+        self._load()
+
+    def _load(self):
+        self._file.seek(self._offset(0), 0)
+        data = self._file.read(self._count * self.size_row)
+        self.heap.flush()
+        with open(self.heap.path, "rb") as heap:
+            image = heap.read()
+        if self.stats is not None:
+            self.stats.seeks += 2
+            self.stats.bytes_read += len(data) + len(image)
+            self.stats.nodes_read += self._count
+        count = len(data) // self.size_row
+
+        self.left = self._column(data, count, "left", "i")
+        self.right = self._column(data, count, "right", "i")
+        self.parent = self._column(data, count, "parent", "i")
+        self.red = bytearray(data[self.offsets["color"]::self.size_row])
+        self.size = self._column(data, count, "size", "I")
+        self.key_refs = self._column(data, count, "key_ref", "q")
+        key_lens = self._column(data, count, "key_len", "I")
+        value_lens = self._column(data, count, "value_len", "I")
+        # В поле значения длинной записи лежит смещение в куче
+        value_refs = self._column(data, count, "value", "q")
+
+        step, limit = self.size_row, self.prefix_size
+        self.keys = [
+            data[row:row + length] if length <= limit
+            else image[ref:ref + length]
+            for row, length, ref in zip(
+                range(self.offsets["prefix"], len(data), step),
+                key_lens, self.key_refs)]
+        self.values = [
+            data[row:row + length] if length <= limit
+            else image[ref:ref + length]
+            for row, length, ref in zip(
+                range(self.offsets["value"], len(data), step),
+                value_lens, value_refs)]
+        self.value_refs = array("q", (
+            ref if length > limit else -1
+            for length, ref in zip(value_lens, value_refs)))
+
+    def _column(self, data, count, field, typecode):
+        # Байты поля собираются срезами с шагом в размер записи
+        column = array(typecode)
+        size = column.itemsize
+        raw = bytearray(count * size)
+        for byte in range(size):
+            raw[byte::size] = \
+                data[self.offsets[field] + byte::self.size_row]
+        column.frombytes(raw)
+        if sys.byteorder == "little":
+            column.byteswap()
+        return column
+
+    def get_node(self, index):
+        if index == -1:
+            return None
+        node = self._cache.get(index)
+        if node is not None:
+            self._cache.move_to_end(index)
+            return node
+        if index >= len(self.keys):
+            return None
+        key, value = self.keys[index], self.values[index]
+        node = Node(self, index, None, None,
+                    left=self.left[index], right=self.right[index],
+                    parent=self.parent[index],
+                    color=NodeColor.Red if self.red[index]
+                    else NodeColor.Black, size=self.size[index])
+        node._key, node.key_len = key, len(key)
+        node.prefix, node.key_ref = \
+            key[:self.prefix_size], self.key_refs[index]
+        node._value, node.value_len = value, len(value)
+        node.value_ref = self.value_refs[index]
+        self._cache[index] = node
+        return node
+
+    def set_node(self, node):
+        super().set_node(node)
+        index = node.index
+        if index == -1:
+            return
+        if index == len(self.keys):
+            for column in (self.left, self.right, self.parent,
+                           self.key_refs, self.value_refs):
+                column.append(-1)
+            self.red.append(0)
+            self.size.append(0)
+            self.keys.append(b"")
+            self.values.append(b"")
+        self.left[index] = node._left
+        self.right[index] = node._right
+        self.parent[index] = node._parent
+        self.red[index] = node._color == NodeColor.Red
+        self.size[index] = node.size
+        self.keys[index] = node.key
+        self.values[index] = node.value
+
+    def _pack(self, node):
+        # Ссылки в кучу появляются при записи, их нужно запомнить, чтобы
+        # вершина, собранная из колонок, не дописала данные повторно
+        data = super()._pack(node)
+        if node.index < len(self.key_refs):
+            self.key_refs[node.index] = node.key_ref
+            self.value_refs[node.index] = node.value_ref
+        return data
+
+    def write_rows(self, rows, count, root):
+        super().write_rows(rows, count, root)
+        self._load()
+
+    def close(self):
+        super().close()
+        self.keys = self.values = list()
+
+
+class MemoryTree(Tree):
+    # Поиск и обход - арифметика индексов по колонкам потока, без
+    # создания вершин. Изменения выполняет обычный Tree
+    def _locate(self, key):
+        stream = self.stream
+        keys, left, right = stream.keys, stream.left, stream.right
+        index = stream._root
+        while index != -1:
+            node_key = keys[index]
+            if key == node_key:
+                return index
+            index = left[index] if key < node_key else right[index]
+        return -1
+
+    def find(self, key):
+        index = self._locate(key)
+        if index != -1:
+            return self.stream.get_node(index)
+
+    def get(self, key):
+        index = self._locate(key)
+        if index != -1:
+            return self.stream.values[index]
+
+    def __len__(self):
+        stream = self.stream
+        return stream.size[stream._root] if stream._root != -1 else 0
+
+    def rank(self, key):
+        stream = self.stream
+        keys, left, right, size = \
+            stream.keys, stream.left, stream.right, stream.size
+        rank = 0
+        index = stream._root
+        while index != -1:
+            if key > keys[index]:
+                child = left[index]
+                rank += (size[child] if child != -1 else 0) + 1
+                index = right[index]
+            else:
+                index = left[index]
+        return rank
+
+    def select(self, i):
+        stream = self.stream
+        left, right, size = stream.left, stream.right, stream.size
+        index = stream._root
+        while index != -1:
+            child = left[index]
+            before = size[child] if child != -1 else 0
+            if i < before:
+                index = child
+            elif i == before:
+                return stream.keys[index]
+            else:
+                i -= before + 1
+                index = right[index]
+
+    def __contains__(self, key):
+        return self._locate(key) != -1
+
+    def get_many(self, keys, values=True):
+        stream = self.stream
+        found = dict()
+        stack = [(stream._root, 0, len(keys))]
+        while stack:
+            index, lo, hi = stack.pop()
+            if index == -1 or lo >= hi:
+                continue
+            split = bisect_left(keys, stream.keys[index], lo, hi)
+            if split < hi and keys[split] == stream.keys[index]:
+                found[keys[split]] = stream.values[index] if values else True
+                stack.append((stream.right[index], split + 1, hi))
+            else:
+                stack.append((stream.right[index], split, hi))
+            stack.append((stream.left[index], lo, split))
+        return found
+
+    def items(self, lo=None, hi=None, reverse=False):
+        stream = self.stream
+        keys, values = stream.keys, stream.values
+        # Для обратного обхода левые и правые ссылки меняются местами
+        near, far = (stream.right, stream.left) if reverse \
+            else (stream.left, stream.right)
+        stack = list()
+        index = stream._root
+        while stack or index != -1:
+            if index != -1:
+                key = keys[index]
+                if not reverse and lo is not None and key < lo \
+                        or reverse and hi is not None and key >= hi:
+                    index = far[index]
+                else:
+                    stack.append(index)
+                    index = near[index]
+                continue
+
+            index = stack.pop()
+            key = keys[index]
+            if not reverse and hi is not None and key >= hi \
+                    or reverse and lo is not None and key < lo:
+                return
+            yield key, values[index]
+            index = far[index]
@@ -0,0 +1,150 @@
+import json
+import os
+import time
+
+from bloom import BloomFilter
+from index import ValueIndex
+from oplog import OpLog, OpLogError
+from storage import Storage
+
+
+# Сколько операций последователь применяет одним пакетом
+FOLLOW_BATCH = 10000
+# Пауза между проверками журнала ведущего, в секундах
+FOLLOW_INTERVAL = 0.5
+
+
+class Follower:
+    # Копия хранилища, которая догоняет ведущее по его журналу операций.
+    # Журнал читается без блокировок ведущего, а файл последователя
+    # открывается на запись только на время пакета, поэтому между
+    # пакетами его читают обычные сессии. Номер последней примененной
+    # операции сохраняется в <path>.follow после закрытия пакета: повтор
+    # операций по порядку дает то же состояние, и сбой между этими
+    # шагами ничего не портит
+    def __init__(self, leader, path, sync="batch"):
+        self.leader = os.path.abspath(leader)
+        self.path = path
+        self._sync = sync
+
+    @staticmethod
+    def path_for(storage_path):
+        return storage_path + ".follow"
+
+    def _state(self):
+        try:
+            with open(self.path_for(self.path)) as state:
+                return json.load(state)
+        except FileNotFoundError:
+            return None
+
+    def _save(self, state):
+        path = self.path_for(self.path)
+        with open(path + ".new", "w") as target:
+            json.dump(state, target)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(path + ".new", path)
+
+    def _log(self, state=None):
+        path = OpLog.path_for(self.leader)
+        if not os.path.exists(path):
+            text = f"Storage '{self.leader}' has no operation log"
+            raise OpLogError(text)
+        log = OpLog(path)
+        log.open(readonly=True)
+        if state is not None and state["token"] != log.token:
+            log.close()
+            text = f"Operation log of '{self.leader}' was recreated"
+            raise OpLogError(text)
+        return log
+
+    def start(self):
+        # Новый последователь. Журнал, начатый на пустом хранилище,
+        # воспроизводится с начала; иначе нужна копия ведущего, и для
+        # нее берется разделяемая блокировка ведущего
+        if self._state() is not None:
+            return
+        if os.path.exists(self.path):
+            text = f"Storage '{self.path}' exists and is not a follower"
+            raise OpLogError(text)
+        log = self._log()
+        try:
+            if log.complete:
+                self._init_empty()
+                state = {"seq": 0, "offset": OpLog.header.size}
+            else:
+                with Storage(self.leader, readonly=True) as leader:
+                    leader.snapshot(self.path)
+                log.close()
+                log = self._log()
+                state = {"seq": log.checkpoint_seq,
+                         "offset": log.checkpoint_end}
+            state.update(leader=self.leader, token=log.token)
+        finally:
+            log.close()
+        self._save(state)
+
+    def _init_empty(self):
+        bloom = None
+        path = BloomFilter.path_for(self.leader)
+        if os.path.exists(path):
+            leader_bloom = BloomFilter(path)
+            leader_bloom.open(readonly=True)
+            bloom = leader_bloom.fp_rate
+            leader_bloom.close()
+        Storage(self.path).init(
+            Storage(self.leader).engine, bloom,
+            os.path.exists(ValueIndex.path_for(self.leader)))
+
+    def step(self, limit=FOLLOW_BATCH):
+        # Один пакет не больше limit операций; возвращает их число
+        state = self._state()
+        if state is None:
+            text = f"Storage '{self.path}' is not a follower"
+            raise OpLogError(text)
+        log = self._log(state)
+        ops = list()
+        try:
+            for seq, record, offset in log.read(
+                    state["seq"], state["offset"]):
+                ops.extend(record)
+                state["seq"] = seq + len(record) - 1
+                state["offset"] = offset
+                if len(ops) >= limit:
+                    break
+        finally:
+            log.close()
+        if ops:
+            with Storage(self.path, sync=self._sync) as storage:
+                storage.replay(ops)
+            self._save(state)
+        return len(ops)
+
+    def lag(self):
+        # Отставание: номер примененной операции, сколько операций ждут
+        # и сколько секунд ждет самая старая из них
+        state = self._state()
+        if state is None:
+            text = f"Storage '{self.path}' is not a follower"
+            raise OpLogError(text)
+        log = self._log(state)
+        try:
+            count, oldest = log.pending(state["offset"])
+        finally:
+            log.close()
+        seconds = 0.0 if oldest is None else \
+            max(time.time() * 1000 - oldest, 0) / 1000
+        return {"seq": state["seq"], "pending": count, "seconds": seconds}
+
+    def run(self, interval=FOLLOW_INTERVAL, once=False, report=None):
+        # Пакет за пакетом; once - остановиться, догнав ведущего
+        self.start()
+        while True:
+            applied = self.step()
+            if applied and report:
+                report(self.lag())
+            if not applied:
+                if once:
+                    return
+                time.sleep(interval)
@@ -0,0 +1,376 @@
+import asyncio
+import json
+import os
+import pickle
+import signal
+import socket
+import tempfile
+from itertools import islice
+
+from backup import Backup, Snapshot
+from codec import decode, encode
+from protocol import (
+    BACKUP, BLOOM, COMPACT, COUNT, DELETE, ERROR, EXIST, FIND, GET, KEYS,
+    LOAD, MORE, OK, PUT, PUT_TTL, RANK, REAP, SCAN, SELECT, SNAPSHOT, STATS,
+    STREAM_CHUNK, TTL, VALUES, frame, pack, parse_address, unpack)
+from storage import REAP_STEP, StorageError
+from wal import parse_sync
+
+
+# Сколько строк потоковый ответ читает за раз под блокировкой
+SCAN_CHUNK = 1000
+
+
+class Server:
+    # Держит хранилище открытым и обслуживает клиентов в одном потоке:
+    # запросы выполняются по одному под общей блокировкой, потоковый
+    # ответ читает под ней порцию за порцией. Запросы одного соединения
+    # обрабатываются по порядку, клиент может слать их, не дожидаясь
+    # ответов
+    def __init__(self, storage, address, sync="batch"):
+        self.storage = storage
+        self.family, self.address = parse_address(address)
+        _, self._interval = parse_sync(sync)
+        self._lock = None
+        self._clients = set()
+        self._handlers = {
+            GET: self._get,
+            PUT: self._put,
+            DELETE: self._delete,
+            EXIST: self._exist,
+            KEYS: self._keys,
+            VALUES: self._values,
+            SCAN: self._scan,
+            LOAD: self._load,
+            COMPACT: self._compact,
+            BLOOM: self._bloom,
+            STATS: self._stats,
+            COUNT: self._count,
+            RANK: self._rank,
+            SELECT: self._select,
+            FIND: self._find,
+            PUT_TTL: self._put_ttl,
+            TTL: self._ttl,
+            REAP: self._reap,
+            SNAPSHOT: self._snapshot,
+            BACKUP: self._backup,
+        }
+        # Обработчики, которые сами берут общую блокировку
+        self._unlocked = {SNAPSHOT, BACKUP, KEYS, VALUES, SCAN, FIND}
+
+    async def serve(self, ready=None):
+        self._lock = asyncio.Lock()
+        if self.family == socket.AF_UNIX:
+            self._remove_stale()
+            server = await asyncio.start_unix_server(
+                self._handle, self.address)
+        else:
+            server = await asyncio.start_server(
+                self._handle, *self.address)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        syncer = asyncio.create_task(self._sync_log())
+        if ready:
+            ready()
+
+        try:
+            await stop.wait()
+        finally:
+            syncer.cancel()
+            server.close()
+            for writer in list(self._clients):
+                writer.close()
+            await server.wait_closed()
+            if self.family == socket.AF_UNIX:
+                os.remove(self.address)
+
+    def _remove_stale(self):
+        # Сокет, оставшийся от упавшего сервера, удаляется. Если по нему
+        # отвечают, значит, сервер еще работает
+        if not os.path.exists(self.address):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(self.address)
+        else:
+            text = f"Socket '{self.address}' is already served"
+            raise StorageError(text)
+        finally:
+            probe.close()
+
+    async def _sync_log(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            async with self._lock:
+                # Истекшие ключи удаляются понемногу и без запросов
+                self.storage.reap(REAP_STEP)
+                self.storage.sync()
+
+    async def _handle(self, reader, writer):
+        self._clients.add(writer)
+        # Пары, присланные частями для массовой загрузки
+        loads = _Upload()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(frame.size)
+                    length, code = frame.unpack(header)
+                    payload = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                try:
+                    handler = self._handlers.get(code)
+                    if handler is None:
+                        raise ValueError(f"Unknown command {code}")
+                    if code in self._unlocked:
+                        await handler(writer, unpack(payload), loads)
+                    else:
+                        async with self._lock:
+                            await handler(writer, unpack(payload), loads)
+                except ConnectionError:
+                    break
+                # Ошибка запроса не должна останавливать сервер
+                except Exception as error:
+                    text = getattr(error, "text", None) or str(error)
+                    writer.write(pack(ERROR, [text.encode("utf-8")]))
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    break
+        finally:
+            loads.close()
+            self._clients.discard(writer)
+            writer.close()
+
+    async def _stream(self, writer, fetch):
+        # fetch(after) под блокировкой отдает порцию строк и ключ, после
+        # которого читать следующую, или None в конце. Отправка идет без
+        # блокировки: медленный клиент не задерживает остальных
+        chunk = list()
+        after = None
+        while True:
+            async with self._lock:
+                rows, after = fetch(after)
+            for row in rows:
+                chunk.extend(row)
+                if len(chunk) >= STREAM_CHUNK:
+                    writer.write(pack(MORE, chunk))
+                    chunk = list()
+                    await writer.drain()
+            if after is None:
+                break
+            # drain() не уступает циклу, пока буфер сокета не полон:
+            # запросы других клиентов встают в очередь к блокировке
+            await asyncio.sleep(0)
+        writer.write(pack(OK, chunk))
+
+    def _range(self, lo, hi, reverse, row):
+        # Между порциями могут пройти записи, поэтому следующая порция
+        # начинается от последнего отданного ключа
+        def fetch(after):
+            start, end = lo, hi
+            if after is not None:
+                if reverse:
+                    end = after
+                else:
+                    start = after
+            rows = self.storage.range(start, end, reverse)
+            if after is not None and not reverse:
+                rows = (item for item in rows if item[0] != after)
+            rows = list(islice(rows, SCAN_CHUNK))
+            last = rows[-1][0] if len(rows) == SCAN_CHUNK else None
+            return [row(key, value) for key, value in rows], last
+        return fetch
+
+    def _index(self, method, args, row):
+        # Порции ответа индекса значений; продолжение - после последней
+        # отданной строки
+        def fetch(after):
+            rows = getattr(self.storage, method)(*args, after=after)
+            rows = list(islice(rows, SCAN_CHUNK))
+            last = rows[-1] if len(rows) == SCAN_CHUNK else None
+            return [row(item) for item in rows], last
+        return fetch
+
+    async def _get(self, writer, items, loads):
+        values = self.storage.get_many(decode(key) for key in items)
+        writer.write(pack(OK, [
+            b"" if value is None else encode(value) for value in values]))
+
+    async def _put(self, writer, items, loads):
+        self.storage.update(
+            (decode(items[i]), decode(items[i + 1]))
+            for i in range(0, len(items), 2))
+        writer.write(pack(OK))
+
+    async def _put_ttl(self, writer, items, loads):
+        # Первый элемент - срок жизни в секундах, дальше пары
+        ttl, *items = items
+        self.storage.update(
+            ((decode(items[i]), decode(items[i + 1]))
+             for i in range(0, len(items), 2)), float(ttl))
+        writer.write(pack(OK))
+
+    async def _ttl(self, writer, items, loads):
+        ttl = self.storage.ttl(decode(items[0]))
+        writer.write(pack(OK, [b"" if ttl is None else str(ttl).encode()]))
+
+    async def _reap(self, writer, items, loads):
+        count = self.storage.reap(int(items[0]) if items[0] else None)
+        writer.write(pack(OK, [str(count).encode()]))
+
+    async def _snapshot(self, writer, items, loads):
+        await self._copy(writer, "snapshot", Snapshot, items[0].decode())
+
+    async def _backup(self, writer, items, loads):
+        directory, incremental = items
+        await self._copy(writer, "backup", Backup,
+                         directory.decode(), bool(incremental))
+
+    async def _copy(self, writer, method, job_class, *args):
+        # Файлы замораживаются и размораживаются под блокировкой, а
+        # копируются в потоке без нее: клиенты тем временем пишут в кэш
+        # и журнал. Шарды копируют себя сами, все это время под блокировкой
+        if not hasattr(self.storage, "freeze"):
+            async with self._lock:
+                report = getattr(self.storage, method)(*args)
+        else:
+            job = job_class(*args)
+            loop = asyncio.get_running_loop()
+            async with self._lock:
+                job.begin(self.storage)
+            try:
+                await loop.run_in_executor(None, job.copy)
+            finally:
+                async with self._lock:
+                    report = job.end(self.storage)
+        writer.write(pack(OK, [json.dumps(report).encode()]))
+
+    async def _delete(self, writer, items, loads):
+        self.storage.delete_many(decode(key) for key in items)
+        writer.write(pack(OK))
+
+    async def _exist(self, writer, items, loads):
+        found = self.storage.contains_many(decode(key) for key in items)
+        writer.write(pack(OK, [b"\x01" if exist else b""
+                               for exist in found]))
+
+    async def _keys(self, writer, items, loads):
+        await self._stream(writer, self._range(
+            None, None, False, lambda key, value: (encode(key),)))
+
+    async def _values(self, writer, items, loads):
+        await self._stream(writer, self._range(
+            None, None, False, lambda key, value: (encode(value),)))
+
+    async def _scan(self, writer, items, loads):
+        lo, hi, reverse = items
+        lo = decode(lo) if lo else None
+        hi = decode(hi) if hi else None
+        await self._stream(writer, self._range(
+            lo, hi, bool(reverse),
+            lambda key, value: (encode(key), encode(value))))
+
+    async def _load(self, writer, items, loads):
+        # Первый элемент - признак последней части, второй - размер
+        # куска сортировки, дальше пары ключ-значение
+        last, chunk_size, *pairs = items
+        loads.add(pairs)
+        if not last:
+            writer.write(pack(OK))
+            return
+        try:
+            total = self.storage.bulk_load(loads.pairs(), int(chunk_size))
+        finally:
+            loads.close()
+        writer.write(pack(OK, [str(total).encode()]))
+
+    async def _compact(self, writer, items, loads):
+        report = self.storage.compact()
+        writer.write(pack(OK, [json.dumps(report).encode()]))
+
+    async def _bloom(self, writer, items, loads):
+        rebuild, fp_rate = items
+        if rebuild:
+            self.storage.rebuild_bloom(
+                float(fp_rate) if fp_rate else None)
+        stats = self.storage.bloom_stats()
+        writer.write(pack(OK, [
+            b"" if stats is None else json.dumps(stats).encode()]))
+
+    async def _stats(self, writer, items, loads):
+        # Пустой элемент - счетчики, иначе обход структуры дерева
+        if items and items[0]:
+            report = self.storage.tree_stats()
+        else:
+            report = self.storage.stats()
+        writer.write(pack(OK, [
+            b"" if report is None else json.dumps(report).encode()]))
+
+    async def _count(self, writer, items, loads):
+        lo, hi = items
+        count = self.storage.count(
+            decode(lo) if lo else None, decode(hi) if hi else None)
+        writer.write(pack(OK, [str(count).encode()]))
+
+    async def _rank(self, writer, items, loads):
+        rank = self.storage.rank(decode(items[0]))
+        writer.write(pack(OK, [str(rank).encode()]))
+
+    async def _select(self, writer, items, loads):
+        key = self.storage.select(int(items[0]))
+        writer.write(pack(OK, [encode(key)]))
+
+    async def _find(self, writer, items, loads):
+        # Первый элемент пуст - ключи с одним значением, иначе пары
+        # (значение, ключ) в диапазоне значений
+        exact, lo, hi, reverse = items
+        if not exact:
+            await self._stream(writer, self._index(
+                "keys_for", (decode(lo),), lambda key: (encode(key),)))
+            return
+        await self._stream(writer, self._index(
+            "value_range",
+            (decode(lo) if lo else None, decode(hi) if hi else None,
+             bool(reverse)),
+            lambda row: (encode(row[0]), encode(row[1]))))
+
+
+class _Upload:
+    # Части массовой загрузки до последней копятся во временном файле,
+    # а не в памяти; коды пар декодируются уже при загрузке
+    def __init__(self):
+        self._file = None
+
+    def add(self, pairs):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        pickle.dump(pairs, self._file, pickle.HIGHEST_PROTOCOL)
+
+    def pairs(self):
+        if self._file is None:
+            return
+        self._file.seek(0)
+        while True:
+            try:
+                pairs = pickle.load(self._file)
+            except EOFError:
+                return
+            for i in range(0, len(pairs), 2):
+                yield decode(pairs[i]), decode(pairs[i + 1])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def serve(storage, address, ready=None, sync="batch"):
+    with storage:
+        asyncio.run(Server(storage, address, sync).serve(ready))
@@ -0,0 +1,508 @@
+import heapq
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from backup import BackupError, restore
+from blob import BLOB_CHUNK, BLOB_THRESHOLD
+from bulk import CHUNK_SIZE
+from codec import encode
+from stats import merge
+from storage import ENGINES, Storage, StorageError, StorageInitError
+
+
+MANIFEST = "manifest.json"
+# Сколько пар шард отдает за один запрос при полном обходе
+SCAN_CHUNK = 10000
+
+# Хранилище шарда в процессе-исполнителе
+_storage = None
+
+
+def _open(path, cache_size, sync, readonly, stats, mode, blob_threshold):
+    global _storage
+    _storage = Storage(path, cache_size, sync, readonly, stats, mode=mode,
+                       blob_threshold=blob_threshold)
+    _storage.__enter__()
+
+
+def _close():
+    global _storage
+    _storage.__exit__(None, None, None)
+    _storage = None
+
+
+def _call(method, *args):
+    return getattr(_storage, method)(*args)
+
+
+def _scan(lo, hi, reverse, skip_lo):
+    # Очередная порция обхода; при продолжении вперед нижняя граница -
+    # последний уже отданный ключ, его нужно пропустить
+    rows = _storage.range(lo, hi, reverse)
+    if skip_lo:
+        rows = (row for row in rows if row[0] != lo)
+    return list(islice(rows, SCAN_CHUNK))
+
+
+def _ranks(keys):
+    return [_storage.rank(key) for key in keys]
+
+
+def _find(method, args, after):
+    # Очередная порция ответа индекса значений после строки after
+    rows = getattr(_storage, method)(*args, after=after)
+    return list(islice(rows, SCAN_CHUNK))
+
+
+def _view(key):
+    # memoryview не передается между процессами: шард отдает копию
+    view = _storage.get_view(key)
+    return None if view is None else bytes(view)
+
+
+def _set_file(path, key, ttl):
+    try:
+        with open(path, "rb") as file:
+            _storage.set_file(key, file, ttl)
+    finally:
+        os.remove(path)
+
+
+def _load(path, chunk_size):
+    def pairs():
+        with open(path, "rb") as file:
+            while True:
+                try:
+                    yield pickle.load(file)
+                except EOFError:
+                    return
+    try:
+        return _storage.bulk_load(pairs(), chunk_size)
+    finally:
+        os.remove(path)
+
+
+class ShardedStorage:
+    # Каталог с N независимыми хранилищами и манифестом. Ключ попадает
+    # в шард по crc32 своего кода; каждый шард обслуживает отдельный
+    # процесс, поэтому пакетные операции идут параллельно. Профилировщик
+    # не передается: шарды работают в других процессах
+    def __init__(self, path, cache_size=None, sync="batch", readonly=False,
+                 stats=False, mode="disk", blob_threshold=BLOB_THRESHOLD):
+        self._path = path
+        self._cache_size = cache_size
+        self._sync = sync
+        self._readonly = readonly
+        self._stats = stats
+        self._mode = mode
+        self._blob_threshold = blob_threshold
+        self._executors = list()
+
+    @staticmethod
+    def is_sharded(path):
+        return os.path.isdir(path)
+
+    def _manifest(self):
+        try:
+            with open(os.path.join(self._path, MANIFEST)) as manifest:
+                return json.load(manifest)
+        except (OSError, ValueError):
+            text = f"Storage '{self._path}' has no valid manifest"
+            raise StorageError(text)
+
+    @property
+    def engine(self):
+        return self._manifest()["engine"]
+
+    def _shard_paths(self, count, directory=None):
+        directory = directory or self._path
+        return [os.path.join(directory, f"shard-{i}") for i in range(count)]
+
+    def init(self, engine="rbtree", bloom=None, shards=2,
+             index_values=False, oplog=False):
+        if shards < 1:
+            text = "Number of shards must be positive"
+            raise StorageInitError(text)
+        if engine not in ENGINES:
+            text = f"Unknown engine '{engine}'"
+            raise StorageInitError(text)
+        if not os.path.basename(os.path.normpath(self._path)):
+            text = "Storage name not specified"
+            raise StorageInitError(text)
+        if os.path.exists(self._path):
+            text = f"Storage '{self._path}' already exists"
+            raise StorageInitError(text)
+
+        os.makedirs(self._path)
+        for path in self._shard_paths(shards):
+            Storage(path).init(engine, bloom, index_values, oplog)
+        # Манифест пишется последним: без него каталог не хранилище
+        manifest = {"engine": engine, "shards": shards, "hash": "crc32"}
+        with open(os.path.join(self._path, MANIFEST), "w") as file:
+            json.dump(manifest, file)
+
+    def __enter__(self):
+        manifest = self._manifest()
+        for path in self._shard_paths(manifest["shards"]):
+            self._executors.append(ProcessPoolExecutor(
+                max_workers=1, initializer=_open, initargs=(
+                    path, self._cache_size, self._sync, self._readonly,
+                    self._stats, self._mode, self._blob_threshold)))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._map(_close)
+        for executor in self._executors:
+            executor.shutdown()
+        self._executors = list()
+
+    def _shard(self, key):
+        return zlib.crc32(encode(key)) % len(self._executors)
+
+    def _submit(self, shard, function, *args):
+        return self._executors[shard].submit(function, *args)
+
+    def _map(self, function, *args):
+        # Один вызов на каждый шард, результаты в порядке шардов
+        futures = [executor.submit(function, *args)
+                   for executor in self._executors]
+        return [future.result() for future in futures]
+
+    def _split(self, keys):
+        parts = [list() for _ in self._executors]
+        for key in keys:
+            parts[self._shard(key)].append(key)
+        return parts
+
+    def __len__(self):
+        return sum(self._map(_call, "__len__"))
+
+    def checkpoint(self):
+        self._map(_call, "checkpoint")
+
+    def sync(self):
+        self._map(_call, "sync")
+
+    def __getitem__(self, key):
+        return self._submit(self._shard(key), _call, "__getitem__",
+                            key).result()
+
+    def __setitem__(self, key, value):
+        self._submit(self._shard(key), _call, "__setitem__",
+                     key, value).result()
+
+    def __delitem__(self, key):
+        self._submit(self._shard(key), _call, "__delitem__", key).result()
+
+    def delete_many(self, keys):
+        futures = [self._submit(shard, _call, "delete_many", part)
+                   for shard, part in enumerate(self._split(keys)) if part]
+        for future in futures:
+            future.result()
+
+    def __contains__(self, item):
+        return self._submit(self._shard(item), _call, "__contains__",
+                            item).result()
+
+    def rank(self, key):
+        return sum(self._map(_call, "rank", key))
+
+    def count(self, lo=None, hi=None):
+        return sum(self._map(_call, "count", lo, hi))
+
+    def select(self, i):
+        # В каждом шарде - окно локальных рангов, где может лежать ответ.
+        # Шарды делят ключи по хэшу, так что ответ близок к той же доле
+        # каждого окна: кандидаты берутся из всех шардов разом, их ранги
+        # во всех шардах - тоже разом, и окна сужаются по ним
+        sizes = self._map(_call, "__len__")
+        size = sum(sizes)
+        if i < 0:
+            i += size
+        if not 0 <= i < size:
+            raise IndexError(f"Index {i} out of range for {size} keys")
+        lows, highs = [0] * len(sizes), list(sizes)
+        while True:
+            width = sum(highs) - sum(lows)
+            offset = i - sum(lows)
+            futures = [(shard, self._submit(
+                shard, _call, "select",
+                lows[shard] + min(high - lows[shard] - 1,
+                                  offset * (high - lows[shard]) // width)))
+                for shard, high in enumerate(highs) if lows[shard] < high]
+            candidates = [(shard, future.result())
+                          for shard, future in futures]
+            table = self._map(_ranks, [key for _, key in candidates])
+            for number, (owner, key) in enumerate(candidates):
+                ranks = [row[number] for row in table]
+                rank = sum(ranks)
+                if rank == i:
+                    return key
+                for shard, shard_rank in enumerate(ranks):
+                    if rank < i:
+                        lows[shard] = max(lows[shard],
+                                          shard_rank + (shard == owner))
+                    else:
+                        highs[shard] = min(highs[shard], shard_rank)
+
+    def _fan_out(self, method, keys):
+        keys = list(keys)
+        parts = self._split(keys)
+        futures = [(part, self._submit(shard, _call, method, part))
+                   for shard, part in enumerate(parts) if part]
+        found = dict()
+        for part, future in futures:
+            found.update(zip(part, future.result()))
+        return [found[key] for key in keys]
+
+    def get_many(self, keys):
+        return self._fan_out("get_many", keys)
+
+    def contains_many(self, keys):
+        return self._fan_out("contains_many", keys)
+
+    def set(self, key, value, ttl=None):
+        self._submit(self._shard(key), _call, "set",
+                     key, value, ttl).result()
+
+    def update(self, items, ttl=None):
+        if hasattr(items, "items"):
+            items = items.items()
+        parts = [list() for _ in self._executors]
+        for key, value in items:
+            parts[self._shard(key)].append((key, value))
+        futures = [self._submit(shard, _call, "update", part, ttl)
+                   for shard, part in enumerate(parts) if part]
+        for future in futures:
+            future.result()
+
+    def check(self, items):
+        # Проверку делает шард ключа: ему известны движок и индекс
+        parts = [list() for _ in self._executors]
+        for key, value in items:
+            parts[self._shard(key)].append((key, value))
+        futures = [self._submit(shard, _call, "check", part)
+                   for shard, part in enumerate(parts) if part]
+        for future in futures:
+            future.result()
+
+    def get_view(self, key):
+        view = self._submit(self._shard(key), _view, key).result()
+        return None if view is None else memoryview(view)
+
+    def set_file(self, key, file, ttl=None):
+        # Файловый объект не передается в процесс шарда: содержимое
+        # кусками копируется во временный файл, который шард читает сам
+        with tempfile.NamedTemporaryFile(
+                dir=self._path, suffix=".part", delete=False) as part:
+            try:
+                shutil.copyfileobj(file, part, BLOB_CHUNK)
+            except BaseException:
+                part.close()
+                os.remove(part.name)
+                raise
+        self._submit(self._shard(key), _set_file, part.name,
+                     key, ttl).result()
+
+    def ttl(self, key):
+        return self._submit(self._shard(key), _call, "ttl", key).result()
+
+    def reap(self, limit=None):
+        # Предел делится между шардами поровну, с округлением вверх
+        if limit is not None:
+            limit = -(-limit // len(self._executors))
+        return sum(self._map(_call, "reap", limit))
+
+    def bulk_load(self, items, chunk_size=CHUNK_SIZE):
+        # Пары раскладываются по временным файлам шардов, затем шарды
+        # загружают свои файлы параллельно
+        if hasattr(items, "items"):
+            items = items.items()
+        files = [tempfile.NamedTemporaryFile(
+            dir=self._path, suffix=".part", delete=False)
+            for _ in self._executors]
+        try:
+            for key, value in items:
+                pickle.dump((key, value), files[self._shard(key)],
+                            pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            for file in files:
+                file.close()
+                os.remove(file.name)
+            raise
+        for file in files:
+            file.close()
+        futures = [self._submit(shard, _load, file.name, chunk_size)
+                   for shard, file in enumerate(files)]
+        return sum(future.result() for future in futures)
+
+    def compact(self):
+        reports = self._map(_call, "compact")
+        return {
+            "size_before": sum(r["size_before"] for r in reports),
+            "size_after": sum(r["size_after"] for r in reports),
+            "lookup_before": sum(
+                r["lookup_before"] for r in reports) / len(reports),
+            "lookup_after": sum(
+                r["lookup_after"] for r in reports) / len(reports),
+        }
+
+    def rebuild_bloom(self, fp_rate=None):
+        self._map(_call, "rebuild_bloom", fp_rate)
+
+    def bloom_stats(self):
+        stats = [item for item in self._map(_call, "bloom_stats") if item]
+        if not stats:
+            return None
+        total = {name: sum(item[name] for item in stats) for name in (
+            "slots", "checks", "negatives", "false_positives")}
+        total["hashes"] = max(item["hashes"] for item in stats)
+        total["fp_rate"] = max(item["fp_rate"] for item in stats)
+        return total
+
+    def stats(self):
+        reports = self._map(_call, "stats")
+        if self._stats:
+            return merge(reports)
+
+    def tree_stats(self):
+        shards = self._map(_call, "tree_stats")
+        keys = sum(shard["keys"] for shard in shards)
+        nodes = sum(shard["nodes"] for shard in shards)
+        total = {
+            "shards": len(shards),
+            "keys": keys,
+            "nodes": nodes,
+            "height": max(shard["height"] for shard in shards),
+            "fill_ratio": sum(shard["fill_ratio"] * shard["nodes"]
+                              for shard in shards) / nodes if nodes else 1.0,
+        }
+        if "black_height" in shards[0]:
+            total["black_height"] = max(
+                shard["black_height"] for shard in shards)
+        return total
+
+    def keys_for(self, value, after=None):
+        # Индекс значений у каждого шарда свой, ответы сливаются
+        return heapq.merge(
+            *self._shard_finds("keys_for", (value,), after), key=encode)
+
+    def value_range(self, lo=None, hi=None, reverse=False, after=None):
+        return heapq.merge(
+            *self._shard_finds("value_range", (lo, hi, reverse), after),
+            key=lambda row: (encode(row[0]), encode(row[1])),
+            reverse=reverse)
+
+    def _shard_finds(self, method, args, after):
+        # Ответы шардов порциями, как в _shard_range: каждая следующая
+        # продолжается после последней строки предыдущей
+        futures = [self._submit(shard, _find, method, args, after)
+                   for shard in range(len(self._executors))]
+        return [self._shard_find(shard, future, method, args)
+                for shard, future in enumerate(futures)]
+
+    def _shard_find(self, shard, future, method, args):
+        while True:
+            rows = future.result()
+            if len(rows) < SCAN_CHUNK:
+                yield from rows
+                return
+            future = self._submit(shard, _find, method, args, rows[-1])
+            yield from rows
+
+    def rebuild_index(self):
+        self._map(_call, "rebuild_index")
+
+    def _shard_copies(self, method, target, *args):
+        # Каждый шард копирует себя в target/shard-i, манифест - последним
+        futures = [self._submit(shard, _call, method, path, *args)
+                   for shard, path in enumerate(self._shard_paths(
+                       len(self._executors), target))]
+        reports = [future.result() for future in futures]
+        shutil.copyfile(os.path.join(self._path, MANIFEST),
+                        os.path.join(target, MANIFEST))
+        return reports
+
+    def snapshot(self, dest):
+        if os.path.exists(dest):
+            text = f"Snapshot '{dest}' already exists"
+            raise BackupError(text)
+        os.makedirs(dest)
+        reports = self._shard_copies("snapshot", dest)
+        return {"bytes": sum(report["bytes"] for report in reports)}
+
+    def backup(self, directory, incremental=False):
+        os.makedirs(directory, exist_ok=True)
+        reports = self._shard_copies("backup", directory, incremental)
+        return {
+            "generation": max(r["generation"] for r in reports),
+            "kind": "delta" if all(r["kind"] == "delta" for r in reports)
+            else "full",
+            "bytes": sum(r["bytes"] for r in reports),
+        }
+
+    @staticmethod
+    def is_sharded_backup(directory):
+        return os.path.exists(os.path.join(directory, MANIFEST))
+
+    def restore(self, directory, generation=None):
+        # Поколения шардов нумеруются независимо; без номера берется
+        # последнее у каждого
+        with open(os.path.join(directory, MANIFEST)) as manifest:
+            shards = json.load(manifest)["shards"]
+        if os.path.exists(self._path):
+            text = f"Storage '{self._path}' already exists"
+            raise BackupError(text)
+        os.makedirs(self._path)
+        generations = [restore(source, dest, generation)
+                       for source, dest in zip(
+                           self._shard_paths(shards, directory),
+                           self._shard_paths(shards))]
+        shutil.copyfile(os.path.join(directory, MANIFEST),
+                        os.path.join(self._path, MANIFEST))
+        return max(generations)
+
+    def _shard_range(self, shard, future, lo, hi, reverse):
+        # Следующая порция запрашивается до выдачи текущей, так что
+        # шарды читают с диска параллельно со слиянием
+        while True:
+            rows = future.result()
+            if len(rows) < SCAN_CHUNK:
+                yield from rows
+                return
+            last = rows[-1][0]
+            if reverse:
+                future = self._submit(shard, _scan, lo, last, True, False)
+            else:
+                future = self._submit(shard, _scan, last, hi, False, True)
+            yield from rows
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        for key, _ in self.range():
+            yield key
+
+    def values(self):
+        for _, value in self.range():
+            yield value
+
+    def items(self, reverse=False):
+        return self.range(reverse=reverse)
+
+    def range(self, lo=None, hi=None, reverse=False):
+        # Слияние упорядоченных потоков шардов в общем порядке кодов.
+        # Первые порции запрашиваются у всех шардов сразу
+        futures = [self._submit(shard, _scan, lo, hi, reverse, False)
+                   for shard in range(len(self._executors))]
+        return heapq.merge(
+            *(self._shard_range(shard, future, lo, hi, reverse)
+              for shard, future in enumerate(futures)),
+            key=lambda row: encode(row[0]), reverse=reverse)
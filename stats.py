@@ -0,0 +1,70 @@
+import time
+
+
+COUNTERS = (
+    "file_opens", "seeks", "bytes_read", "bytes_written",
+    "nodes_read", "nodes_written", "cache_hits", "cache_misses",
+    "rotations", "recolors", "splits", "merges",
+)
+OPERATIONS = ("insert", "find", "delete")
+# Корзина i гистограммы - задержки меньше 2 ** i микросекунд
+BUCKETS = 32
+
+
+class Stats:
+    # Счетчики ввода-вывода и горячего пути. Пока сбор выключен, у
+    # потоков и дерева stats равен None, и проверка стоит одно сравнение
+    def __init__(self, profiler=None):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        # Вызывается после каждой операции: profiler(operation, key, seconds)
+        self.profiler = profiler
+        self.histograms = {
+            operation: [0] * BUCKETS for operation in OPERATIONS}
+
+    def observe(self, operation, key, started):
+        elapsed = time.perf_counter() - started
+        bucket = min(int(elapsed * 1e6).bit_length(), BUCKETS - 1)
+        self.histograms[operation][bucket] += 1
+        if self.profiler is not None:
+            self.profiler(operation, key, elapsed)
+
+    def as_dict(self):
+        return {
+            "counters": {name: getattr(self, name) for name in COUNTERS},
+            "latency": {operation: summary(histogram)
+                        for operation, histogram in self.histograms.items()},
+        }
+
+
+def _percentile(histogram, total, share):
+    # Верхняя граница корзины, в которую попадает доля share операций
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if seen >= share * total:
+            return 2 ** bucket
+    return 0
+
+
+def summary(histogram):
+    total = sum(histogram)
+    return {
+        "count": total,
+        "p50_us": _percentile(histogram, total, 0.5) if total else 0,
+        "p99_us": _percentile(histogram, total, 0.99) if total else 0,
+        "buckets": histogram,
+    }
+
+
+def merge(reports):
+    # Сумма отчетов нескольких хранилищ, например шардов
+    counters = {name: sum(report["counters"][name] for report in reports)
+                for name in COUNTERS}
+    latency = dict()
+    for operation in OPERATIONS:
+        histogram = [sum(bucket) for bucket in zip(
+            *(report["latency"][operation]["buckets"]
+              for report in reports))]
+        latency[operation] = summary(histogram)
+    return {"counters": counters, "latency": latency}
@@ -1,66 +1,1066 @@
-import os
-import struct
-
-from rbtree import Tree, NodeStream
-
-
-class StorageInitError(Exception):
-    def __init__(self, text=""):
-        self.text = text
-
-
-class Storage:
-    def __init__(self, path):
-        self._path = path
-        self._tree = None
-
-    def init(self):
-        head, tail = os.path.split(self._path)
-        if not tail:
-            text = "Storage name not specified"
-            raise StorageInitError(text)
-
-        try:
-            os.makedirs(head)
-        except (FileNotFoundError, FileExistsError):
-            pass
-
-        if os.path.exists(self._path):
-            text = f"Storage '{tail}' already exists"
-            raise StorageInitError(text)
-
-        with open(self._path, "wb") as storage:
-            pass
-
-        with open(self._path, "rb+") as storage:
-            # Количество вершин
-            storage.write(struct.pack(">i", 0))
-            # Позиция корня
-            storage.write(struct.pack(">i", -1))
-
-    def __len__(self):
-        return NodeStream.nodes_count()
-
-    def __enter__(self):
-        self._tree = Tree(self._path)
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
-
-    def __setitem__(self, key, value):
-        self._tree.insert(key, value)
-
-    def __getitem__(self, key):
-        result = self._tree.find(key)
-        if result:
-            return result.value
-
-    def __delitem__(self, key):
-        pass
-
-    def __contains__(self, item):
-        return self._tree.find(item)
-
-    def __iter__(self):
-        pass
+from bisect import bisect_left
+import fcntl
+import glob
+import os
+import random
+import time
+
+from backup import Backup, ChangeLog, Snapshot
+from blob import BLOB_THRESHOLD, REF, BlobStore, is_ref
+from bloom import BLOOM_CAPACITY, BLOOM_FP_RATE, BloomFilter
+from btree import BTree, PageStream
+from bulk import CHUNK_SIZE, sort_pairs
+from codec import BYTES, INT, STR, encode, decode
+from expiry import TIME, ExpiryIndex, deadline, moment, now
+from heap import Heap
+from index import ValueIndex, entry, is_truncated
+from oplog import OpLog
+from rbtree import MemoryNodeStream, MemoryTree, NodeStream, Tree
+from stats import Stats
+from wal import DELETE, EXPIRE, PUT, WriteAheadLog
+
+
+ENGINES = {
+    "rbtree": (NodeStream, Tree),
+    "btree": (PageStream, BTree),
+}
+# Режим memory: записи целиком в памяти, поиск по колонкам
+MEMORY_ENGINES = {
+    "rbtree": (MemoryNodeStream, MemoryTree),
+}
+MODES = ("disk", "memory")
+
+# Метки кодов значений, которые принимает пакет операций
+TAGS = {bytes([tag]) for tag in (INT, STR, BYTES, REF)}
+
+# Контрольная точка, когда журнал вырос больше этого размера
+WAL_LIMIT = 16 * 1024 * 1024
+# Сколько ключей используется для замера времени поиска при сжатии
+LATENCY_SAMPLE = 1000
+# Сколько истекших ключей удаляется попутно с каждой записью и сколько
+# за один пакет журнала при явной чистке
+REAP_STEP = 16
+REAP_CHUNK = 10000
+
+
+class StorageError(Exception):
+    def __init__(self, text=""):
+        self.text = text
+
+
+class StorageInitError(StorageError):
+    pass
+
+
+class Storage:
+    # Сессия писателя держит исключительную блокировку файла <path>.lock,
+    # сессии только для чтения - разделяемую, поэтому читатели работают
+    # параллельно и никогда не видят дерево посреди записи
+    def __init__(self, path, cache_size=None, sync="batch", readonly=False,
+                 stats=False, profiler=None, mode="disk",
+                 blob_threshold=BLOB_THRESHOLD):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode '{mode}'")
+        self._path = path
+        self._mode = mode
+        # Коды значений длиннее порога пишутся в файл блобов; None -
+        # новые значения остаются в дереве
+        self._blob_threshold = blob_threshold
+        self._cache_size = cache_size
+        self._sync = sync
+        self._readonly = readonly
+        # Счетчики собираются, только если их попросили
+        self._stats = Stats(profiler) if stats or profiler else None
+        self._lock = None
+        self._stream = None
+        self._tree = None
+        self._wal = None
+        self._bloom = None
+        self._index = None
+        self._expiry = None
+        self._changes = None
+        self._oplog = None
+        self._blobs = None
+        # Больше нуля, пока файлы данных копируются: см. freeze
+        self._frozen = 0
+
+    @property
+    def engine(self):
+        with open(self._path, "rb") as storage:
+            magic = storage.read(4)
+        for name, (stream_class, _) in ENGINES.items():
+            if stream_class.magic == magic:
+                return name
+        text = f"Storage '{self._path}' has unknown format"
+        raise StorageError(text)
+
+    def init(self, engine="rbtree", bloom=None, index_values=False,
+             oplog=False):
+        if engine not in ENGINES:
+            text = f"Unknown engine '{engine}'"
+            raise StorageInitError(text)
+
+        if bloom is not None and not 0 < bloom < 1:
+            text = f"False positive rate {bloom} not in (0, 1)"
+            raise StorageInitError(text)
+
+        head, tail = os.path.split(self._path)
+        if not tail:
+            text = "Storage name not specified"
+            raise StorageInitError(text)
+
+        try:
+            os.makedirs(head)
+        except (FileNotFoundError, FileExistsError):
+            pass
+
+        if os.path.exists(self._path):
+            text = f"Storage '{tail}' already exists"
+            raise StorageInitError(text)
+
+        stream_class, _ = ENGINES[engine]
+        stream_class.create(self._path)
+        if bloom is not None:
+            BloomFilter.create(BloomFilter.path_for(self._path),
+                               fp_rate=bloom)
+        if index_values:
+            ValueIndex.create(
+                ValueIndex.path_for(self._path), ENGINES[engine])
+        if oplog:
+            OpLog.create(OpLog.path_for(self._path), complete=True)
+
+    def __len__(self):
+        return len(self._tree) - len(self._expired_ranks())
+
+    def __enter__(self):
+        if self._mode == "memory" and self.engine not in MEMORY_ENGINES:
+            text = f"Engine '{self.engine}' has no memory mode"
+            raise StorageError(text)
+        self._lock = open(self._path + ".lock", "a+b")
+        if not self._readonly:
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+            self._open()
+            return self
+
+        fcntl.flock(self._lock, fcntl.LOCK_SH)
+        if self._needs_recovery():
+            # Читатель не может чинить файлы после сбоя писателя:
+            # восстановление выполняется под исключительной блокировкой
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+            self._readonly = False
+            try:
+                self._open()
+                self._close()
+            finally:
+                self._readonly = True
+            fcntl.flock(self._lock, fcntl.LOCK_SH)
+        self._open()
+        return self
+
+    def _needs_recovery(self):
+        wal_path = WriteAheadLog.path_for(self._path)
+        if os.path.exists(wal_path) and os.path.getsize(wal_path):
+            return True
+        if self._compacted_blobs():
+            return True
+        bloom_path = BloomFilter.path_for(self._path)
+        return os.path.exists(bloom_path) and \
+            not BloomFilter.is_clean(bloom_path)
+
+    def _open(self):
+        blobs = self._compacted_blobs()
+        if blobs and not self._readonly:
+            os.replace(blobs, BlobStore.path_for(self._path))
+        self._wal = WriteAheadLog(
+            WriteAheadLog.path_for(self._path), self._sync)
+        self._wal.open()
+        if self._stats is not None:
+            self._stats.file_opens += 1
+        self._open_changes()
+        image, batches = self._wal.read()
+        if image:
+            # Оборванная контрольная точка: повторяем запись блоков
+            WriteAheadLog.apply_image(image, self._paths())
+            if self._changes:
+                self._changes.append(image)
+                self._changes.sync()
+
+        self._open_tree()
+        self._open_index()
+        self._open_expiry()
+        self._open_blobs()
+        self._open_oplog(batches)
+        for ops in batches:
+            self._apply(ops)
+        if image or batches:
+            self.checkpoint()
+        self._open_bloom()
+
+    def _open_tree(self):
+        engines = MEMORY_ENGINES if self._mode == "memory" else ENGINES
+        stream_class, tree_class = engines[self.engine]
+        self._stream = stream_class(self._path, self._cache_size)
+        self._stream.stats = self._stats
+        self._stream.open()
+        self._tree = tree_class(self._stream)
+
+    def _paths(self):
+        # Файлы в порядке номеров блоков образа журнала: номер файла
+        # постоянен, отсутствующий файл - None
+        paths = [self._path]
+        for side in (ValueIndex, ExpiryIndex, OpLog):
+            path = side.path_for(self._path)
+            paths.append(path if os.path.exists(path) else None)
+        return paths
+
+    def _streams(self):
+        return [self._stream,
+                self._index.stream if self._index else None,
+                self._expiry.stream if self._expiry else None]
+
+    def _open_index(self):
+        path = ValueIndex.path_for(self._path)
+        if not os.path.exists(path):
+            return
+        self._index = ValueIndex(
+            path, ENGINES[self.engine], self._cache_size)
+        self._index.open()
+
+    def _open_expiry(self, create=False):
+        # Файл сроков появляется с первой записью ключа с ttl
+        if self._expiry is not None:
+            return
+        path = ExpiryIndex.path_for(self._path)
+        if not os.path.exists(path):
+            if not create:
+                return
+            ExpiryIndex.create(path, ENGINES[self.engine])
+        self._expiry = ExpiryIndex(
+            path, ENGINES[self.engine], self._cache_size)
+        self._expiry.open()
+
+    def _open_blobs(self, create=False):
+        # Файл блобов появляется с первым длинным значением
+        if self._blobs is not None:
+            return
+        path = BlobStore.path_for(self._path)
+        if not os.path.exists(path):
+            if not create:
+                return
+            BlobStore.create(path)
+        self._blobs = BlobStore(path)
+        self._blobs.open(self._readonly)
+
+    def _compacted_blobs(self):
+        # Сжатие упало после подмены дерева, но до подмены файла блобов:
+        # новое дерево ссылается на новый файл, его нужно поставить на
+        # место
+        temp = self._path + ".compact"
+        path = BlobStore.path_for(temp)
+        if os.path.exists(path) and not os.path.exists(temp):
+            return path
+
+    def _store(self, value):
+        # Длинный код значения уходит в файл блобов, в дерево - ссылка
+        if self._blob_threshold is None or \
+                len(value) <= self._blob_threshold or is_ref(value):
+            return value
+        self._open_blobs(create=True)
+        return self._blobs.append(value)
+
+    def _load(self, value):
+        if value is not None and is_ref(value):
+            return self._blobs.read(value)
+        return value
+
+    def _view(self, value):
+        # Как _load, но блоб без копии: для хэша и сравнения в индексе
+        if value is not None and is_ref(value):
+            return self._blobs.view(value)
+        return value
+
+    def _inline(self, ops):
+        # Операции со значениями вместо ссылок на блобы: у последователя
+        # свой файл блобов
+        if self._blobs is None:
+            return ops
+        return [(op, key, self._load(value[0])) if op == PUT
+                else (op, key, *value) for op, key, *value in ops]
+
+    def _open_oplog(self, batches=()):
+        path = OpLog.path_for(self._path)
+        if self._readonly or not os.path.exists(path):
+            return
+        self._oplog = OpLog(path)
+        self._oplog.open()
+        self._oplog.recover(self._inline(ops) for ops in batches)
+
+    def enable_oplog(self):
+        # Журнал операций для последователей на непустом хранилище: они
+        # начинают с копии хранилища, а не с пустого файла
+        self._check_writable()
+        if self._oplog is None:
+            self.checkpoint()
+            OpLog.create(OpLog.path_for(self._path),
+                         complete=self._tree.is_empty())
+            self._open_oplog()
+
+    def oplog_seq(self):
+        # Номер последней операции в журнале операций
+        self._check_writable()
+        if self._oplog is None:
+            text = f"Storage '{self._path}' has no operation log"
+            raise StorageError(text)
+        return self._oplog.seq
+
+    def _open_changes(self):
+        # Журнал изменений ведется после первой резервной копии
+        path = ChangeLog.path_for(self._path)
+        if self._readonly or not os.path.exists(path):
+            return
+        self._changes = ChangeLog(path)
+        self._changes.open()
+
+    def _drop_changes(self):
+        # Файлы переписаны целиком: следующая копия будет полной
+        if self._changes:
+            self._changes.close()
+            os.remove(self._changes.path)
+            self._changes = None
+
+    def changes(self):
+        self._check_writable()
+        return self._changes
+
+    def track_changes(self, token):
+        # Учет изменений заново, с метки нового поколения копии
+        self._check_writable()
+        if self._changes:
+            self._changes.close()
+        path = ChangeLog.path_for(self._path)
+        ChangeLog.create(path, token)
+        self._changes = ChangeLog(path)
+        self._changes.open()
+
+    def freeze(self):
+        # Контрольная точка и запрет записи в файлы данных до thaw:
+        # изменения копятся в кэше и журнале, а файлы остаются снимком
+        # этого момента. Возвращает [(номер файла образа, путь, размер)],
+        # у куч и фильтра номера нет
+        if not self._readonly:
+            self.checkpoint()
+        self._frozen += 1
+        files = list()
+        for number, stream in enumerate(self._streams()):
+            if stream:
+                files.append(
+                    (number, stream.path, os.path.getsize(stream.path)))
+                files.append((None, stream.heap.path, len(stream.heap)))
+        if self._blobs is not None:
+            files.append((None, self._blobs.path, len(self._blobs)))
+        if self._bloom:
+            files.append((None, self._bloom.path,
+                          os.path.getsize(self._bloom.path)))
+        return files
+
+    def thaw(self):
+        self._frozen = max(self._frozen - 1, 0)
+
+    def _check_frozen(self):
+        if self._frozen:
+            text = f"Storage '{self._path}' is being copied"
+            raise StorageError(text)
+
+    def _copy(self, job):
+        job.begin(self)
+        try:
+            job.copy()
+        finally:
+            report = job.end(self)
+        return report
+
+    def snapshot(self, dest):
+        # Согласованная копия хранилища в dest
+        return self._copy(Snapshot(dest))
+
+    def backup(self, directory, incremental=False):
+        # Очередное поколение резервной копии в каталоге directory
+        self._check_writable()
+        return self._copy(Backup(directory, incremental))
+
+    def _check_index(self):
+        if self._index is None:
+            text = f"Storage '{self._path}' has no value index"
+            raise StorageError(text)
+
+    def rebuild_index(self):
+        # Индекс строится заново по текущим парам; создается, если его
+        # не было
+        self._check_writable()
+        self._check_frozen()
+        self.checkpoint()
+        self._drop_changes()
+        total, entries = sort_pairs(
+            ((entry(key, self._view(value)), b"")
+             for key, value in self._tree.items()),
+            directory=os.path.dirname(self._path) or None)
+        if self._index is None:
+            self._index = ValueIndex(ValueIndex.path_for(self._path),
+                                     ENGINES[self.engine], self._cache_size)
+        self._index.rebuild(entries, total)
+
+    def _open_bloom(self):
+        # Фильтр открывается после восстановления: если прошлая сессия
+        # не закрыла его чисто, счетчики могут расходиться с деревом
+        path = BloomFilter.path_for(self._path)
+        if not os.path.exists(path):
+            return
+        self._bloom = BloomFilter(path)
+        self._bloom.open(self._readonly)
+        if self._stats is not None:
+            self._stats.file_opens += 1
+        if not self._bloom.clean and not self._readonly:
+            self.rebuild_bloom()
+
+    def _check_writable(self):
+        if self._readonly:
+            text = f"Storage '{self._path}' is opened read-only"
+            raise StorageError(text)
+
+    def rebuild_bloom(self, fp_rate=None):
+        # Новый фильтр по текущим ключам, размер под их число
+        self._check_writable()
+        if fp_rate is None:
+            fp_rate = self._bloom.fp_rate if self._bloom else BLOOM_FP_RATE
+        path = BloomFilter.path_for(self._path)
+        temp = path + ".rebuild"
+        BloomFilter.create(
+            temp, max(len(self._tree), BLOOM_CAPACITY), fp_rate)
+        bloom = BloomFilter(temp)
+        bloom.open()
+        for key in self._tree:
+            bloom.add(key)
+        bloom.close(clean=True)
+
+        if self._bloom:
+            self._bloom.close()
+        os.replace(temp, path)
+        self._bloom = BloomFilter(path)
+        self._bloom.open()
+
+    def bloom_stats(self):
+        if self._bloom:
+            return self._bloom.stats()
+
+    def stats(self):
+        # Счетчики ввода-вывода и гистограммы задержек операций
+        if self._stats is not None:
+            return self._stats.as_dict()
+
+    def tree_stats(self):
+        return self._tree.structure()
+
+    def _maybe_contains(self, key):
+        return self._bloom is None or key in self._bloom
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._close()
+        self._lock.close()
+        self._lock = None
+
+    def _close(self):
+        # Незаконченное копирование теряет согласованность, но файлы
+        # хранилища должны получить изменения через журнал
+        self._frozen = 0
+        self.checkpoint()
+        if self._bloom:
+            self._bloom.close(clean=True)
+            self._bloom = None
+        if self._index:
+            self._index.close()
+            self._index = None
+        if self._expiry:
+            self._expiry.close()
+            self._expiry = None
+        if self._changes:
+            self._changes.close()
+            self._changes = None
+        if self._oplog:
+            self._oplog.close()
+            self._oplog = None
+        if self._blobs is not None:
+            self._blobs.close()
+            self._blobs = None
+        self._wal.close()
+        self._stream.close()
+        self._stream = None
+        self._tree = None
+        self._wal = None
+
+    def checkpoint(self):
+        # Измененные записи попадают в файл данных только здесь: сначала
+        # их образы фиксируются в журнале, затем пишутся на место
+        # Образы индексов пишутся той же записью журнала. Пока файлы
+        # копируются, точка откладывается: изменения остаются в журнале
+        if self._frozen:
+            return
+        streams = [(number, stream) for number, stream
+                   in enumerate(self._streams()) if stream]
+        images = [stream.blocks() for _, stream in streams]
+        blocks = [(number, offset, data)
+                  for (number, _), image in zip(streams, images)
+                  for offset, data in image]
+        # Заголовок журнала операций - позиция, до которой он совпадает
+        # с файлами данных; номер его файла следует за деревьями
+        oplog = self._oplog if self._oplog and self._oplog.dirty() \
+            else None
+        if oplog:
+            oplog.sync()
+            blocks.append((len(self._streams()), 0, oplog.image()))
+        if blocks:
+            for _, stream in streams:
+                stream.heap.sync()
+            if self._blobs is not None:
+                self._blobs.sync()
+            self._wal.log_image(blocks)
+            if self._changes:
+                self._changes.append(blocks)
+            for (_, stream), image in zip(streams, images):
+                stream.write_blocks(image)
+                stream.sync()
+            if oplog:
+                oplog.write_header()
+            if self._changes:
+                self._changes.sync()
+        if self._wal.size():
+            self._wal.reset()
+
+    def sync(self):
+        # Долгоживущий процесс вызывает это по таймеру, чтобы последние
+        # записи не ждали следующей операции ради группового fsync
+        self._wal.commit()
+
+    def compact(self):
+        # Живые данные переписываются во временный файл, который затем
+        # атомарно подменяет хранилище. Куча нового файла получает новое
+        # поколение, поэтому старая остается целой до переименования
+        self._check_writable()
+        self._check_frozen()
+        # Истекшие ключи не переносятся в новый файл
+        self.reap()
+        self.checkpoint()
+        self._drop_changes()
+        stream_class, _ = ENGINES[self.engine]
+        temp = self._path + ".compact"
+        generation = self._stream.heap_gen + 1
+        for path in glob.glob(glob.escape(temp) + "*"):
+            os.remove(path)
+
+        sample = self._sample_keys()
+        size_before = self._size()
+        latency_before = self._latency(sample)
+
+        stream_class.create(temp, heap_gen=generation)
+        target = stream_class(temp)
+        target.open()
+        # Живые блобы переписываются в новый файл по порядку записей
+        blobs = None
+        if self._blobs is not None:
+            path = BlobStore.path_for(temp)
+            BlobStore.create(path)
+            blobs = BlobStore(path)
+            blobs.open()
+
+            def convert(value):
+                if is_ref(value):
+                    return blobs.append(self._blobs.view(value))
+                return value
+        else:
+            convert = None
+        self._tree.compact_into(target, convert)
+        target.sync()
+        target.close()
+        if blobs is not None:
+            blobs.sync()
+            blobs.close()
+
+        old_heap = self._stream.heap.path
+        self._stream.close()
+        os.replace(Heap.path_for(temp, generation),
+                   Heap.path_for(self._path, generation))
+        os.replace(temp, self._path)
+        directory = os.open(os.path.dirname(self._path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        if blobs is not None:
+            # После подмены дерева: упавшее здесь сжатие доделывает
+            # следующее открытие, см. _compacted_blobs
+            self._blobs.close()
+            self._blobs = None
+            os.replace(blobs.path, BlobStore.path_for(self._path))
+            self._open_blobs()
+        os.remove(old_heap)
+        self._open_tree()
+        if self._index:
+            self.rebuild_index()
+
+        return {
+            "size_before": size_before,
+            "size_after": self._size(),
+            "lookup_before": latency_before,
+            "lookup_after": self._latency(sample),
+        }
+
+    def _size(self):
+        paths = [self._path, self._stream.heap.path, self._wal.path]
+        if self._blobs is not None:
+            paths.append(self._blobs.path)
+        return sum(os.path.getsize(path) for path in paths)
+
+    def _sample_keys(self):
+        # Равномерная выборка ключей за один проход
+        sample = list()
+        for i, key in enumerate(self._tree):
+            if i < LATENCY_SAMPLE:
+                sample.append(key)
+            else:
+                j = random.randrange(i + 1)
+                if j < LATENCY_SAMPLE:
+                    sample[j] = key
+        return sample
+
+    def _latency(self, keys):
+        # Среднее время поиска в секундах при пустом кэше
+        if not keys:
+            return 0.0
+        self._stream.drop_cache()
+        started = time.perf_counter()
+        for key in keys:
+            self._tree.get(key)
+        return (time.perf_counter() - started) / len(keys)
+
+    def _apply(self, ops):
+        stats = self._stats
+        index = self._index
+        for op, key, *value in ops:
+            if op == EXPIRE:
+                self._open_expiry(create=True)
+                self._expiry.set(key, value[0])
+                continue
+            if stats is not None:
+                started = time.perf_counter()
+            # Новая запись или удаление снимает прежний срок жизни
+            if self._expiry:
+                self._expiry.clear(key)
+            # Старое значение нужно, чтобы убрать его запись из индекса
+            old = self._view(self._tree.get(key)) if index else None
+            if op == PUT:
+                stored = self._store(value[0])
+                if index:
+                    value = self._view(value[0])
+                    if old != value:
+                        index.add(key, value)
+                        if old is not None:
+                            index.remove(key, old)
+                if self._tree.insert(key, stored) and self._bloom:
+                    self._bloom.add(key)
+            else:
+                if old is not None:
+                    index.remove(key, old)
+                if self._tree.delete(key) and self._bloom:
+                    self._bloom.remove(key)
+            if stats is not None:
+                stats.observe(
+                    "insert" if op == PUT else "delete", key, started)
+
+    def _check_ops(self, ops):
+        # Пакет проверяется целиком до журнала и дерева: ошибка посреди
+        # применения оставила бы в дереве часть пакета
+        limit = self._tree.max_key_size
+        for op, key, *value in ops:
+            if op not in (PUT, DELETE, EXPIRE) or \
+                    not isinstance(key, bytes) or not key or \
+                    len(value) != (op != DELETE):
+                raise ValueError(f"Malformed operation {op!r}")
+            if op == PUT and (not isinstance(value[0], bytes) or
+                              value[0][:1] not in TAGS):
+                raise ValueError(f"Malformed value for key {key!r}")
+            if op == EXPIRE and (not isinstance(value[0], bytes) or
+                                 len(value[0]) != moment.size):
+                raise ValueError(f"Malformed expiry for key {key!r}")
+            if limit is None or op == DELETE:
+                continue
+            # Ключи боковых деревьев длиннее ключа хранилища
+            size = len(key)
+            if op == EXPIRE:
+                size += len(TIME) + moment.size
+            elif self._index:
+                size = len(entry(key, self._view(value[0])))
+            if size > limit:
+                raise ValueError(
+                    f"Key longer than {limit} bytes "
+                    f"is not supported by {self.engine} engine")
+
+    def _write(self, ops, reap=REAP_STEP):
+        # Перед записью удаляется до reap истекших ключей, тем же пакетом
+        # журнала: удаления идут первыми и не задевают новые значения
+        self._check_writable()
+        self._check_ops(ops)
+        expired = list()
+        if self._expiry:
+            at = now()
+            expired = self._expiry.expired(at, reap)
+            ops = [(DELETE, key) for key in expired] + ops
+        if not ops:
+            return 0
+        self._wal.log(ops)
+        self._apply(ops)
+        if self._oplog:
+            self._oplog.append(self._inline(ops))
+        if expired:
+            self._expiry.refresh(at)
+        if any(stream.dirty_count() > stream.cache_size
+               for stream in self._streams() if stream) \
+                or self._wal.size() > WAL_LIMIT:
+            self.checkpoint()
+        return len(expired)
+
+    def __setitem__(self, key, value):
+        self._write([(PUT, encode(key), encode(value))])
+
+    def set(self, key, value, ttl=None):
+        self.update([(key, value)], ttl)
+
+    def update(self, items, ttl=None):
+        # ttl - срок жизни записанных ключей в секундах
+        if hasattr(items, "items"):
+            items = items.items()
+        # Повторные ключи: побеждает последнее значение
+        batch = {encode(key): encode(value) for key, value in items}
+        ops = list()
+        when = None if ttl is None else deadline(ttl)
+        for key in sorted(batch):
+            ops.append((PUT, key, batch[key]))
+            if when is not None:
+                ops.append((EXPIRE, key, when))
+        self._write(ops)
+
+    def check(self, items):
+        # Пары проверяются так же, как при записи, но не пишутся: пакетный
+        # режим сообщает об ошибке на строке с неподходящей парой
+        self._check_ops([(PUT, encode(key), encode(value))
+                         for key, value in items])
+
+    def set_file(self, key, file, ttl=None):
+        # Значение типа bytes из файлового объекта: читается кусками
+        # прямо в файл блобов и не собирается в памяти целиком
+        self._check_writable()
+        key = encode(key)
+        self._open_blobs(create=True)
+        value = self._blobs.append_stream(file, bytes([BYTES]))
+        # Журнал получит только ссылку, поэтому данные нужны на диске
+        # раньше него
+        self._blobs.sync()
+        ops = [(PUT, key, value)]
+        if ttl is not None:
+            ops.append((EXPIRE, key, deadline(ttl)))
+        self._write(ops)
+
+    def ttl(self, key):
+        # Сколько секунд осталось жить ключу; None - ключа нет или срок
+        # не задан
+        key = encode(key)
+        if self._expiry is None or not self._contains(key):
+            return None
+        when = self._expiry.expires_at(key)
+        if when is not None:
+            return max(when - now(), 0) / 1000
+
+    def reap(self, limit=None):
+        # Удаляет истекшие ключи пачками по REAP_CHUNK, не больше limit
+        self._check_writable()
+        total = 0
+        while self._expiry and (limit is None or total < limit):
+            step = REAP_CHUNK if limit is None else \
+                min(REAP_CHUNK, limit - total)
+            reaped = self._write([], step)
+            total += reaped
+            if reaped < step:
+                break
+        return total
+
+    def _live(self):
+        # Проверка истечения на один вызов чтения: время берется один
+        # раз; None - истекших ключей заведомо нет
+        expiry = self._expiry
+        if expiry is None:
+            return None
+        at = now()
+        if not expiry.maybe_expired(at):
+            return None
+        return lambda key: not expiry.is_expired(key, at)
+
+    def bulk_load(self, items, chunk_size=CHUNK_SIZE):
+        self._check_writable()
+        if hasattr(items, "items"):
+            items = items.items()
+        items = ((encode(key), encode(value)) for key, value in items)
+        total, pairs = sort_pairs(
+            items, chunk_size, os.path.dirname(self._path) or None)
+
+        if not self._tree.is_empty() or self._oplog:
+            # Хранилище не пусто или последователям нужны операции:
+            # строить дерево с нуля нельзя
+            batch = list()
+            for key, value in pairs:
+                batch.append((PUT, key, value))
+                if len(batch) >= chunk_size:
+                    self._write(batch)
+                    batch = list()
+            self._write(batch)
+        else:
+            # Дерево пишется в файл данных целиком, минуя журнал
+            self._check_frozen()
+            self._drop_changes()
+            self._tree.build(
+                ((key, self._store(value)) for key, value in pairs), total)
+            if self._blobs is not None:
+                self._blobs.sync()
+            self._stream.sync()
+            self._wal.reset()
+            if self._bloom:
+                self.rebuild_bloom()
+            if self._index:
+                self.rebuild_index()
+        return total
+
+    def __getitem__(self, key):
+        key = encode(key)
+        if self._stats is not None:
+            started = time.perf_counter()
+            value = self._get(key)
+            self._stats.observe("find", key, started)
+        else:
+            value = self._get(key)
+        if value is not None:
+            return decode(value)
+
+    def _get(self, key):
+        return self._load(self._find(key))
+
+    def get_view(self, key):
+        # Байты значения типа bytes или str (utf-8) как memoryview; None -
+        # ключа нет. Длинное значение отдается прямо из отображения
+        # файла блобов без копирования, и представление остается верным
+        # после записей и закрытия хранилища
+        value = self._find(encode(key))
+        if value is None:
+            return None
+        view = self._blobs.view(value) if is_ref(value) \
+            else memoryview(value)
+        if view[0] not in (BYTES, STR):
+            raise TypeError(f"Value of key {key!r} is not bytes or str")
+        return view[1:]
+
+    def _find(self, key):
+        # Код значения или ссылка на блоб
+        if not self._maybe_contains(key):
+            return None
+        value = self._tree.get(key)
+        if value is None and self._bloom:
+            self._bloom.false_positives += 1
+        if value is not None and self._expired(key):
+            return None
+        return value
+
+    def _expired(self, key):
+        live = self._live()
+        return live is not None and not live(key)
+
+    def _get_many(self, keys, values=True):
+        # Пакет попадает в гистограмму поиска одной операцией
+        if self._stats is not None:
+            started = time.perf_counter()
+        lookup = [key for key in sorted(set(keys))
+                  if self._maybe_contains(key)]
+        found = self._tree.get_many(lookup, values)
+        if self._bloom:
+            self._bloom.false_positives += len(lookup) - len(found)
+        live = self._live()
+        if live is not None:
+            found = {key: value for key, value in found.items()
+                     if live(key)}
+        if values and self._blobs is not None:
+            found = {key: self._load(value) for key, value in found.items()}
+        if self._stats is not None:
+            self._stats.observe("find", None, started)
+        return found
+
+    def get_many(self, keys):
+        keys = [encode(key) for key in keys]
+        found = self._get_many(keys)
+        return [decode(found[key]) if key in found else None
+                for key in keys]
+
+    def contains_many(self, keys):
+        keys = [encode(key) for key in keys]
+        found = self._get_many(keys, values=False)
+        return [key in found for key in keys]
+
+    def __delitem__(self, key):
+        self._write([(DELETE, encode(key))])
+
+    def replay(self, ops):
+        # Операции журнала другого хранилища в том же коде, одним пакетом
+        self._write(list(ops))
+
+    def delete_many(self, keys):
+        # Все удаления - одна запись журнала
+        keys = {encode(key) for key in keys}
+        self._write([(DELETE, key) for key in sorted(keys)])
+
+    def __contains__(self, item):
+        key = encode(item)
+        if self._stats is not None:
+            started = time.perf_counter()
+            found = self._contains(key)
+            self._stats.observe("find", key, started)
+            return found
+        return self._contains(key)
+
+    def _contains(self, key):
+        if not self._maybe_contains(key):
+            return False
+        if key in self._tree:
+            return not self._expired(key)
+        if self._bloom:
+            self._bloom.false_positives += 1
+        return False
+
+    def _expired_ranks(self):
+        # Позиции в дереве истекших, но еще не удаленных ключей, по
+        # возрастанию. Счетчики поддеревьев о сроках не знают, поэтому
+        # rank, select и count пропускают эти позиции сами. Читатель
+        # удалять не может, а сборщик держит таких ключей немного
+        expiry = self._expiry
+        if expiry is None:
+            return []
+        return sorted(self._tree.rank(key)
+                      for key in expiry.expired(now(), None))
+
+    def _rank(self, key, ranks):
+        position = self._tree.rank(key)
+        return position - bisect_left(ranks, position)
+
+    def rank(self, key):
+        # Сколько ключей меньше key, в порядке кодов
+        return self._rank(encode(key), self._expired_ranks())
+
+    def select(self, i):
+        # i-й по порядку ключ; отрицательный индекс - с конца
+        ranks = self._expired_ranks()
+        size = len(self._tree) - len(ranks)
+        if i < 0:
+            i += size
+        if not 0 <= i < size:
+            raise IndexError(f"Index {i} out of range for {size} keys")
+        for position in ranks:
+            if position > i:
+                break
+            i += 1
+        return decode(self._tree.select(i))
+
+    def count(self, lo=None, hi=None):
+        # Число ключей в [lo, hi) без обхода диапазона
+        ranks = self._expired_ranks()
+        upper = len(self._tree) - len(ranks) if hi is None \
+            else self._rank(encode(hi), ranks)
+        lower = 0 if lo is None else self._rank(encode(lo), ranks)
+        return max(upper - lower, 0)
+
+    def keys_for(self, value, after=None):
+        # Ключи с данным значением в порядке ключей, после after, если
+        # он задан. Длинное значение индекс находит по хэшу, и оно
+        # сверяется с хранилищем
+        self._check_index()
+        value = encode(value)
+        after = None if after is None else encode(after)
+        exact = not is_truncated(value)
+        live = self._live()
+        for key in self._index.keys_for(value, after):
+            if (live is None or live(key)) and \
+                    (exact or self._view(self._tree.get(key)) == value):
+                yield decode(key)
+
+    def value_range(self, lo=None, hi=None, reverse=False, after=None):
+        # Пары (значение, ключ) с lo <= значение < hi по порядку значений,
+        # после пары after, если она задана
+        self._check_index()
+        lo = None if lo is None else encode(lo)
+        hi = None if hi is None else encode(hi)
+        if after is not None:
+            after = encode(after[0]), encode(after[1])
+        live = self._live()
+        for value, key in self._index_rows(lo, hi, reverse, after):
+            if live is None or live(key):
+                yield decode(value), decode(key)
+
+    def _index_rows(self, lo, hi, reverse, after):
+        # Длинные значения индекс хранит началом и хэшем: они читаются
+        # из хранилища, проверяются по границам, а пары с общим началом
+        # упорядочиваются заново, в памяти
+        group, head = list(), None
+        rows = self._index.range(lo, hi, reverse, after)
+        for value, key, prefix in rows:
+            if group and prefix != head:
+                yield from self._index_group(
+                    group, lo, hi, reverse, after)
+                group = list()
+            if prefix is None:
+                yield value, key
+            else:
+                head = prefix
+                group.append(key)
+        if group:
+            yield from self._index_group(
+                group, lo, hi, reverse, after)
+
+    def _index_group(self, keys, lo, hi, reverse, after):
+        rows = sorted(((self._load(self._tree.get(key)), key)
+                       for key in keys), reverse=reverse)
+        for row in rows:
+            # При продолжении уже отданные пары группы пропускаются
+            if after is not None and \
+                    (row >= after if reverse else row <= after):
+                continue
+            value = row[0]
+            if (lo is None or value >= lo) and (hi is None or value < hi):
+                yield row
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        live = self._live()
+        for key in self._tree:
+            if live is None or live(key):
+                yield decode(key)
+
+    def values(self):
+        live = self._live()
+        for key, value in self._tree.items():
+            if live is None or live(key):
+                yield decode(self._load(value))
+
+    def items(self, reverse=False):
+        return self.range(reverse=reverse)
+
+    def range(self, lo=None, hi=None, reverse=False):
+        lo = None if lo is None else encode(lo)
+        hi = None if hi is None else encode(hi)
+        live = self._live()
+        for key, value in self._tree.items(lo, hi, reverse):
+            if live is None or live(key):
+                yield decode(key), decode(self._load(value))
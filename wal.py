@@ -0,0 +1,190 @@
+import os
+import struct
+import time
+import zlib
+
+
+PUT = 1
+DELETE = 2
+# Срок жизни ключа: значение операции - момент истечения
+EXPIRE = 3
+
+# Типы записей журнала
+BATCH = 1
+IMAGE = 2
+
+SYNC_POLICIES = ("always", "batch", "off")
+SYNC_INTERVAL = 10
+
+
+op_header = struct.Struct(">BI")
+op_length = struct.Struct(">I")
+
+
+def pack_ops(ops):
+    # Операция: код и длина ключа, ключ, для записей - длина и значение
+    parts = list()
+    for op, key, *value in ops:
+        parts.append(op_header.pack(op, len(key)))
+        parts.append(key)
+        if op != DELETE:
+            parts.append(op_length.pack(len(value[0])))
+            parts.append(value[0])
+    return b"".join(parts)
+
+
+def unpack_ops(payload):
+    ops = list()
+    offset = 0
+    while offset < len(payload):
+        op, key_len = op_header.unpack_from(payload, offset)
+        offset += op_header.size
+        key = payload[offset:offset + key_len]
+        offset += key_len
+        if op != DELETE:
+            value_len = op_length.unpack_from(payload, offset)[0]
+            offset += op_length.size
+            ops.append((op, key, payload[offset:offset + value_len]))
+            offset += value_len
+        else:
+            ops.append((op, key))
+    return ops
+
+
+def parse_sync(policy):
+    # "always", "off", "batch" или "batch:N", где N - интервал в мс
+    mode, _, interval = policy.partition(":")
+    if mode not in SYNC_POLICIES or (interval and mode != "batch"):
+        raise ValueError(f"Unknown fsync policy '{policy}'")
+    return mode, (float(interval) if interval else SYNC_INTERVAL) / 1000
+
+
+class WriteAheadLog:
+    # Журнал рядом с файлом хранилища. Операции пишутся логическими
+    # записями (одна запись - один атомарный пакет), а контрольная точка
+    # сначала пишет в журнал образы измененных блоков и только потом
+    # переносит их в файл данных, поэтому оборванная контрольная точка
+    # повторяется при восстановлении
+    record = struct.Struct(">IIB")
+    # Номер файла в образе (0 - хранилище, 1 - индекс значений,
+    # 2 - сроки жизни, 3 - журнал операций), смещение, длина
+    block = struct.Struct(">BQI")
+
+    def __init__(self, path, sync="batch"):
+        self.path = path
+        self.mode, self.interval = parse_sync(sync)
+        self._file = None
+        self._size = 0
+        self._last_sync = 0
+        self._pending = False
+
+    @staticmethod
+    def path_for(storage_path):
+        return storage_path + ".wal"
+
+    def open(self):
+        self._file = open(self.path, "a+b")
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.commit()
+            self._file.close()
+            self._file = None
+
+    def commit(self):
+        # Сбрасывает записи, ожидающие группового fsync
+        if self._pending and self.mode != "off":
+            self.sync()
+
+    def size(self):
+        return self._size
+
+    def _append(self, kind, payload):
+        crc = zlib.crc32(payload, zlib.crc32(bytes([kind])))
+        self._file.write(self.record.pack(len(payload), crc, kind))
+        self._file.write(payload)
+        self._file.flush()
+        self._size += self.record.size + len(payload)
+
+    def log(self, ops):
+        self._append(BATCH, pack_ops(ops))
+        self._pending = True
+
+        # Групповая фиксация: один fsync на все записи за интервал
+        if self.mode == "always":
+            self.sync()
+        elif self.mode == "batch" and \
+                time.monotonic() - self._last_sync >= self.interval:
+            self.sync()
+
+    def log_image(self, blocks):
+        # blocks - тройки (файл, смещение, данные): образ всех файлов
+        # фиксируется одной записью, поэтому они не расходятся
+        parts = list()
+        for number, offset, data in blocks:
+            parts.append(self.block.pack(number, offset, len(data)))
+            parts.append(data)
+        self._append(IMAGE, b"".join(parts))
+        self.sync()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+        self._pending = False
+
+    def reset(self):
+        self._file.truncate(0)
+        self._size = 0
+        self.sync()
+
+    def read(self):
+        # Последний целый образ и пакеты операций после него; чтение
+        # останавливается на первой оборванной или испорченной записи
+        image = None
+        batches = list()
+        self._file.seek(0, 0)
+        data = self._file.read()
+        offset = 0
+        while offset + self.record.size <= len(data):
+            length, crc, kind = self.record.unpack_from(data, offset)
+            start = offset + self.record.size
+            payload = data[start:start + length]
+            if len(payload) != length or \
+                    zlib.crc32(payload, zlib.crc32(bytes([kind]))) != crc:
+                break
+            if kind == IMAGE:
+                image = self._blocks(payload)
+                batches = list()
+            elif kind == BATCH:
+                batches.append(unpack_ops(payload))
+            offset = start + length
+        self._file.truncate(offset)
+        self._size = offset
+        return image, batches
+
+    def _blocks(self, payload):
+        blocks = list()
+        offset = 0
+        while offset < len(payload):
+            number, position, length = \
+                self.block.unpack_from(payload, offset)
+            offset += self.block.size
+            blocks.append(
+                (number, position, payload[offset:offset + length]))
+            offset += length
+        return blocks
+
+    @staticmethod
+    def apply_image(blocks, paths):
+        for number, path in enumerate(paths):
+            if path is None:
+                continue
+            with open(path, "rb+") as storage:
+                for block, offset, data in blocks:
+                    if block == number:
+                        storage.seek(offset, 0)
+                        storage.write(data)
+                storage.flush()
+                os.fsync(storage.fileno())